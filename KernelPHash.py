@@ -1,19 +1,53 @@
 #! /usr/bin/env python3
 """ Author: Jianqi Chen, Date: May 2019 """
-from anytree import Node
-import os, sys, re, math
+import os, sys, re, math, bisect, array, collections, itertools, json, contextlib, time, threading, mmap, struct, random, importlib, importlib.util
+
+# Importing this module only defines functions: anytree is imported by the functions that build anytree nodes, numpy and asyncio when
+# they are first used (see LazyModule), and the modules of the batch, service and cache modes by these modes.
+# A module imported at the first access to one of its attributes, then bound to the global name instead of this object.
+class LazyModule:
+    def __init__(self, name, global_name):
+        self.name = name
+        self.global_name = global_name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.name)
+        if globals().get(self.global_name) is self:
+            globals()[self.global_name] = module
+        return getattr(module, attr)
+
+np = LazyModule('numpy', 'np') if importlib.util.find_spec('numpy') else None # numpy is optional, hash lists are compared in pure python without it
+asyncio = LazyModule('asyncio', 'asyncio')
+
+# anytree Node, for 'from KernelPHash import Node' and kph.Node (anytree is not imported with this module)
+def __getattr__(name):
+    if name == 'Node':
+        from anytree import Node
+        return Node
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 TEXTGEN = 'preorder' # can be 'preorder', 'postorder' or 'BFS'
 PHASH = 'selfmade' #perceptual hash algorithm, 'selfmade' is using TextHash64 function, 'pHashlib' is using pHash C++ library
 prevent_overlapped_name = True
-node_name_dict = {}
-os.system('cd pHash && rm -f text_ast hash hash.info')
-os.system('chmod 744 pHash/text_hash.exe')
+FINGERPRINT_VERSION = 1 # version of the fingerprints, increase it when the output of KernelFingerprint() changes (invalidates FingerprintCache)
 
 def usage():
     print('Please see example.py')
 
 def main(argv):
+    if '--batch' in argv:
+        argv.remove('--batch')
+        return BatchMain(argv)
+    if '--profile' in argv:
+        argv.remove('--profile')
+        return ProfileMain(argv)
+    if '--serve' in argv:
+        argv.remove('--serve')
+        return ServeMain(argv)
+    if '--clones' in argv:
+        argv.remove('--clones')
+        return ClonesMain(argv)
+
     from anytree.exporter import DotExporter
     from anytree import RenderTree
 
@@ -30,9 +64,7 @@ def main(argv):
 
         # print tree in terminal
         for pre, fill, node in RenderTree(ast_nodes[0]):
-            if prevent_overlapped_name == 1:
-                node_name = re.sub(r'\{[\d]+\}','',node.name)
-            print("%s%s" % (pre,node_name))
+            print("%s%s" % (pre,node.label))
 
         # print DFS pre-order traversal
         text_d = TextGenDFS(ast_nodes, order='pre')
@@ -58,33 +90,848 @@ def main(argv):
         print('Hash list of',argv[1],':',hash_1)
         print('Average Hamming Distance:',hm_dist)
 
+# Batch mode: fingerprint many kernel files with a process pool, print one JSON line per file: {"index": n, "file": name, "hash": [...]}
+# ({"index": n, "file": name, "error": message} if the file fails). e.g. python KernelPHash.py --batch test_cases -j 4 -o hashes.jsonl
+# With --multi, every file has several kernels (see SplitKernels) and every line has the "kernel" name too.
+def BatchMain(argv):
+    import argparse, multiprocessing
+    parser = argparse.ArgumentParser(prog='KernelPHash.py --batch', description='Generate the hash lists of many kernel files, as JSON lines.')
+    parser.add_argument('paths', nargs='*', help="kernel files, directories (files matching --pattern inside), glob patterns, or '-' to read file names from stdin, one per line (default)")
+    parser.add_argument('--pattern', default='*.txt', help='file name pattern in directories (default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: number of CPUs), 1 to run in this process')
+    parser.add_argument('--chunk-size', type=int, default=1, help='number of files sent to a worker at a time (default: %(default)s)')
+    parser.add_argument('--ordered', action='store_true', help='print the results in input order instead of completion order')
+    parser.add_argument('--textgen', default=TEXTGEN, choices=['preorder','postorder','BFS'])
+    parser.add_argument('--phash', default=PHASH, choices=['selfmade','pHashlib'])
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    parser.add_argument('--cache', metavar='DIR', help='fingerprint cache directory (see FingerprintCache), no cache by default')
+    parser.add_argument('--cache-size', type=float, default=256, help='maximum cache size in MB (default: %(default)s)')
+    parser.add_argument('--multi', action='store_true', help="every input file has several kernels, each one after a '//@kernel name' line (see SplitKernels)")
+    parser.add_argument('--store', metavar='FILE', help='also write the hash lists to a binary fingerprint store (see FingerprintStore), in input order')
+    parser.add_argument('--stats', metavar='FILE', help="write a JSON summary of the time of every pipeline stage and of the counts (see PipelineStats) to FILE, '-' for stderr")
+    args = parser.parse_args(argv)
+
+    cache = (args.cache, int(args.cache_size*1024*1024)) if args.cache else None
+    if args.multi:
+        kernels = MultiKernels( BatchInputs(args.paths or ['-'], args.pattern) )
+    else:
+        kernels = ( (file_name, None, None, None) for file_name in BatchInputs(args.paths or ['-'], args.pattern) )
+    tasks = ( (i, file_name, args.textgen, args.phash, cache, name, kernel_txt, error, bool(args.stats)) for i, (file_name, name, kernel_txt, error) in enumerate(kernels) )
+    out = open(args.output,'w') if args.output else sys.stdout
+    counts = collections.Counter()
+    results = [] if args.store else None
+    stats = PipelineStats() if args.stats else None
+    start = time.perf_counter()
+    try:
+        if args.workers > 1:
+            with multiprocessing.Pool(args.workers) as pool:
+                imap = pool.imap if args.ordered else pool.imap_unordered
+                for result in imap(BatchTask, tasks, chunksize=args.chunk_size):
+                    BatchOutput(result, out, counts, results, stats)
+        else:
+            for task in tasks:
+                BatchOutput(BatchTask(task), out, counts, results, stats)
+    finally:
+        if args.output:
+            out.close()
+
+    if stats:
+        summary = dict( stats.Summary(), wall_time=time.perf_counter()-start, workers=args.workers, errors=counts['error'] )
+        if args.stats == '-':
+            print(json.dumps(summary, indent=1), file=sys.stderr)
+        else:
+            with open(args.stats,'w') as f:
+                json.dump(summary, f, indent=1)
+
+    if args.store:
+        results.sort( key=lambda result: result['index'] )
+        FingerprintStore.Write( args.store, [ result['hash'] for result in results ], [ result.get('kernel', result['file']) for result in results ] )
+    if cache:
+        print('cache: %d hits, %d misses' % (counts['hit'], counts['miss']), file=sys.stderr)
+    return 1 if counts['error'] else 0
+
+def BatchOutput(result, out, counts, results=None, stats=None):
+    if 'stats' in result: # not printed
+        stats.Merge( result.pop('stats') )
+    counts['error'] += 'error' in result
+    counts[ result.get('cache') ] += 1
+    out.write(json.dumps(result)+'\n')
+    out.flush()
+    if results != None and 'hash' in result:
+        results.append(result)
+
+# (file name, kernel name, kernel text, None) of every kernel of the files of --batch --multi, read in this process.
+# A file that cannot be read gives (file name, None, None, error) instead, and the batch goes on.
+def MultiKernels(file_names):
+    for file_name in file_names:
+        try:
+            kernels = ReadKernels(file_name)
+        except (OSError, UnicodeDecodeError) as e:
+            yield (file_name, None, None, '%s: %s' % (type(e).__name__, e))
+            continue
+        for name, kernel_txt in kernels:
+            yield (file_name, name, kernel_txt, None)
+
+# file names of the batch inputs: files in directories (recursively), files matching glob patterns, file names from stdin for '-'
+def BatchInputs(paths, pattern='*.txt'):
+    import glob
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        elif os.path.isdir(path):
+            yield from sorted( glob.glob( os.path.join(path,'**',pattern), recursive=True ) )
+        elif any( c in path for c in '*?[' ):
+            yield from sorted( glob.glob(path, recursive=True) )
+        else:
+            yield path
+
+# Profile mode: fingerprint one kernel file under cProfile, print the time of every pipeline stage (PipelineStats) and the functions
+# taking the most time. e.g. python KernelPHash.py --profile test_cases/test.txt --repeat 20
+def ProfileMain(argv):
+    import cProfile, pstats, argparse
+    parser = argparse.ArgumentParser(prog='KernelPHash.py --profile', description='Profile the fingerprint of one kernel file.')
+    parser.add_argument('file', help='kernel file')
+    parser.add_argument('--textgen', default=TEXTGEN, choices=['preorder','postorder','BFS'])
+    parser.add_argument('--phash', default=PHASH, choices=['selfmade','pHashlib'])
+    parser.add_argument('--repeat', type=int, default=1, help='number of times the kernel is fingerprinted (default: %(default)s)')
+    parser.add_argument('--anytree', action='store_true', help='convert the AST to anytree nodes as ASTGen(text) does (CompactAST by default)')
+    parser.add_argument('--sort', default='cumulative', help='sort key of the cProfile statistics (default: %(default)s)')
+    parser.add_argument('--limit', type=int, default=25, help='number of functions printed (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='also save the cProfile statistics to this file (for pstats or snakeviz)')
+    args = parser.parse_args(argv)
+
+    with open(args.file,'r') as f:
+        kernel_txt = f.read()
+    profile = cProfile.Profile()
+    with CollectStats() as stats:
+        profile.enable()
+        for _ in range(args.repeat):
+            hash_v = PHashGen( ASTGen(kernel_txt, compact=not args.anytree), textgen=args.textgen, phash=args.phash )
+        profile.disable()
+
+    print('%-16s %8s %12s %12s' % ('stage','calls','total(ms)','per call(ms)'))
+    for stage, stage_stats in stats.Summary()['stages'].items():
+        print('%-16s %8d %12.3f %12.3f' % (stage, stage_stats['calls'], stage_stats['time']*1e3, stage_stats['time']*1e3/stage_stats['calls']))
+    print( ', '.join( '%s: %d' % item for item in stats.counts.items() ) )
+    print('hash list:', hash_v)
+    if args.output:
+        profile.dump_stats(args.output)
+    pstats.Stats(profile).strip_dirs().sort_stats(args.sort).print_stats(args.limit)
+    return 0 if hash_v != -1 else 1
+
+# --clones mode: the pairs of hash lists of a fingerprint store (from --batch --store) within a HammingDist64() threshold, found by FindClones()
+def ClonesMain(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='KernelPHash.py --clones', description='Print the pairs of kernels of a fingerprint store within a HammingDist64 threshold, one "id1 id2 distance" line per pair.')
+    parser.add_argument('store', help='fingerprint store file (see --batch --store)')
+    parser.add_argument('-t', '--threshold', type=float, default=8, help='maximum HammingDist64 of a pair (default: %(default)s)')
+    parser.add_argument('--bands', type=int, default=16, help='number of bands, more find more pairs (default: %(default)s)')
+    parser.add_argument('--band-bits', type=int, default=32, help='bits per band, more give fewer candidate pairs to compare (default: %(default)s)')
+    parser.add_argument('--max-bucket', type=int, default=64, help='buckets of more kernels are skipped, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--min-shared', type=int, default=1, help='number of buckets two kernels must share to be compared (default: %(default)s)')
+    parser.add_argument('--exhaustive', action='store_true', help='compare every two kernels (PairwiseDistanceMatrix) instead')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    store = FingerprintStore(args.store)
+    if args.exhaustive:
+        hm_matrix = PairwiseDistanceMatrix(store)
+        clones = sorted( ( (i, j, hm_matrix[i][j]) for i in range(len(store)) for j in range(i+1,len(store)) if hm_matrix[i][j] <= args.threshold ),
+                         key=lambda p: (p[2],p[0],p[1]) )
+    else:
+        clones = FindClones(store, args.threshold, args.bands, args.band_bits, args.max_bucket, args.min_shared)
+    out = open(args.output,'w') if args.output else sys.stdout
+    for i, j, hm_dist in clones:
+        out.write('%s %s %.4f\n' % (store.KernelId(i), store.KernelId(j), hm_dist))
+    if args.output:
+        out.close()
+    return 0
+
+# kernels of a file with several kernels, each one starts with a line '//@kernel name' (a comment, so the file is still C code).
+# return a list of (name, kernel text), a kernel without name is named by its index in the file. Text before the first '//@kernel' line
+# is a kernel too unless it is blank, so a file without those lines is one kernel.
+def SplitKernels(text):
+    parts = kernel_delimiter_re.split(text)
+    kernels = [ ('0', parts[0]) ] if parts[0].strip() else []
+    for name, kernel_txt in zip(parts[1::2], parts[2::2]):
+        kernels.append( (name or str(len(kernels)), kernel_txt) )
+    return kernels
+
+kernel_delimiter_re = re.compile(r'^[ \t]*//[ \t]*@kernel\b[ \t]*(.*?)[ \t]*(?:\r?\n|\Z)', re.M)
+
+# read the kernels of a file written by WriteKernels() (or by hand), see SplitKernels()
+def ReadKernels(file_name):
+    with open(file_name,'r') as f:
+        return SplitKernels( f.read() )
+
+# write kernels, a list of (name, kernel text), to one file that ReadKernels() splits again
+def WriteKernels(file_name, kernels):
+    with open(file_name,'w') as f:
+        for name, kernel_txt in kernels:
+            f.write( '//@kernel %s\n%s' % (name, kernel_txt) )
+            if not kernel_txt.endswith('\n'):
+                f.write('\n')
+
+batch_cache_dict = {} # (cache directory, size) -> FingerprintCache of this process
+
+# fingerprint one kernel of the batch, task is (index, file name, textgen, phash, (cache directory, size) or None, kernel name, kernel text,
+# read error, collect stats). The kernel text is read from the file if it is None. Errors are returned, not raised.
+# With collect stats, the PipelineStats.Summary() of the kernel is returned as 'stats'.
+def BatchTask(task):
+    with CollectStats() if task[-1] else contextlib.nullcontext() as stats:
+        result = BatchKernel(*task[:-1])
+    if stats:
+        result['stats'] = stats.Summary()
+    return result
+
+# error: the input could not be read (see MultiKernels), the result is this error
+def BatchKernel(index, file_name, textgen, phash, cache, name, kernel_txt, error=None):
+    result = {'index': index, 'file': file_name}
+    if name != None:
+        result['kernel'] = name
+    if error != None:
+        result['error'] = error
+        return result
+    try:
+        if kernel_txt == None:
+            with Stage('read'), open(file_name,'r') as f:
+                kernel_txt = f.read()
+        with contextlib.redirect_stdout(sys.stderr): # keep the output stream for the results only
+            if cache:
+                if not cache in batch_cache_dict:
+                    batch_cache_dict[cache] = FingerprintCache(*cache)
+                n_hit = batch_cache_dict[cache].hits
+                fingerprint = batch_cache_dict[cache].Fingerprint(kernel_txt, textgen, phash)
+                hash_v = fingerprint['hash'] if fingerprint else -1
+            else:
+                hash_v = PHashGen( ASTGen(kernel_txt, compact=True), textgen=textgen, phash=phash )
+        if hash_v == -1:
+            result['error'] = 'PHashGen failed'
+        else:
+            result['hash'] = hash_v
+            if cache:
+                result['cache'] = 'hit' if batch_cache_dict[cache].hits > n_hit else 'miss'
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+
+    return result
+
+# Service mode: a long-lived local fingerprint service, python KernelPHash.py --serve --socket /tmp/kph.sock (or --port N for localhost TCP).
+# Every request is one JSON line and gets one JSON line back with the same "id" (replies may be out of order when requests are pipelined):
+#   {"id": 1, "op": "fingerprint", "kernel": "...", "textgen": "preorder", "phash": "selfmade"} -> {"id": 1, "hash": [...]}
+#   {"id": 2, "op": "compare", "hash1": [...], "hash2": [...]} (or "kernel1", "kernel2") -> {"id": 2, "distance": 3.5}
+#   {"id": 3, "op": "metrics"} -> {"id": 3, "metrics": {...}} (see FingerprintService.Metrics)
+# A failed request gets {"id": n, "error": message}. ServiceClient is a blocking client.
+def ServeMain(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='KernelPHash.py --serve', description='Serve fingerprint and compare requests (JSON lines) on a Unix socket or localhost TCP.')
+    parser.add_argument('--socket', metavar='PATH', help='Unix socket path')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host when --socket is not given (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port when --socket is not given, 0 for any free port (default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--batch-window', type=float, default=2.0, help='time in ms a batch waits for more kernels after the first one (default: %(default)s)')
+    parser.add_argument('--max-batch', type=int, default=32, help='maximum number of kernels in a batch (default: %(default)s)')
+    parser.add_argument('--queue-size', type=int, default=1024, help='maximum number of kernels waiting for a batch, requests wait when it is full (default: %(default)s)')
+    parser.add_argument('--max-pending', type=int, default=256, help='maximum number of unanswered requests of one connection, it is not read further when reached (default: %(default)s)')
+    parser.add_argument('--cache', metavar='DIR', help='fingerprint cache directory (see FingerprintCache), no cache by default')
+    parser.add_argument('--cache-size', type=float, default=256, help='maximum cache size in MB (default: %(default)s)')
+    parser.add_argument('--metrics-interval', type=float, default=0, help='print the metrics to stderr every this many seconds, 0 for only at exit (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    cache = (args.cache, int(args.cache_size*1024*1024)) if args.cache else None
+    service = FingerprintService(args.workers, args.batch_window/1000, args.max_batch, args.queue_size, args.max_pending, cache)
+    asyncio.run( Serve(service, args.socket, args.host, args.port, args.metrics_interval) )
+    return 0
+
+# run service on a Unix socket (path) or TCP (host, port) until SIGINT or SIGTERM
+async def Serve(service, path=None, host='127.0.0.1', port=8765, metrics_interval=0):
+    import signal
+    loop = asyncio.get_running_loop()
+    await service.Start()
+    if path:
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(service.Client, path=path, limit=service_line_limit)
+        address = path
+    else:
+        server = await asyncio.start_server(service.Client, host, port, limit=service_line_limit)
+        address = '%s:%d' % server.sockets[0].getsockname()[:2]
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    print('serving on', address, 'with', service.workers, 'workers', file=sys.stderr, flush=True)
+
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), metrics_interval or None)
+        except asyncio.TimeoutError:
+            print(json.dumps(service.Metrics()), file=sys.stderr, flush=True)
+    server.close()
+    await server.wait_closed()
+    await service.Close()
+    if path and os.path.exists(path):
+        os.remove(path)
+    print(json.dumps(service.Metrics()), file=sys.stderr, flush=True)
+
+service_line_limit = 1<<24 # maximum length of a request line in bytes
+
+# Fingerprint requests are put in a bounded queue, and a batcher takes them in batches (up to max_batch kernels, waiting at most
+# batch_window seconds after the first one) that run in a process pool with BatchKernel(). At most 2*workers batches run or wait for
+# the pool, so when the pool is the bottleneck the queue fills up and the requests wait for room, which stops reading their connections.
+class FingerprintService:
+    def __init__(self, workers=1, batch_window=0.002, max_batch=32, queue_size=1024, max_pending=256, cache=None, n_latency=10000):
+        self.workers = max(1, workers)
+        self.batch_window = batch_window
+        self.max_batch = max(1, max_batch)
+        self.queue_size = queue_size
+        self.max_pending = max_pending
+        self.cache = cache
+        self.latency = collections.deque(maxlen=n_latency) # seconds, of the last n_latency requests
+        self.counts = collections.Counter()
+        self.max_queue_depth = 0
+        self.running_batches = 0
+        self.pool = None
+
+    # start the worker processes (each one fingerprints a kernel before the first request) and the batcher
+    async def Start(self):
+        import concurrent.futures
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.queue_size)
+        self.slots = asyncio.Semaphore(2*self.workers) # batches running or waiting for the pool
+        self.batch_tasks = set()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        await asyncio.gather( *[ loop.run_in_executor(self.pool, ServiceWarmup) for _ in range(self.workers) ] )
+        self.start_time = time.perf_counter()
+        self.batcher = asyncio.create_task( self.Batcher() )
+
+    async def Close(self):
+        self.batcher.cancel()
+        if self.batch_tasks:
+            await asyncio.gather(*self.batch_tasks, return_exceptions=True)
+        self.pool.shutdown()
+
+    # fingerprint one kernel in a batch, return a BatchKernel() result ('hash' or 'error')
+    async def Fingerprint(self, kernel_txt, textgen=TEXTGEN, phash=PHASH):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put( (kernel_txt, textgen, phash, future) )
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def Batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [ await self.queue.get() ]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append( await asyncio.wait_for(self.queue.get(), timeout) )
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append( self.queue.get_nowait() )
+            await self.slots.acquire()
+            self.running_batches += 1
+            task = asyncio.create_task( self.RunBatch(batch) )
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def RunBatch(self, batch):
+        try:
+            tasks = [ (kernel_txt, textgen, phash, self.cache) for kernel_txt, textgen, phash, _ in batch ]
+            results = await asyncio.get_running_loop().run_in_executor(self.pool, ServiceBatch, tasks)
+        except Exception as e: # e.g. a worker process was killed
+            results = [ {'error': '%s: %s' % (type(e).__name__, e)} ]*len(batch)
+        finally:
+            self.slots.release()
+            self.running_batches -= 1
+        self.counts['batches'] += 1
+        self.counts['batched_kernels'] += len(batch)
+        for (_, _, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    # the response to one request (a dictionary decoded from a JSON line)
+    async def Handle(self, request):
+        op = request.get('op', 'fingerprint')
+        if not op in ('fingerprint','compare','metrics'):
+            return {'error': 'unknown op %s' % op}
+        self.counts[op] += 1
+        textgen = request.get('textgen', TEXTGEN)
+        phash = request.get('phash', PHASH)
+        if not textgen in ('preorder','postorder','BFS') or not phash in ('selfmade','pHashlib'):
+            return {'error': 'unsupported textgen or phash'}
+
+        if op == 'fingerprint':
+            result = await self.Fingerprint(request['kernel'], textgen, phash)
+            return { key: result[key] for key in ('hash','error','cache') if key in result }
+        elif op == 'compare':
+            hash_lists = [ request.get('hash1'), request.get('hash2') ]
+            missing = [ i for i in (0,1) if hash_lists[i] == None ] # fingerprinted from 'kernel1' or 'kernel2'
+            kernels = [ request['kernel%d' % (i+1)] for i in missing ]
+            results = await asyncio.gather( *[ self.Fingerprint(kernel_txt, textgen, phash) for kernel_txt in kernels ] )
+            for i, result in zip(missing, results):
+                if 'error' in result:
+                    return {'error': result['error']}
+                hash_lists[i] = result['hash']
+            if phash == 'selfmade':
+                return {'distance': HammingDist64(*hash_lists)}
+            return {'distance': HammingDist(*hash_lists)}
+        return {'metrics': self.Metrics()}
+
+    # serve one connection: requests are read while fewer than max_pending of them are unanswered
+    async def Client(self, reader, writer):
+        pending = asyncio.Semaphore(self.max_pending)
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                await pending.acquire()
+                try:
+                    line = await reader.readline()
+                except ValueError: # longer than service_line_limit
+                    await self.Reply(writer, write_lock, {'error': 'request too long'})
+                    break
+                if not line:
+                    break
+                task = asyncio.create_task( self.Request(line, writer, write_lock, pending) )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def Request(self, line, writer, write_lock, pending):
+        start = time.perf_counter()
+        request = {}
+        try:
+            request = json.loads(line)
+            response = await self.Handle(request)
+        except Exception as e:
+            response = {'error': 'invalid request: %s: %s' % (type(e).__name__, e)}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        self.counts['requests'] += 1
+        self.counts['errors'] += 'error' in response
+        self.latency.append( time.perf_counter()-start )
+        try:
+            await self.Reply(writer, write_lock, response)
+        finally:
+            pending.release()
+
+    async def Reply(self, writer, write_lock, response):
+        async with write_lock:
+            writer.write( (json.dumps(response)+'\n').encode() )
+            await writer.drain()
+
+    # requests, errors, batches, queue depth and latency percentiles (ms, over the last n_latency requests)
+    def Metrics(self):
+        latency = sorted(self.latency)
+        uptime = time.perf_counter()-self.start_time
+        metrics = dict(self.counts, uptime=uptime, throughput=self.counts['requests']/uptime if uptime > 0 else 0.0,
+                       queue_depth=self.queue.qsize(), max_queue_depth=self.max_queue_depth, running_batches=self.running_batches,
+                       mean_batch_size=self.counts['batched_kernels']/self.counts['batches'] if self.counts['batches'] else 0.0)
+        for p in (50, 90, 99):
+            metrics['latency_p%d_ms' % p] = Percentile(latency, p)*1e3
+        metrics['latency_max_ms'] = latency[-1]*1e3 if latency else 0.0
+        return metrics
+
+# p-th percentile (nearest rank) of a sorted list, 0.0 if it is empty
+def Percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[ min( len(sorted_values)-1, max(0, math.ceil(p/100*len(sorted_values))-1) ) ]
+
+# run in the worker processes of FingerprintService: BatchKernel() for every (kernel text, textgen, phash, cache) of tasks,
+# so the kernels are parsed to the compact AST as in --batch (and ServiceWarmup() warms up the same path)
+def ServiceBatch(tasks):
+    return [ BatchKernel(i, None, textgen, phash, cache, None, kernel_txt) for i, (kernel_txt, textgen, phash, cache) in enumerate(tasks) ]
+
+# run once in every worker process before the first request, so that the first batch is not slower
+def ServiceWarmup():
+    PHashGen( ASTGen('for(i=0;i<n;i++){ y[i] = (a*x[i]) + y[i]; }', compact=True) )
+    return os.getpid()
+
+# blocking client of the service: address is a Unix socket path or a (host, port) tuple. Not thread-safe, use one client per thread.
+class ServiceClient:
+    def __init__(self, address, timeout=None):
+        import socket
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+        else:
+            self.sock = socket.create_connection(address, timeout)
+        self.file = self.sock.makefile('rwb')
+        self.next_id = 0
+
+    # send one request (a dictionary), return the response
+    def Request(self, request):
+        self.next_id += 1
+        self.file.write( (json.dumps( dict(request, id=self.next_id) )+'\n').encode() )
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('the service closed the connection')
+        return json.loads(line)
+
+    # hash list of a kernel as PHashGen(ASTGen(kernel_txt, compact=True), textgen, phash), -1 if it failed
+    def Fingerprint(self, kernel_txt, textgen=TEXTGEN, phash=PHASH):
+        response = self.Request( {'op': 'fingerprint', 'kernel': kernel_txt, 'textgen': textgen, 'phash': phash} )
+        return response.get('hash', -1)
+
+    # distance of two hash lists (HammingDist64 for 'selfmade', HammingDist for 'pHashlib')
+    def Compare(self, hash_list1, hash_list2, phash=PHASH):
+        response = self.Request( {'op': 'compare', 'hash1': hash_list1, 'hash2': hash_list2, 'phash': phash} )
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['distance']
+
+    def Metrics(self):
+        return self.Request( {'op': 'metrics'} )['metrics']
+
+    def Close(self):
+        self.file.close()
+        self.sock.close()
+
+# Opt-in instrumentation of the fingerprint pipeline: inside 'with CollectStats() as stats:', the stages run by this thread add their
+# wall time and number of calls to stats (a PipelineStats), and the pipeline adds its counts (tokens, nodes, hashes before and after
+# ReduceHashList, ...). callback(stage, seconds) is called after every timed stage. When no stats are collected, a stage only costs
+# a thread-local lookup.
+pipeline_stages = ['read','cache','strip_comments','tokenize','bracket_match','parse','anytree','textgen','unify_naming','padding','texthash64','reduce','phash_text']
+# stats_local.stats: the PipelineStats collected by this thread, None if not collecting (a class attribute, so that reading it is fast
+# in the threads that never set it)
+class StatsLocal(threading.local):
+    stats = None
+
+stats_local = StatsLocal()
+
+class PipelineStats:
+    def __init__(self, callback=None):
+        self.time = collections.Counter() # stage -> total seconds
+        self.calls = collections.Counter() # stage -> number of calls
+        self.counts = collections.Counter()
+        self.callback = callback
+
+    def AddTime(self, stage, seconds):
+        self.time[stage] += seconds
+        self.calls[stage] += 1
+        if self.callback != None:
+            self.callback(stage, seconds)
+
+    # dictionary for JSON: {'stages': {stage: {'calls': n, 'time': seconds}} in pipeline order, 'counts': {name: n}}
+    def Summary(self):
+        stages = [ stage for stage in pipeline_stages if stage in self.calls ] + sorted( set(self.calls)-set(pipeline_stages) )
+        return { 'stages': { stage: {'calls': self.calls[stage], 'time': self.time[stage]} for stage in stages }, 'counts': dict(self.counts) }
+
+    # add a Summary() (e.g. from another process)
+    def Merge(self, summary):
+        for stage, stage_stats in summary['stages'].items():
+            self.time[stage] += stage_stats['time']
+            self.calls[stage] += stage_stats['calls']
+        self.counts.update( summary['counts'] )
+
+# collect the PipelineStats of the code run in this thread inside the with statement (nested ones collect only into the innermost stats)
+@contextlib.contextmanager
+def CollectStats(stats=None, callback=None):
+    if stats == None:
+        stats = PipelineStats(callback)
+    previous = stats_local.stats
+    stats_local.stats = stats
+    try:
+        yield stats
+    finally:
+        stats_local.stats = previous
+
+# time a pipeline stage: with Stage('tokenize'): ... (only a shared do-nothing context manager when no stats are collected)
+def Stage(stage):
+    stats = stats_local.stats
+    return no_stage if stats == None else StageTimer(stats, stage)
+
+no_stage = contextlib.nullcontext()
+
+class StageTimer:
+    __slots__ = ('stats','stage','start')
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.stats.AddTime( self.stage, time.perf_counter()-self.start )
+
+# add n to the count name of the PipelineStats being collected, if any
+def CountStat(name, n=1):
+    stats = stats_local.stats
+    if stats != None:
+        stats.counts[name] += n
+
+keyword = ['for','if','else','while','return']
+# operator priority high to low ('{','}' are actually not operators, put them here just for convenience)
+operator = ['{','}','(',')','[',']','.','->','!','~','++','--','*','/','%','+','-','<<','>>','<','<=','>','>=','==','!=','&','^','|','&&','||','?',':','=','+=','-=','*=','/=','%=','>>=','<<=','&=','^=','|=']
+# operators with three letters (need to be processed first when splitting the text)
+operator_3c = list( filter(lambda p: len(p)==3, operator) )
+operator_2c = list( filter(lambda p: len(p)==2, operator) )
+operator_1c = list( filter(lambda p: len(p)==1, operator) )
+
+# every character that can be part of an operator. The text is scanned once into runs of operator characters, ';' and everything else.
+operator_chars = ''.join( sorted( set(''.join(operator)) ) )
+token_re = re.compile( r'[^\s;'+re.escape(operator_chars)+r']+|;|['+re.escape(operator_chars)+r']+' )
+operator_run_dict = {} # cache of OperatorSplit() results for runs of operator characters (e.g. ')+', '][')
+operator_run_size = 4096 # maximum number of runs in operator_run_dict, it is cleared when full
 
 # Generate abstract syntax tree (AST), text is a string of kernel source code
 # return a list of nodes in AST. The FIRST element is the root.
-def ASTGen(text):
-    global keyword, operator
-    keyword = ['for','if','else','while','return']
-    # operator priority high to low ('{','}' are actually not operators, put them here just for convenience)
-    operator = ['{','}','(',')','[',']','.','->','!','~','++','--','*','/','%','+','-','<<','>>','<','<=','>','>=','==','!=','&','^','|','&&','||','?',':','=','+=','-=','*=','/=','%=','>>=','<<=','&=','^=','|=']
-    # operators with three letters (need to be processed first when splitting the text)
-    operator_3c = list( filter(lambda p: len(p)==3, operator) )
-    operator_2c = list( filter(lambda p: len(p)==2, operator) )
-    operator_1c = list( filter(lambda p: len(p)==1, operator) )
-
-    text_real =  re.sub(r'\n[ \t\r\n]*\n','\n', re.sub(r'[ \t]*(//.*?[\r\n]+|//.*?$|/\*.*?\*/)','',text,flags=re.S) ) # remove comments, and multiple newlines
+# if compact is True, return a CompactAST instead, which all the functions taking a node list below also accept.
+def ASTGen(text, compact=False):
+    with Stage('strip_comments'):
+        text_real = StripComments(text)
 
     # split the text
-    text_s = re.split(r'\s+',text_real)
-    text_s = map( lambda p: re.split(r'(;)',p), text_s )
-    text_s = sum(text_s,[])
-    text_s = list(filter(lambda p: p!='', text_s) )
-    
-#    for keyw in keyword:
-#        new_text_s = []
-#        for item in text_s:
-#            new_text_s += re.split(r'(\b'+re.escape(keyw)+r'\b)',item)
-#        text_s = new_text_s
+    with Stage('tokenize'):
+        text_s = TextSplit(text_real)
+
+    text_len = len(text_s)
+    with Stage('bracket_match'):
+        bracket_match = BracketMatch(text_s)
+    with Stage('parse'):
+        ast = CompactAST()
+        root_node = ast.AddNode('Start', -1, 'Start')
+        i = 0
+        n_statement = 0
+        while i < text_len:
+            i = StatementRule(text_s, i, root_node, ast.AddNode, bracket_match)
+            n_statement += 1
+
+        if ast.first_child[0] != -1 and ast.next_sibling[ ast.first_child[0] ] == -1: # only one child
+            ast.DropRoot()
+    CountStat('kernels')
+    CountStat('tokens', text_len)
+    CountStat('top_level_statements', n_statement)
+    CountStat('nodes', len(ast))
+
+    if compact:
+        return ast
+    return ast.NodeList()
+
+# remove comments, and multiple newlines
+def StripComments(text):
+    return re.sub(r'\n[ \t\r\n]*\n','\n', re.sub(r'[ \t]*(//.*?[\r\n]+|//.*?$|/\*.*?\*/)','',text,flags=re.S) )
+
+# kinds of AST nodes in CompactAST
+node_kinds = ['Start','statement','operator','Var','Arr','Const']
+node_kind_dict = { kind: i for i, kind in enumerate(node_kinds) }
+
+# Compact AST: nodes are integers numbered in pre-order (the order of the node list returned by ASTGen()), node 0 is the root.
+# Each node has a kind (index of node_kinds), a label id (index of label_list), a parent, a first child and a next sibling (-1 if none), stored in arrays.
+# It is converted to anytree nodes only when needed: ast.NodeList() or ast[i] (e.g. DotExporter(ast[0]), RenderTree(ast[0])).
+# (anytree nodes have the name with {N} for DotExporter, and the label without {N} as node.label)
+class CompactAST:
+    __slots__ = ('kind','label_id','parent','first_child','next_sibling','last_child','label_list','label_dict','node_list')
+
+    def __init__(self):
+        self.kind = array.array('b')
+        self.label_id = array.array('i')
+        self.parent = array.array('i')
+        self.first_child = array.array('i')
+        self.next_sibling = array.array('i')
+        self.last_child = array.array('i') # to add children in O(1)
+        self.label_list = [] # label id -> label
+        self.label_dict = {} # label -> label id
+        self.node_list = None # anytree nodes, converted by NodeList()
+
+    def __len__(self):
+        return len(self.label_id)
+
+    def __getitem__(self, index):
+        return self.NodeList()[index]
+
+    # add a node as the last child of node parent (-1 for the root), nodes must be added in pre-order. kind is guessed from the label if not given.
+    # return the new node
+    def AddNode(self, label, parent, kind=None):
+        node = len(self.label_id)
+        if kind == None:
+            kind = LabelKind(label)
+        if not label in self.label_dict:
+            self.label_dict[label] = len(self.label_list)
+            self.label_list.append(label)
+        self.kind.append( node_kind_dict[kind] )
+        self.label_id.append( self.label_dict[label] )
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.last_child.append(-1)
+        if parent != -1:
+            if self.last_child[parent] == -1:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[ self.last_child[parent] ] = node
+            self.last_child[parent] = node
+
+        return node
+
+    # remove the root, its only child becomes the root
+    def DropRoot(self):
+        for name in ('kind','label_id','parent','first_child','next_sibling','last_child'):
+            old_array = getattr(self, name)
+            if name in ('kind','label_id'):
+                new_array = old_array[1:]
+            else:
+                new_array = array.array('i', [ p-1 if p != -1 else -1 for p in old_array[1:] ])
+            setattr(self, name, new_array)
+        self.parent[0] = -1
+        self.node_list = None
+
+    def Label(self, node):
+        return self.label_list[ self.label_id[node] ]
+
+    def Kind(self, node):
+        return node_kinds[ self.kind[node] ]
+
+    def Children(self, node):
+        children = []
+        child = self.first_child[node]
+        while child != -1:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+    # list of node labels in DFS pre-order ('pre') or post-order ('post')
+    def LabelDFS(self, order='pre'):
+        label_list = self.label_list
+        labels = [ label_list[i] for i in self.label_id ] # nodes are numbered in pre-order
+        if order=='pre':
+            return labels
+        elif order!='post':
+            return []
+
+        first_child = self.first_child
+        next_sibling = self.next_sibling
+        post_labels = []
+        stack = []
+        node = 0
+        while True:
+            while first_child[node] != -1: # go down to the first leaf
+                stack.append(node)
+                node = first_child[node]
+            post_labels.append( labels[node] )
+            while next_sibling[node] == -1: # the last child, its parent is finished
+                if not stack:
+                    return post_labels
+                node = stack.pop()
+                post_labels.append( labels[node] )
+            node = next_sibling[node]
+
+    # list of node labels in BFS order
+    def LabelBFS(self):
+        label_list = self.label_list
+        label_id = self.label_id
+        first_child = self.first_child
+        next_sibling = self.next_sibling
+        labels = []
+        queue_b = collections.deque( [0] )
+        while queue_b:
+            node = queue_b.popleft()
+            labels.append( label_list[ label_id[node] ] )
+            child = first_child[node]
+            while child != -1:
+                queue_b.append(child)
+                child = next_sibling[child]
+
+        return labels
+
+    # label ids of the nodes in DFS pre-order, DFS post-order and BFS order, in one walk: the BFS order is the nodes of every depth
+    # in pre-order, depth after depth
+    def LabelIdViews(self):
+        if not len(self):
+            return ([], [], [])
+        label_id = self.label_id
+        first_child = self.first_child
+        next_sibling = self.next_sibling
+        post_ids = []
+        levels = [] # label ids of the nodes of every depth
+        stack = []
+        node = 0
+        while True:
+            while True: # pre-order visit of node and its first descendants
+                if len(stack) == len(levels):
+                    levels.append([])
+                levels[ len(stack) ].append( label_id[node] )
+                if first_child[node] == -1:
+                    break
+                stack.append(node)
+                node = first_child[node]
+            post_ids.append( label_id[node] )
+            while next_sibling[node] == -1: # the last child, its parent is finished
+                if not stack:
+                    return ( list(label_id), post_ids, [ i for level in levels for i in level ] )
+                node = stack.pop()
+                post_ids.append( label_id[node] )
+            node = next_sibling[node]
+
+    # convert to a list of anytree nodes, the same as ASTGen(text, compact=False)
+    def NodeList(self):
+        if self.node_list == None:
+            from anytree import Node
+            with Stage('anytree'):
+                node_list = []
+                node_name_dict = {} # {N} of the node names count from 1 in every AST
+                for i, label in enumerate( map(self.Label, range(len(self))) ):
+                    node_list.append( Node( label if self.kind[i] == node_kind_dict['Start'] else NodeName(label, node_name_dict), label=label ) )
+                # attach the children from the last node, so that every parent is still a root and anytree checks no long path
+                for i in range(len(self)-1, -1, -1):
+                    children = self.Children(i)
+                    if children:
+                        node_list[i].children = [ node_list[c] for c in children ]
+                self.node_list = node_list
+
+        return self.node_list
+
+# kind of an AST node (one of node_kinds) with label created from a tree list
+def LabelKind(label):
+    if label.startswith('Var('):
+        return 'Var'
+    elif label.startswith('Arr('):
+        return 'Arr'
+    elif label.startswith('Const('):
+        return 'Const'
+    return 'operator'
+
+
+# split the kernel text into a list of tokens (names, constants, operators, ';') in a single scan.
+# Operators can only be made of operator_chars, so every run of those characters is split independently by OperatorSplit(),
+# which gives exactly the same tokens as splitting the whole text operator by operator.
+def TextSplit(text):
+    text_s = []
+    for item in token_re.findall(text):
+        if len(item)>1 and item[0] in operator_chars:
+            # the tokens are kept in a local, another thread may clear the cache at any time (this only costs another OperatorSplit())
+            tokens = operator_run_dict.get(item)
+            if tokens == None:
+                tokens = OperatorSplit([item])
+                if len(operator_run_dict) >= operator_run_size:
+                    operator_run_dict.clear()
+                operator_run_dict[item] = tokens
+            text_s += tokens
+        else:
+            text_s.append(item)
 
+    return text_s
+
+# split every item of text_s by the operators, three-letter operators first, then two-letter and one-letter operators (in the order of operator list)
+# return the list of splitted text, empty strings removed
+def OperatorSplit(text_s):
     for op in operator_3c:
         new_text_s = []
         for item in text_s:
@@ -109,333 +956,439 @@ def ASTGen(text):
                 new_text_s.append(item)
         text_s = new_text_s
 
-    text_s = list(filter(lambda p: p!='', text_s) )
-    # splitting finished
-
-    text_len = len(text_s)
-    i = 0
-    root_node = Node("Start")
-    node_list = [ root_node ]
-    while i < text_len:
-        node_l, j = SyntaxRule(text_s,i,root_node)
-        i = j
-        node_list += node_l
-
-    if len( node_list[0].children ) == 1:
-        node_list[1].parent = None
-        del node_list[0]
-
-    return node_list
-
+    return list(filter(lambda p: p!='', text_s) )
 
 # text_list is the list of text of splitted kernel, start_index is the index of text_list to start analyzing, parent_node is the parent node of the starting point.
 # return (node_list, j), node_list is the list of node of analyzed text, j is the next index of the end of this analysis.
-def SyntaxRule(text_list, start_index, parent_node):
-    # this 'for' rule ignores the iterator statements (in the round brackets)
-    if text_list[start_index] == 'for':
-        node_list = [ Node( NodeName('for'),parent=parent_node) ]
-        i = 2
-        l_count = 1
-        r_count = 0
-        while l_count != r_count:
-            if text_list[start_index+i] == '(':
-                l_count += 1
-            elif text_list[start_index+i] == ')':
-                r_count += 1
+# bracket_match is the output of BracketMatch(text_list), computed if not given.
+# node_name_dict counts the node names for NodeName(), give the same dictionary to every call that adds nodes to the same tree.
+def SyntaxRule(text_list, start_index, parent_node, bracket_match=None, node_name_dict=None):
+    from anytree import Node
+    if node_name_dict == None:
+        node_name_dict = {}
+    node_list = []
+    def AddNode(label, parent, kind):
+        node = Node( NodeName(label, node_name_dict), parent=parent, label=label )
+        node_list.append(node)
+        return node
+
+    j = StatementRule(text_list, start_index, parent_node, AddNode, bracket_match)
+    return (node_list, j)
+
+# analyze the statement starting at text_list[start_index] (the rules of SyntaxRule()), nodes are created by add_node(label, parent, kind) in pre-order and added under parent_node.
+# return j, the next index of the end of this analysis.
+# Nested statements are handled with an explicit stack of unfinished 'for', 'while', 'if', '{}' and 'return' statements instead of recursion, so the nesting depth is not limited.
+# Each stack item is [keyword, node, end]: end is the index of '}' for '{}', and whether the 'else' statement was analyzed for 'if'.
+def StatementRule(text_list, start_index, parent_node, add_node, bracket_match=None):
+    if bracket_match == None:
+        bracket_match = BracketMatch(text_list)
+    stack = []
+    i = start_index
+    while True:
+        parent = stack[-1][1] if stack else parent_node
+        # this 'for'/'while' rule ignores the iterator statements (in the round brackets)
+        if text_list[i] in ('for','while'):
+            node = add_node(text_list[i], parent, 'statement')
+            stack.append( [text_list[i], node, None] )
+            i = BracketEnd(text_list, i+1, '(', ')', bracket_match) + 1
+            continue
+
+        # standard 'if else' rule, three childs: the first is condition, the second is if statement, the third is else statement
+        elif text_list[i] == 'if':
+            node = add_node('if', parent, 'statement')
+            offset_cond = BracketEnd(text_list, i+1, '(', ')', bracket_match)
+            cond_st = text_list[i+2 : offset_cond]
+            AssignStatementRule(cond_st, node, add_node) # condition
+            stack.append( ['if', node, False] )
+            i = offset_cond + 1 # if statement
+            continue
+
+        # '{}' rule
+        elif text_list[i] == '{':
+            node = add_node('BLOCK', parent, 'statement')
+            stack.append( ['{', node, BracketEnd(text_list, i, '{', '}', bracket_match)] )
+            j = i + 1
+
+        # 'return' rule
+        elif text_list[i] == 'return':
+            node = add_node('return', parent, 'statement')
+            stack.append( ['return', node, None] )
             i += 1
-        
-        offset = i-1
-        node_l, j = SyntaxRule(text_list, start_index+offset+1, node_list[0])
-        node_list += node_l
-        return (node_list, j)
-
-    # this 'while' rule ignores the iterator statements (in the round brackets)
-    elif text_list[start_index] == 'while':
-        node_list = [ Node( NodeName('while'),parent=parent_node) ]
-        i = 2
-        l_count = 1
-        r_count = 0
-        while l_count != r_count:
-            if text_list[start_index+i] == '(':
-                l_count += 1
-            elif text_list[start_index+i] == ')':
-                r_count += 1
-            i += 1
-        
-        offset = i-1
-        node_l, j = SyntaxRule(text_list, start_index+offset+1, node_list[0])
-        node_list += node_l
-        return (node_list, j)
-
-    # standard 'if else' rule, three childs: the first is condition, the second is if statement, the third is else statement
-    elif text_list[start_index] == 'if':
-        node_list = [ Node( NodeName('if'),parent=parent_node) ]
-        i = 2
-        l_count = 1
-        r_count = 0
-        while l_count != r_count:
-            if text_list[start_index+i] == '(':
-                l_count += 1
-            elif text_list[start_index+i] == ')':
-                r_count += 1
-            i += 1
-        
-        offset_cond = i-1
-        cond_st = text_list[start_index+2 : start_index+offset_cond]
-        tree_l = AssignSyntaxRule(cond_st)
-        node_l = ConvertNodeList(tree_l, node_list[0]) # condition
-        node_list += node_l
-
-        node_l, j = SyntaxRule(text_list, start_index+offset_cond+1, node_list[0]) # if statement
-        node_list += node_l
-
-        if text_list[j] == 'else':
-            node_l, j = SyntaxRule(text_list, j+1, node_list[0]) # else statement
-            node_list += node_l
-
-        return (node_list, j)
-
-    # '{}' rule
-    elif text_list[start_index] == '{':
-        node_list = [ Node( NodeName('BLOCK'),parent=parent_node) ]
-        i = 1
-        l_count = 1
-        r_count = 0
-        while l_count != r_count:
-            if text_list[start_index+i] == '{':
-                l_count += 1
-            elif text_list[start_index+i] == '}':
-                r_count += 1
-            i += 1
-
-        offset_right_bracket = i-1
-        j = start_index + 1
-        # while in the curly brackets
-        while j < (start_index + offset_right_bracket):
-            node_l, j = SyntaxRule(text_list, j, node_list[0])
-            node_list += node_l
+            continue
 
-        return (node_list, start_index+offset_right_bracket+1)
+        # assignment rule
+        else:
+            j = i
+            while text_list[j] != ';':
+                j += 1
 
-    # 'return' rule
-    elif text_list[start_index] == 'return':
-        node_list = [ Node( NodeName('return'),parent=parent_node) ]
-        node_l, j = SyntaxRule(text_list, start_index+1, node_list[0])
-        node_list += node_l
+            assign_st = text_list[i : j]
+            AssignStatementRule(assign_st, parent, add_node)
+            j += 1
 
-        return (node_list, j)
-    
-    # assignment rule
-    else:
-        i = 0
-        while text_list[start_index+i] != ';':
-            i += 1
+        # a statement ends before j, finish the statements waiting for it
+        while stack:
+            key, node, end = stack[-1]
+            if key == 'if' and not end and text_list[j] == 'else':
+                stack[-1][2] = True
+                break
+            elif key == '{' and j < end: # while in the curly brackets
+                break
+            stack.pop()
+            if key == '{':
+                j = end + 1
+
+        if not stack:
+            return j
+        i = j+1 if key == 'if' else j # skip 'else'
+
+# given text_list[start_index] is the left bracket l_brack, return the index of the matching right bracket r_brack
+def BracketEnd(text_list, start_index, l_brack, r_brack, bracket_match=None):
+    if bracket_match and text_list[start_index] == l_brack and start_index in bracket_match:
+        return bracket_match[start_index]
+
+    i = start_index + 1
+    l_count = 1
+    r_count = 0
+    while l_count != r_count:
+        if text_list[i] == l_brack:
+            l_count += 1
+        elif text_list[i] == r_brack:
+            r_count += 1
+        i += 1
 
-        offset_semi_col = i
-        assign_st = text_list[start_index : start_index+offset_semi_col]
-        tree_list = AssignSyntaxRule(assign_st)
-        node_list = ConvertNodeList(tree_list, parent_node)
+    return i-1
+
+# match all the '(' and '{' in text_list in one pass, return a dictionary, key is the index of a left bracket, value is the index of its right bracket.
+# (every type of bracket is counted independently, as in BracketEnd())
+def BracketMatch(text_list):
+    bracket_match = {}
+    stack_dict = { '(': [], '{': [] }
+    for i, item in enumerate(text_list):
+        if item in stack_dict:
+            stack_dict[item].append(i)
+        elif item == ')' and stack_dict['(']:
+            bracket_match[ stack_dict['('].pop() ] = i
+        elif item == '}' and stack_dict['{']:
+            bracket_match[ stack_dict['{'].pop() ] = i
+
+    return bracket_match
+
+# add the nodes of an assignment statement (or condition) under parent_node with add_node(label, parent, kind), the same as
+# TreeListRule(AssignSyntaxRule(text_list), parent_node, add_node), with the statement template from the cache when possible
+def AssignStatementRule(text_list, parent_node, add_node):
+    shape = StatementShape(text_list) if statement_cache_size > 0 else None
+    template = StatementCacheGet(shape)
+    if template == None and shape != None:
+        # only the shape is parsed, and the statement is built from its new template
+        template = StatementTemplate(AssignSyntaxRule(list(shape), quiet=True))
+        if template != None:
+            StatementCachePut(shape, template)
+    if template == None: # no shape, or an error: statements with errors are not cached (their error messages need the real text)
+        TreeListRule(AssignSyntaxRule(text_list), parent_node, add_node)
+        return
 
-        return (node_list, start_index+offset_semi_col+1)
+    node_list = []
+    for prefix, index, kind, parent_i in template:
+        label = prefix if index < 0 else prefix+text_list[index]+')'
+        node_list.append( add_node(label, parent_node if parent_i < 0 else node_list[parent_i], kind) )
+
+# Cache of the parsed assignment statements. Unrolled kernels repeat the same statements with different names and numbers,
+# and AssignSyntaxRule() only depends on the operators and on which tokens are names or constants: the cache is keyed by the shape of
+# the statement, where they are replaced by placeholders numbered by position (names 'v<position>', constants '<position>').
+# A template is the nodes of the tree list of the shape in pre-order, (label prefix, position of the name/constant or -1, kind, parent in the template or -1),
+# the label of a node is prefix+text_list[position]+')' for names and constants ('Var(', 'Arr(', 'Const('), prefix otherwise.
+statement_cache = collections.OrderedDict() # shape -> template, least recently used first
+statement_cache_size = 4096 # maximum number of templates, 0 to disable the cache
+statement_cache_lock = threading.Lock()
+statement_cache_stats = collections.Counter() # 'hits', 'misses' (including the statements that can not be cached), 'evictions'
+operator_set = set(operator)
+
+# shape of an assignment statement (tuple), None if a token is not an operator, a name or a constant
+def StatementShape(text_list):
+    shape = []
+    for k, item in enumerate(text_list):
+        if item in operator_set:
+            shape.append(item)
+        elif name_re.match(item):
+            shape.append('v%d' % k)
+        elif item != '.' and const_re.match(item):
+            shape.append('%d' % k)
+        else:
+            return None
+    return tuple(shape)
+
+def StatementCacheGet(shape):
+    with statement_cache_lock:
+        template = statement_cache.get(shape) if shape != None else None
+        if template == None:
+            statement_cache_stats['misses'] += 1
+        else:
+            statement_cache_stats['hits'] += 1
+            statement_cache.move_to_end(shape)
+        return template
+
+def StatementCachePut(shape, template):
+    with statement_cache_lock:
+        statement_cache[shape] = template
+        while len(statement_cache) > statement_cache_size:
+            statement_cache.popitem(last=False)
+            statement_cache_stats['evictions'] += 1
+
+# statistics of the statement cache: hits, misses, evictions, size, maxsize
+def StatementCacheInfo():
+    with statement_cache_lock:
+        return { 'hits': statement_cache_stats['hits'], 'misses': statement_cache_stats['misses'], 'evictions': statement_cache_stats['evictions'],
+                 'size': len(statement_cache), 'maxsize': statement_cache_size }
+
+def StatementCacheClear():
+    with statement_cache_lock:
+        statement_cache.clear()
+        statement_cache_stats.clear()
+
+# template of the tree list of a statement shape (see statement_cache), None if the tree list has an error node (its label is 'Error' or not a string).
+# The tree list is walked once in pre-order, the same order as TreeListRule()
+def StatementTemplate(tree_list):
+    template = []
+    stack = [ (tree_list, -1) ]
+    while stack:
+        tree_l, parent = stack.pop()
+        if not isinstance(tree_l, list) or not tree_l or not isinstance(tree_l[0], str) or tree_l[0] == 'Error':
+            return None
+        label = tree_l[0]
+        if label.startswith(('Var(v','Arr(v')):
+            template.append( (label[:4], int(label[5:-1]), label[:3], parent) )
+        elif label.startswith('Const('):
+            template.append( (label[:6], int(label[6:-1]), 'Const', parent) )
+        else:
+            template.append( (label, -1, LabelKind(label), parent) )
+        node = len(template)-1
+        for child_list in reversed(tree_l[1:]):
+            stack.append( (child_list, node) )
+    return tuple(template)
+
+# operators of assignment statements, used by AssignSyntaxRule()
+compound_assign = ['+=','-=','*=','/=','%=','>>=','<<=','&=','^=','|=']
+# binary operators grouped by priority, lowest priority first. The right-most one outside brackets splits the statement (execution from left to right)
+binary_levels = [ ['||'], ['&&'], ['|'], ['^'], ['&'], ['==','!='], ['<','<=','>','>='], ['<<','>>'], ['+','-'], ['*','/','%'], ['!','~','++','--'], ['.','->'] ]
+binary_level_dict = { op: lvl for lvl, ops in enumerate(binary_levels) for op in ops }
+unary_level = binary_level_dict['!'] # '!','~','++','--' are split like binary operators, but one side must be empty
+member_level = binary_level_dict['.']
+name_re = re.compile(r'^[_a-zA-Z][_a-zA-Z0-9]*$')
+const_re = re.compile(r'^[\.0-9]*$')
 
 # syntax rule for assignment statements, similar to SyntaxRule(), but instead of returning a node list, it return a list show the tree structure that can be convert to a node_list
 # Arguments' difference are start index is 0 by default, text_list is only for one statement.
 # return value: tree format - [parent_name, [child1 name, [..],[..]], [child2 name,[..],[..]], [..], ..]
-def AssignSyntaxRule(text_list):
-    if text_list == []:
-        return None
-    # check form the operators with lowest priority to the operators with highest priority
-    if bool( {'+=','-=','*=','/=','%=','>>=','<<=','&=','^=','|='} & set(text_list) ):
-        for i,item in enumerate(text_list):
-            for sym in ['+','-','*','/','%','>>','<<','&','^','|']:
-                if item == (sym+'='):
-                    LS = AssignSyntaxRule(text_list[0:i])
-                    RS = AssignSyntaxRule(text_list[i+1:])
-                    return ['=',LS,[sym,LS,RS]]
-
-    if '=' in text_list:
-        i = text_list.index('=')
-        LS = AssignSyntaxRule(text_list[0:i])
-        RS = AssignSyntaxRule(text_list[i+1:])
-        return ['=',LS,RS]
-
-    if '?' in text_list and ':' in text_list:
-        for i,item in enumerate(text_list):
-            if item == '?':
-                quest_ind = i
-            if item == ':':
-                col_ind = i
-        LS = AssignSyntaxRule(text_list[0:quest_ind])
-        MS = AssignSyntaxRule(text_list[quest_ind+1:col_ind])
-        RS = AssignSyntaxRule(text_list[col_ind+1:])
-        return ['if',LS,MS,RS]
-
-    if '||' in text_list:
-        i = len(text_list)-1
-        while i >= 0:
-            # scan from right to left (execution from left to right), make sure not in brackets
-            if ( text_list[i] == '||' ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return ['||',LS,RS]
-            i -= 1
-
-    if '&&' in text_list:
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] == '&&' ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return ['&&',LS,RS]
-            i -= 1
-
-    if '|' in text_list:
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] == '|' ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return ['|',LS,RS]
-            i -= 1
-
-    if '^' in text_list:
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] == '^' ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return ['^',LS,RS]
-            i -= 1
-
-    if '&' in text_list:
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] == '&' ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return ['&',LS,RS]
-            i -= 1
-
-    if bool( {'==','!='} & set(text_list) ):
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] in ['==','!='] ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return [text_list[i],LS,RS]
-            i -= 1
-
-    if bool( {'<','<=','>','>='} & set(text_list) ):
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] in ['<','<=','>','>='] ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return [text_list[i],LS,RS]
-            i -= 1
-
-    if bool( {'<<','>>'} & set(text_list) ):
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] in ['<<','>>'] ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return [text_list[i],LS,RS]
-            i -= 1
-
-    if bool( {'+','-'} & set(text_list) ):
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] in ['+','-'] ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return [text_list[i],LS,RS]
-            i -= 1
-
-    if bool( {'*','/','%'} & set(text_list) ):
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] in ['*','/','%'] ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return [text_list[i],LS,RS]
-            i -= 1
-
-    if bool( {'!','~','++','--'} & set(text_list) ):
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] in ['!','~','++','--'] ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                if LS == None:
-                    return [text_list[i],RS]
-                elif RS == None:
-                    return [text_list[i],LS]
-                else:
+# The statement is indexed once: the bracket depth before every token, and the positions of every operator grouped by depth and priority level.
+# A sub-statement is then a range [lo,hi) of text_list, and finding its splitting operator is a binary search instead of a rescan.
+# quiet: no error message is printed (the tree list still has the error nodes)
+def AssignSyntaxRule(text_list, quiet=False):
+    text_len = len(text_list)
+    depth_list = [None]*(text_len+1) # depth_list[i] = (text_list[:i].count('(')-text_list[:i].count(')'), same for '[',']')
+    depth_pos = {} # depth -> {level: positions of the operators of that level}
+    compound_pos = [] # positions of compound assignments
+    assign_pos = []
+    quest_pos = []
+    col_pos = []
+    l_brack_pos = []
+    r_brack_pos = []
+    p_d = 0
+    b_d = 0
+    depth = (0,0)
+    for i, item in enumerate(text_list):
+        depth_list[i] = depth
+        if item in binary_level_dict:
+            depth_pos.setdefault( depth, {} ).setdefault( binary_level_dict[item], [] ).append(i)
+        elif item == '=':
+            assign_pos.append(i)
+        elif item in compound_assign:
+            compound_pos.append(i)
+        elif item == '?':
+            quest_pos.append(i)
+        elif item == ':':
+            col_pos.append(i)
+        elif item == '(':
+            p_d += 1
+            depth = (p_d,b_d)
+        elif item == ')':
+            p_d -= 1
+            depth = (p_d,b_d)
+        elif item == '[':
+            b_d += 1
+            depth = (p_d,b_d)
+            l_brack_pos.append(i)
+        elif item == ']':
+            b_d -= 1
+            depth = (p_d,b_d)
+            r_brack_pos.append(i)
+    depth_list[text_len] = depth
+    # levels sorted from the lowest priority, as (level, positions)
+    depth_pos = { d: sorted(lvl_dict.items()) for d, lvl_dict in depth_pos.items() }
+
+    bisect_left = bisect.bisect_left
+    # first / last element of the sorted list pos in [lo,hi), -1 if not found
+    def FirstPos(pos, lo, hi):
+        k = bisect_left(pos, lo)
+        if k < len(pos) and pos[k] < hi:
+            return pos[k]
+        return -1
+
+    def LastPos(pos, lo, hi):
+        k = bisect_left(pos, hi) - 1
+        if k >= 0 and pos[k] >= lo:
+            return pos[k]
+        return -1
+
+    # decide how the range [lo,hi) is analyzed, without analyzing the sub-statements.
+    # return (rule, i, ranges): i is the index of the operator (or the result itself for rule 'value'), ranges are the sub-statements to analyze
+    def Split(lo, hi):
+        if hi <= lo:
+            return ('value', None, ())
+        # a single name or number (checked first since most sub-statements are variables and constants)
+        if hi-lo == 1:
+            item = text_list[lo]
+            # Variable
+            if name_re.match(item):
+                return ('value', [ 'Var('+item+')' ], ())
+            # Constant ('.' alone is an operator)
+            if item != '.' and const_re.match(item):
+                return ('value', [ 'Const('+item+')' ], ())
+
+        # check form the operators with lowest priority to the operators with highest priority
+        if compound_pos:
+            i = FirstPos(compound_pos, lo, hi)
+            if i != -1:
+                return ('compound', i, ((lo,i),(i+1,hi)))
+
+        if assign_pos:
+            i = FirstPos(assign_pos, lo, hi)
+            if i != -1:
+                return ('=', i, ((lo,i),(i+1,hi)))
+
+        if quest_pos and col_pos:
+            quest_ind = LastPos(quest_pos, lo, hi)
+            col_ind = LastPos(col_pos, lo, hi)
+            if quest_ind != -1 and col_ind != -1:
+                return ('?', quest_ind, ((lo,quest_ind),(quest_ind+1,col_ind),(col_ind+1,hi)))
+
+        # operators outside brackets have the same depth as the beginning of the sub-statement
+        for lvl, pos in depth_pos.get( depth_list[lo], () ):
+            i = LastPos(pos, lo, hi)
+            if i != -1:
+                return (lvl, i, ((lo,i),(i+1,hi)))
+
+        if text_list[lo] == '[' and text_list[hi-1] == ']':
+            return ('[ ]', lo, ((lo+1,hi-1),))
+
+        if text_list[lo] == '(' and text_list[hi-1] == ')':
+            return ('( )', lo, ((lo+1,hi-1),))
+
+        # Array
+        if FirstPos(l_brack_pos, lo, hi) != -1 and FirstPos(r_brack_pos, lo, hi) != -1 and name_re.match(text_list[lo]):
+            ranges = []
+            l_count = 0
+            r_count = 0
+            for i in range(lo, hi):
+                item = text_list[i]
+                if item == '[':
+                    l_count += 1
+                    if l_count == 1:
+                        l_start = i
+                elif item == ']':
+                    r_count += 1
+                    if (l_count>0) and (r_count>0) and (l_count==r_count):
+                        r_end = i
+                        ranges.append( (l_start, r_end+1) )
+                        l_count = 0
+                        r_count = 0
+            return ('Arr', lo, ranges)
+
+        if not quiet:
+            print('Error: No assignment rule found:',text_list[lo:hi])
+        return ('value', ['Error'], ())
+
+    # build the tree list of range [lo,hi) from the tree lists of its sub-statements
+    def Build(rule, i, lo, hi, sub_trees):
+        if rule == 'value':
+            return i
+        elif rule == 'compound':
+            LS, RS = sub_trees
+            return ['=',LS,[text_list[i][:-1],LS,RS]]
+        elif rule == '=':
+            return ['=']+sub_trees
+        elif rule == '?':
+            return ['if']+sub_trees
+        elif rule == unary_level:
+            LS, RS = sub_trees
+            if LS == None:
+                return [text_list[i],RS]
+            elif RS == None:
+                return [text_list[i],LS]
+            else:
+                if not quiet:
                     print("Error when dealing with '!','~','++','--'")
-                    print('text:',text_list)
-                    return [-1]
-            i -= 1
-    
-    if bool( {'.','->'} & set(text_list) ):
-        i = len(text_list)-1
-        while i >= 0:
-            if ( text_list[i] in ['.','->'] ) and ( text_list[:i].count('(') == text_list[:i].count(')') ) and  ( text_list[:i].count('[') == text_list[:i].count(']') ):
-                LS = AssignSyntaxRule(text_list[0:i])
-                RS = AssignSyntaxRule(text_list[i+1:])
-                return [LS,text_list[i],RS]
-            i -= 1
-
-    if text_list[0] == '[' and text_list[-1] == ']':
-        MS = AssignSyntaxRule(text_list[1:-1])
-        return ['[ ]',MS]
-
-    if text_list[0] == '(' and text_list[-1] == ')':
-        MS = AssignSyntaxRule(text_list[1:-1])
-        return MS
-
-    # Array
-    if ('[' in text_list) and (']' in text_list) and re.match(r'^[_a-zA-Z][_a-zA-Z0-9]*$',text_list[0]):
-        tree_list = [ 'Arr('+text_list[0]+')' ]
-        l_count = 0
-        r_count = 0
-        for i, item in enumerate(text_list):
-            if item == '[':
-                l_count += 1
-                if l_count == 1:
-                    l_start = i
-            elif item == ']':
-                r_count += 1
-                if (l_count>0) and (r_count>0) and (l_count==r_count):
-                    r_end = i
-                    tree_list.append( AssignSyntaxRule(text_list[l_start:r_end+1]) )
-                    l_count = 0
-                    r_count = 0
-        return tree_list
-
-    # Variable
-    if ( len(text_list)==1 ) and re.match(r'^[_a-zA-Z][_a-zA-Z0-9]*$',text_list[0]):
-        return [ 'Var('+text_list[0]+')' ]
-
-    # Constant
-    if ( len(text_list)==1 ) and re.match(r'^[\.0-9]*$',text_list[0]):
-        return [ 'Const('+text_list[0]+')' ]
-
-    print('Error: No assignment rule found:',text_list)
-    return ['Error']
+                    print('text:',text_list[lo:hi])
+                return [-1]
+        elif rule == member_level:
+            return [sub_trees[0],text_list[i],sub_trees[1]]
+        elif rule == '[ ]':
+            return ['[ ]']+sub_trees
+        elif rule == '( )':
+            return sub_trees[0]
+        elif rule == 'Arr':
+            return [ 'Arr('+text_list[lo]+')' ]+sub_trees
+        else:
+            return [text_list[i]]+sub_trees
+
+    # analyze the sub-statements depth first with an explicit stack (no recursion, so the statement length and depth are not limited)
+    # each stack item is [rule, i, lo, hi, ranges, sub_trees], the first item is a dummy one with the whole statement as its only sub-statement
+    stack = [ [None, None, 0, text_len, ((0,text_len),), []] ]
+    while True:
+        frame = stack[-1]
+        sub_trees = frame[5]
+        if len(sub_trees) < len(frame[4]):
+            lo, hi = frame[4][len(sub_trees)]
+            rule, i, ranges = Split(lo, hi)
+            if ranges:
+                stack.append( [rule, i, lo, hi, ranges, []] )
+            else:
+                sub_trees.append( Build(rule, i, lo, hi, []) )
+            continue
+
+        stack.pop()
+        if not stack:
+            return sub_trees[0]
+        stack[-1][5].append( Build(frame[0], frame[1], frame[2], frame[3], sub_trees) )
 
-# convert tree lists (outputs by AssignSyntaxRule()) to node list (the format of the output of SyntaxRule())
-def ConvertNodeList(tree_list, parent_node):
-    node_list = [ Node( NodeName(tree_list[0]), parent=parent_node) ]
-    for child_list in tree_list[1:]:
-        node_l = ConvertNodeList(child_list, node_list[0])
-        node_list += node_l
 
+# convert tree lists (outputs by AssignSyntaxRule()) to node list (the format of the output of SyntaxRule())
+# node_name_dict is the same as in SyntaxRule()
+def ConvertNodeList(tree_list, parent_node, node_name_dict=None):
+    from anytree import Node
+    if node_name_dict == None:
+        node_name_dict = {}
+    node_list = []
+    def AddNode(label, parent, kind):
+        node = Node( NodeName(label, node_name_dict), parent=parent, label=label )
+        node_list.append(node)
+        return node
+
+    TreeListRule(tree_list, parent_node, AddNode)
     return node_list
 
+# add the nodes of a tree list under parent_node with add_node(label, parent, kind), in pre-order, with an explicit stack instead of recursion
+def TreeListRule(tree_list, parent_node, add_node):
+    stack = [ (tree_list, parent_node) ]
+    while stack:
+        tree_l, parent = stack.pop()
+        node = add_node(tree_l[0], parent, LabelKind(tree_l[0]))
+        for child_list in reversed(tree_l[1:]):
+            stack.append( (child_list, node) )
+
 # To prevent same name of different nodes (e.g. many name are '+'), add {N} at the end (e.g. instead of '+', use '+{1}'). Set prevent = 1 to enable the function.
-def NodeName(name, prevent = prevent_overlapped_name):
-    global node_name_dict
+# node_name_dict is the count of every name in the AST being built (N of the last node with that name), so the names do not depend on other ASTs.
+def NodeName(name, node_name_dict, prevent = prevent_overlapped_name):
     if prevent:
         if not name in node_name_dict:
             node_name_dict[name] = 1
@@ -449,132 +1402,196 @@ def NodeName(name, prevent = prevent_overlapped_name):
 # The piece of code (kernel) can be viewed as a single module, which has inputs and outputs. To determine those IOs this function use DFS to find them. To make things easier, every var/arr appeared on the left of '=' are output, and every var/arr appeared on the right of '=' are inputs.
 # return value is [dict_array, dict_variable], where dict_array = {'inputs': [arr1,arr2...],'outputs': [arr3,arr4...]}. Similar for dict_variable.
 def FindIO(node_list):
-    def DFTrav(node,flg):
-        if re.match(r'Var\(.+\)\{[\d]+\}',node.name):
-            var_name = re.findall(r'\(.+\)',node.name)[0][1:-1]
+    root, Children, Label = ASTAccess(node_list)
+    arr_inputs = set()
+    arr_outputs = set()
+    var_inputs = set()
+    var_outputs = set()
+    # DFS with an explicit stack, flg is 'left' or 'right' of the '=' the node is under
+    stack = [ (root,None) ]
+    while stack:
+        node, flg = stack.pop()
+        label = Label(node)
+        if label.startswith('Var('):
+            var_name = label[4:-1]
             if flg=='left':
                 var_outputs.add(var_name)
             elif flg=='right':
                 var_inputs.add(var_name)
-                
-        elif re.match(r'Arr\(.+\)\{[\d]+\}',node.name):
-            arr_name = re.findall(r'\(.+\)',node.name)[0][1:-1]
+
+        elif label.startswith('Arr('):
+            arr_name = label[4:-1]
             if flg=='left':
                 arr_outputs.add(arr_name)
             elif flg=='right':
                 arr_inputs.add(arr_name)
 
-        if re.match(r'=\{[\d]+\}',node.name):
-            DFTrav(node.children[0],'left')
-            DFTrav(node.children[1],'right')
+        children = Children(node)
+        if label == '=':
+            stack.append( (children[1],'right') )
+            stack.append( (children[0],'left') )
         else:
-            for child_node in node.children:
-                DFTrav(child_node,flg)
-                
-        return
+            for child_node in reversed(children):
+                stack.append( (child_node,flg) )
 
-    arr_inputs = set()
-    arr_outputs = set()
-    var_inputs = set()
-    var_outputs = set()
-    DFTrav(node_list[0],None)
     return [{'inputs':list(arr_inputs), 'outputs': list(arr_outputs)},{'inputs':list(var_inputs), 'outputs': list(var_outputs)}]
 
-# To generate a string from the AST, this function use depth first traversal, order can be 'pre'(preorder) or 'post'(postorder) 
-def TextGenDFS(node_list,order='pre'):
-    def DFTrav(node,order='pre'):
-        nonlocal text
-        if order=='pre':
-            text += ( ' '+re.sub(r'\{[\d]+\}','',node.name) )
+# return (root, Children, Label) to walk an AST given as a node list (or a CompactAST): Children(node) is the list of children of node, Label(node) is its name without {N}
+def ASTAccess(node_list):
+    if isinstance(node_list, CompactAST):
+        return (0, node_list.Children, node_list.Label)
+    return (node_list[0], lambda node: node.children, NodeLabel)
 
-        for child_node in node.children:
-            DFTrav(child_node,order=order)
+# name of an anytree node without {N}
+def NodeLabel(node):
+    try:
+        return node.label
+    except AttributeError: # node not created by this program
+        return re.sub(r'\{[\d]+\}','',node.name)
 
-        if order=='post':
-            text += ( ' '+re.sub(r'\{[\d]+\}','',node.name) )
-
-        return
-
-    text = ''
-    DFTrav(node_list[0], order=order)
-    return text[1:]
+# To generate a string from the AST, this function use depth first traversal, order can be 'pre'(preorder) or 'post'(postorder) 
+def TextGenDFS(node_list,order='pre'):
+    with Stage('textgen'):
+        return ' '.join( LabelGenDFS(node_list,order=order) )
 
 # To generate a string from the AST, this function use breadth first traversal
 def TextGenBFS(node_list):
-    text = ''
-    queue_b = [ node_list[0] ]
-
-    while bool( queue_b ): # while queue not empty
-        text += ( ' '+re.sub(r'\{[\d]+\}','',queue_b[0].name) )
-        for child_node in queue_b[0].children:
-            queue_b.append(child_node)
-        del queue_b[0]
+    with Stage('textgen'):
+        return ' '.join( LabelGenBFS(node_list) )
+
+# list of node labels in depth first traversal, order can be 'pre'(preorder) or 'post'(postorder). TextGenDFS() is the labels joined by spaces.
+def LabelGenDFS(node_list,order='pre'):
+    if isinstance(node_list, CompactAST):
+        return node_list.LabelDFS(order)
+
+    root, Children, Label = ASTAccess(node_list)
+    labels = []
+    # DFS with an explicit stack, a node is pushed again with visited=True to output it after its children in post-order
+    stack = [ (root,False) ]
+    while stack:
+        node, visited = stack.pop()
+        if visited:
+            labels.append( Label(node) )
+            continue
 
-    return text[1:]
+        if order=='pre':
+            labels.append( Label(node) )
+        elif order=='post':
+            stack.append( (node,True) )
+
+        for child_node in reversed(Children(node)):
+            stack.append( (child_node,False) )
+
+    return labels
+
+# list of node labels in breadth first traversal. TextGenBFS() is the labels joined by spaces.
+def LabelGenBFS(node_list):
+    if isinstance(node_list, CompactAST):
+        return node_list.LabelBFS()
+
+    root, Children, Label = ASTAccess(node_list)
+    labels = []
+    queue_b = collections.deque( [root] )
+
+    while queue_b: # while queue not empty
+        node = queue_b.popleft()
+        labels.append( Label(node) )
+        queue_b.extend( Children(node) )
+
+    return labels
+
+# labels of the nodes in the orders of the textgen values 'preorder', 'postorder' and 'BFS', from one walk of the AST.
+# return (label_list, {textgen: label ids}), the labels are label_list[i] for the ids i
+def LabelViews(node_list):
+    if isinstance(node_list, CompactAST):
+        pre_ids, post_ids, bfs_ids = node_list.LabelIdViews()
+        return ( node_list.label_list, {'preorder': pre_ids, 'postorder': post_ids, 'BFS': bfs_ids} )
+
+    root, Children, Label = ASTAccess(node_list)
+    label_dict = {}
+    pre_ids, post_ids, levels = [], [], []
+    # DFS with an explicit stack as LabelGenDFS(), with the depth of every node for the BFS order
+    # (a node is pushed again with its label id to output it after its children in post-order)
+    stack = [ (root,0,None) ]
+    while stack:
+        node, depth, i = stack.pop()
+        if i is not None:
+            post_ids.append(i)
+            continue
+        i = label_dict.setdefault( Label(node), len(label_dict) )
+        pre_ids.append(i)
+        if depth == len(levels):
+            levels.append([])
+        levels[depth].append(i)
+        stack.append( (node,depth,i) )
+        for child_node in reversed(Children(node)):
+            stack.append( (child_node,depth+1,None) )
+
+    return ( list(label_dict), {'preorder': pre_ids, 'postorder': post_ids, 'BFS': [ i for level in levels for i in level ]} )
 
 # to eliminate the impact of different name of variables and arrays, rename them in the text generated from AST.
 def UnifyNaming(text):
-    var_l = re.findall(r'Var\(.+?\)',text)
-    arr_l = re.findall(r'Arr\(.+?\)',text)
-
-    # remove duplicated elements while maintaining the order
-    var_list = []
-    for var in var_l:
-        if not var in var_list:
-            var_list.append(var)
-
-    arr_list = []
-    for arr in arr_l:
-        if not arr in arr_list:
-            arr_list.append(arr)
-
-    # change the name
-    new_text = text
-    for i, var in enumerate(var_list):
-        new_name = str(i)*3
-        new_text = new_text.replace(var,'Var('+new_name+')')
-    
-    for i, arr in enumerate(arr_list):
-        new_name = str(i)*3
-        new_text = new_text.replace(arr,'Arr('+new_name+')')
-
-    return new_text
+    # new index of each name in the order of first appearance, variables and arrays are counted separately
+    new_index = { 'Var': {}, 'Arr': {} }
+    def Rename(match):
+        kind, name = match.groups()
+        index = new_index[kind].setdefault(name, len(new_index[kind]))
+        return kind+'('+str(index)*3+')'
+
+    # one pass over the text, so a new name is never renamed again
+    with Stage('unify_naming'):
+        return name_label_re.sub(Rename, text)
+
+# UnifyNaming() of the texts of several label id sequences over label_list (see LabelViews), without joining and searching every text:
+# the names in every label are found once for all the sequences, and every sequence renames each of its labels once (names are still
+# numbered in the order of first appearance in every sequence)
+def UnifyNamingViews(label_list, id_lists):
+    with Stage('unify_naming'):
+        has_name = [ name_label_re.search(label) != None for label in label_list ]
+        texts = []
+        for ids in id_lists:
+            new_index = { 'Var': {}, 'Arr': {} }
+            def Rename(match):
+                kind, name = match.groups()
+                index = new_index[kind].setdefault(name, len(new_index[kind]))
+                return kind+'('+str(index)*3+')'
+            renamed = list(label_list)
+            done = [ not name for name in has_name ] # labels without names are not renamed
+            for i in ids:
+                if not done[i]:
+                    renamed[i] = name_label_re.sub(Rename, label_list[i])
+                    done[i] = True
+            texts.append( ' '.join( [ renamed[i] for i in ids ] ) )
+        return texts
+
+name_label_re = re.compile(r'(Var|Arr)\((.+?)\)')
 
 # given a AST tree (node_list), return a dictionary of variables, key is variable name, value is frequency.
 def VarList(node_list):
-    text = TextGenBFS(node_list)
-    var_l = re.findall(r'Var\(.+?\)',text)
-    var_lm = map(lambda p: p[4:-1], var_l)
-    
-    var_dict = {}
-    for var in var_lm:
-        if not var in var_dict:
-            var_dict[var] = 1
-        else:
-            var_dict[var] += 1
-            
-    return var_dict
-    
+    return NameCount(node_list, 'Var(')
+
 # similar to VarList(), this one target arrays
 def ArrList(node_list):
-    text = TextGenBFS(node_list)
-    arr_l = re.findall(r'Arr\(.+?\)',text)
-    arr_lm = map(lambda p: p[4:-1], arr_l)
-    
-    arr_dict = {}
-    for arr in arr_lm:
-        if not arr in arr_dict:
-            arr_dict[arr] = 1
-        else:
-            arr_dict[arr] += 1
-            
-    return arr_dict
+    return NameCount(node_list, 'Arr(')
+
+# count the names of the nodes with labels prefix+name+')' (in the order of BFS)
+def NameCount(node_list, prefix):
+    name_count = collections.Counter( label[len(prefix):-1] for label in LabelGenBFS(node_list) if label.startswith(prefix) )
+    return dict(name_count)
 
 # Generate Perceptual hash from the AST, node_list is a list of nodes in AST
 # textgen is the way to generate text form AST, can be 'preorder', 'postorder','BFS'
 # phash is the perceptual hash algorithm, 'selfmade' is using TextHash64 function, 'pHashlib' is using pHash C++ library
 # returns a list of 32-bit hex hash(string)
 def PHashGen(node_list, textgen=TEXTGEN, phash=PHASH):
+    text_ast = UnifiedText(node_list, textgen)
+    if text_ast == None:
+        return -1
+
+    return TextPHash(text_ast, phash)
+
+# the text PHashGen() hashes: the traversal of the AST by textgen, with variable/array names changed. None if textgen is not supported
+def UnifiedText(node_list, textgen=TEXTGEN):
     if textgen == 'preorder':
         text_ast = TextGenDFS(node_list,order='pre')
     elif textgen == 'postorder':
@@ -583,39 +1600,348 @@ def PHashGen(node_list, textgen=TEXTGEN, phash=PHASH):
         text_ast = TextGenBFS(node_list)
     else:
         print('Error: textgen=',textgen,'not supported')
-        return -1
-
-    text_ast = UnifyNaming(text_ast) # change variable/array names
+        return None
 
-    i = 1
+    return UnifyNaming(text_ast) # change variable/array names
+
+# multi-view fingerprint: {textgen: PHashGen(node_list, textgen, phash)} for every textgen of textgens, with one walk of the AST for
+# all the views (LabelViews) and the names of every label found once (UnifyNamingViews)
+def PHashGenViews(node_list, phash=PHASH, textgens=('preorder','postorder','BFS')):
+    text_dict = UnifiedTexts(node_list, textgens)
+    return { textgen: -1 if text_ast == None else TextPHash(text_ast, phash) for textgen, text_ast in text_dict.items() }
+
+# {textgen: UnifiedText(node_list, textgen)} for every textgen of textgens
+def UnifiedTexts(node_list, textgens=('preorder','postorder','BFS')):
+    with Stage('textgen'):
+        label_list, id_dict = LabelViews(node_list)
+    for textgen in textgens:
+        if not textgen in id_dict:
+            print('Error: textgen=',textgen,'not supported')
+    supported = [ textgen for textgen in textgens if textgen in id_dict ]
+    text_dict = dict( zip( supported, UnifyNamingViews(label_list, [ id_dict[textgen] for textgen in supported ]) ) )
+    return { textgen: text_dict.get(textgen) for textgen in textgens }
+
+# hash list of a text from UnifiedText(), by phash (see PHashGen)
+def TextPHash(text_ast, phash=PHASH):
     if phash=='selfmade':
         limit_low = 80
     elif phash=='pHashlib':
         limit_low = 500
-        
-    while len(text_ast) < limit_low: # avoid the text is too short
-        text_ast += text_ast
-        i += 1
-        
-    text_ast += ('101'*i + ' 5656 '*(i>4 and i<8) + '7878'*(i>8 and i<16) + '9090'*(i>16))
-    
+
+    n_doubling = PaddingDoublings(len(text_ast), limit_low) # avoid the text is too short
+    CountStat('doublings', n_doubling)
+    CountStat('text_chars', len(text_ast)*(1<<n_doubling) + len( PaddingSuffix(n_doubling) ))
+    if phash=='selfmade' and np is not None:
+        # the copies of the text are not made, see PaddedWindows()
+        with Stage('padding'):
+            windows = PaddedWindows(text_ast, n_doubling)
+        with Stage('texthash64'):
+            hash_list = WindowHashes(windows, 8)
+        return ReduceTextHashes(hash_list)
+
+    with Stage('padding'):
+        text_ast = PaddedText(text_ast, n_doubling)
+
     if phash=='selfmade':
         hash_v = TextHash64(text_ast)
 
     elif phash=='pHashlib':
-        with open('pHash/text_ast','w') as f:
-            f.write(text_ast)
-            
-        ret_v = os.system('export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:$(pwd)/pHash/src && cd pHash && ./text_hash.exe text_ast')
-        if ret_v != 0:
-            print('Error occur in text_hash.exe')
+        with Stage('phash_text'):
+            hash_v = PHashText(text_ast)
+        if not hash_v:
+            print('Error: text is too short for the pHash text hash')
             return -1
 
-        with open('pHash/hash','r') as f:
-            hash_v = f.read().splitlines()
-
     return hash_v
 
+# number of times TextPHash() doubles a text of n_char characters to have at least limit_low characters
+def PaddingDoublings(n_char, limit_low):
+    n_doubling = 0
+    while 0 < n_char<<n_doubling < limit_low:
+        n_doubling += 1
+    return n_doubling
+
+# the text TextPHash() appends after n_doubling doublings
+def PaddingSuffix(n_doubling):
+    i = n_doubling+1
+    return '101'*i + ' 5656 '*(i>4 and i<8) + '7878'*(i>8 and i<16) + '9090'*(i>16)
+
+# the text hashed by TextPHash(): text_ast doubled n_doubling times, then PaddingSuffix()
+def PaddedText(text_ast, n_doubling):
+    return text_ast*(1<<n_doubling) + PaddingSuffix(n_doubling)
+
+# the windows of PaddedText(text_ast, n_doubling) (see TextWindows), without aligning every copy of text_ast: words are aligned
+# independently and the copies are joined without space, so the aligned text is the words of text_ast but the last, then
+# (last word + first word) and the other words but the first and the last, aligned once and repeated for every copy after the first,
+# then (last word + suffix)
+def PaddedWindows(text_ast, n_doubling, win_len=8):
+    words = text_ast.split(' ')
+    if len(words) == 1 or n_doubling == 0:
+        return TextWindows( PaddedText(text_ast, n_doubling), win_len )
+    period = TextAlign( words[-1]+words[0]+' '+' '.join(words[1:-1]), win_len )
+    aligned = TextAlign( ' '.join(words[:-1]), win_len ) + period*((1<<n_doubling)-1) + TextAlign( words[-1]+PaddingSuffix(n_doubling), win_len )
+    return np.frombuffer( aligned.encode('utf-32-le'), dtype=np.uint32 ).reshape(-1, win_len)
+
+# Incremental PHashGen() for the versions of a kernel being edited: Update(text) returns PHashGen(ASTGen(text), textgen, phash).
+# The tokens, the AST of every top-level statement (as its labels in the textgen order) and the windows and paragraph hashes of the
+# text hashed by TextHash64 are kept. Only the top-level statements touched by the changed tokens are parsed again (a statement is
+# parsed from its first token, so the statements after the change are reused as soon as the parsing reaches one of their starts),
+# and only the paragraphs over changed windows are hashed again. Comments are stripped, the text is split and the names are unified
+# in the whole text every time. n_parsed is the number of top-level statements parsed by the last Update().
+class IncrementalPHash:
+    def __init__(self, textgen=TEXTGEN, phash=PHASH):
+        self.textgen = textgen
+        self.phash = phash
+        self.tokens = []
+        self.starts = [] # first token of every top-level statement
+        self.ends = [] # the token after every top-level statement (the start of the next one)
+        self.pieces = [] # labels of the nodes of every top-level statement joined by spaces (a string per level for 'BFS')
+        self.n_children = [] # number of nodes every top-level statement adds under the root
+        self.text = None # the text hashed by TextHash64 (numpy and 'selfmade' only)
+        self.windows = None # TextWindows() and WordWindows() of the text
+        self.word_windows = None
+        self.prefix_hashes = None # TextHash64_real('dummy '*i+text) of the hashed text for every i
+        self.hash_list = None
+        self.n_parsed = 0
+
+    def Update(self, text):
+        if not self.textgen in ('preorder','postorder','BFS'):
+            return PHashGen(None, self.textgen, self.phash)
+        with Stage('tokenize'):
+            tokens = TextSplit( StripComments(text) )
+        if self.hash_list != None and tokens == self.tokens:
+            self.n_parsed = 0
+            return self.HashList()
+
+        # the tokens before p and after len-s are unchanged
+        old = self.tokens
+        n_old, n_new = len(old), len(tokens)
+        p = CommonPrefixLength(old, tokens)
+        s = CommonPrefixLength(old[:p-1:-1], tokens[:p-1:-1]) if p > 0 else CommonPrefixLength(old[::-1], tokens[::-1])
+        delta = n_new - n_old
+
+        # a statement is kept if it ends before p (its tokens and the next one, checked for 'else', are unchanged).
+        # The statements from the first one starting after n_old-s are parsed the same from their new starts.
+        k0 = bisect.bisect_left(self.ends, p)
+        k1 = max( k0, bisect.bisect_left(self.starts, n_old-s) )
+        i = self.ends[k0-1] if k0 > 0 else 0
+        hi = min( n_new, max(n_new-s, self.ends[k1-1]+delta if k1 > k0 else 0) + 1 )
+        bracket_match = { l+i: r+i for l, r in BracketMatch(tokens[i:hi]).items() } # a bracket not matched in it is found by BracketEnd()
+        starts, ends, pieces, n_children = [], [], [], []
+        k = k1
+        with Stage('parse'):
+            while i < n_new:
+                while k < len(self.starts) and self.starts[k]+delta < i:
+                    k += 1
+                if k < len(self.starts) and self.starts[k]+delta == i:
+                    break
+                piece, n_child, j = self.ParseStatement(tokens, i, bracket_match)
+                starts.append(i)
+                ends.append(j)
+                pieces.append(piece)
+                n_children.append(n_child)
+                i = j
+        self.n_parsed = len(starts)
+        if i >= n_new:
+            k = len(self.starts)
+
+        self.starts = self.starts[:k0] + starts + [ st+delta for st in self.starts[k:] ]
+        self.ends = self.ends[:k0] + ends + [ end+delta for end in self.ends[k:] ]
+        self.pieces = self.pieces[:k0] + pieces + self.pieces[k:]
+        self.n_children = self.n_children[:k0] + n_children + self.n_children[k:]
+        self.tokens = tokens
+
+        with Stage('textgen'):
+            text_ast = self.Text()
+        self.hash_list = self.TextHash( UnifyNaming(text_ast) )
+        return self.HashList()
+
+    # a copy of the hash list of the last Update() (-1 if it could not be generated)
+    def HashList(self):
+        return self.hash_list if self.hash_list == -1 else list(self.hash_list)
+
+    # parse the top-level statement starting at tokens[i], return (piece, n_child, j) (see __init__), j is the start of the next one
+    def ParseStatement(self, tokens, i, bracket_match):
+        ast = CompactAST()
+        root = ast.AddNode('Start', -1, 'Start')
+        j = StatementRule(tokens, i, root, ast.AddNode, bracket_match)
+        n_child = len( ast.Children(root) )
+        if self.textgen == 'BFS':
+            # nodes of every level in the BFS order, which is their pre-order
+            depth = [0]*len(ast)
+            levels = []
+            for node in range(1, len(ast)):
+                depth[node] = depth[ ast.parent[node] ] + 1
+                if depth[node] > len(levels):
+                    levels.append([])
+                levels[ depth[node]-1 ].append( ast.Label(node) )
+            return ([ ' '.join(level) for level in levels ], n_child, j)
+
+        labels = ast.LabelDFS('pre')[1:] if self.textgen == 'preorder' else ast.LabelDFS('post')[:-1]
+        return (' '.join(labels), n_child, j)
+
+    # the traversal of the AST (TextGenDFS or TextGenBFS), from the pieces of the top-level statements.
+    # The root 'Start' is dropped by ASTGen() when it has only one child.
+    def Text(self):
+        start = [] if sum(self.n_children) == 1 else ['Start']
+        if self.textgen == 'BFS':
+            n_level = max( map(len, self.pieces), default=0 )
+            levels = [ ' '.join( piece[d] for piece in self.pieces if len(piece) > d ) for d in range(n_level) ]
+            return ' '.join(start + levels)
+
+        parts = [ piece for piece in self.pieces if piece ]
+        if self.textgen == 'preorder':
+            return ' '.join(start + parts)
+        return ' '.join(parts + start)
+
+    # TextPHash(text_ast, phash), TextHash64 reuses the windows and the paragraph hashes of the previous text
+    def TextHash(self, text_ast):
+        if self.phash != 'selfmade' or np is None or len(text_ast) < 80:
+            self.windows = None
+            return TextPHash(text_ast, self.phash)
+
+        with Stage('texthash64'):
+            prefix_hashes = self.PrefixHashes(text_ast+'101') # the padding of TextPHash()
+        if prefix_hashes == None: # the same text
+            return self.hash_list
+        with Stage('reduce'):
+            return ReduceHashList( [ h for hash_list in prefix_hashes for h in hash_list ], 32 )
+
+    # TextHash64_real('dummy '*i+text) for every prefix i, from the ones of the previous text. None if text is the same
+    def PrefixHashes(self, text):
+        n_prefix = 8
+        if self.windows is None:
+            windows = TextWindows(text)
+            word_windows = WordWindows(text)
+            pw = sw = 0
+        elif text == self.text:
+            return None
+        else:
+            # every word (split by ' ') is aligned to windows independently: only the words from the first changed one (text[:x] is
+            # unchanged) to the last changed one (text[y:] is unchanged) are aligned again
+            old_text = self.text
+            x = CommonPrefixLength(old_text, text)
+            y = len(text) - min( CommonPrefixLength(old_text[::-1], text[::-1]), min(len(old_text), len(text))-x )
+            x = text.rfind(' ', 0, x) + 1
+            y = text.find(' ', y)
+            if y == -1:
+                y = len(text)
+            n_head = text.count(' ', 0, x) # words before x
+            n_tail = text.count(' ', y) # words after y
+            pw = int( self.word_windows[n_head] ) # windows before pw and the last sw windows are unchanged
+            sw = len(self.windows) - int( self.word_windows[len(self.word_windows)-1-n_tail] )
+            mid_windows = TextWindows(text[x:y])
+            windows = np.concatenate( (self.windows[:pw], mid_windows, self.windows[len(self.windows)-sw:]) )
+            word_windows = np.concatenate( (self.word_windows[:n_head+1], pw + WordWindows(text[x:y])[1:],
+                                            self.word_windows[len(self.word_windows)-n_tail:] + (len(windows)-len(self.windows))) )
+
+        window_cumsum = WindowCumsum(windows, n_prefix)
+        n_new = len(windows)
+        delta = n_new - (len(self.windows) if self.windows is not None else 0)
+        prefix_hashes = []
+        for i in range(n_prefix):
+            n_round = (i+n_new)//10 + 1
+            # paragraph r of prefix i covers the windows [10r-i, 10r+10-i) of the text: the ones before pw are unchanged,
+            # and the ones from n_new-sw are paragraph r2 of prefix i2 of the old text if i2 = (i+delta)%10 < n_prefix
+            r_head = min( (pw+i)//10, n_round )
+            i2 = (i+delta) % 10
+            r_tail = n_round
+            if sw > 0 and i2 < n_prefix:
+                r_tail = max( r_head, -(-(n_new-sw+i)//10) )
+            r_shift = (i+delta-i2)//10
+            hash_list = self.prefix_hashes[i][:r_head] if r_head > 0 else []
+            hash_list += ParagraphHashes(window_cumsum, n_prefix, i, r_head, r_tail)
+            hash_list += self.prefix_hashes[i2][r_tail-r_shift:] if r_tail < n_round else []
+            prefix_hashes.append(hash_list)
+        self.text = text
+        self.windows = windows
+        self.word_windows = word_windows
+        self.prefix_hashes = prefix_hashes
+
+        return prefix_hashes
+
+# cumulative number of windows of the words of TextAlign(text, win_len): the words (split by ' ') before word k have word_windows[k] windows
+def WordWindows(text, win_len=8):
+    n_window = np.fromiter( map(len, text.split(' ')), dtype=np.int64 )
+    word_windows = np.zeros(len(n_window)+1, dtype=np.int64)
+    np.cumsum( -(-n_window//win_len), out=word_windows[1:] )
+    return word_windows
+
+# length of the common prefix of two lists (or strings), compared slice by slice
+def CommonPrefixLength(seq1, seq2):
+    lo, hi = 0, min(len(seq1), len(seq2))
+    while lo < hi:
+        mid = (lo+hi+1)//2
+        if seq1[lo:mid] == seq2[lo:mid]:
+            lo = mid
+        else:
+            hi = mid-1
+
+    return lo
+
+# the 32 high bits of the textkeys of the pHash library (pHash/src/pHash.h), their 32 low bits are all 0
+ph_textkeys = [
+    0xd7168ace, 0x64f6478c, 0xc87930d2, 0xcc6690e6, 0xe961b8a2, 0x3292b9fe, 0x55d12894, 0xc4aab1d8,
+    0x471c3e52, 0x8dd0f99a, 0x7a36b174, 0xa0fdaf56, 0x5d6283e4, 0x836e3df6, 0xf3c553c6, 0xea8bc28c,
+    0xa2be00f8, 0xb7a0c584, 0x244010a8, 0x9b624ff0, 0x042c4636, 0x3e2dd3d0, 0x23219bce, 0xcdde871a,
+    0x281c1eec, 0x66a44ab4, 0x2139f25c, 0x1bdae4c6, 0xffb98466, 0x37dfaf3e, 0x834f8992, 0xd6d00f34,
+    0x9cd5f6cc, 0x4bc8ba64, 0xa336a01a, 0x8637af6e, 0x7e5b7462, 0xf907c8b0, 0x4ae26146, 0xc577b2b4,
+    0x86d8c24a, 0xc51912ba, 0x6675620a, 0xe43b462e, 0x488750b0, 0x5a3ab5d2, 0xcec708bc, 0xeb4551a8,
+    0x11db7b56, 0xf3071964, 0x86a7a19a, 0x1607c18c, 0x3134ed36, 0xa9c93d68, 0xe3e648a8, 0x59510c22,
+    0x106d881c, 0x05203b04, 0x752bf0e8, 0x10270c82, 0x3cffea42, 0xf87b7a7a, 0xe6f71bb8, 0xd9d5e10e,
+    0x444434e0, 0x8a2dbbd2, 0x600d907c, 0xc29fa942, 0x83358482, 0xaaeff1c2, 0x88175bf8, 0x0a0e46ce,
+    0x7009047c, 0xee8cbe02, 0xee498cfc, 0xb890552e, 0x48c773d4, 0xbd1095b8, 0xa3d5a6d6, 0x5aa2ef2c,
+    0xb017af1e, 0x2a7d4870, 0x70aab0b8, 0xe14c9c54, 0xd44685d8, 0x5490f960, 0x3a9da876, 0xe4b40df6,
+    0x59b13464, 0xafc9995e, 0xf4db1a78, 0x96b11ea8, 0xa84513d8, 0xdbd23630, 0x7086ffb6, 0xec8948b8,
+    0x65fff204, 0xd0949034, 0xaf28f1fc, 0xe9357686, 0x7b8481f6, 0x37404df4, 0xf343bd54, 0xeb8d8674,
+    0x25cd0bf6, 0xe18d4a52, 0xa41ddba2, 0x6e947fcc, 0x9e9de00a, 0x47f38278, 0xc9376ef8, 0x4eb58f28,
+    0x7270caea, 0x39e21fb0, 0x30022b7c, 0x46b750c2, 0x8e731912, 0x6a9fd3f2, 0x2b6b5eb8, 0xe8244d76,
+    0x1a696d50, 0x20467932, 0x7ed56c1e, 0xc2ae812a, 0xfc18af62, 0xef5c6bd6, 0xaf37c9e2, 0x6218a166,
+    0xbff0fc0a, 0x5e60bbde, 0x4b4e17ee, 0x3b757e00, 0x95a109d2, 0x3e91d542, 0x27030474, 0xbb6e15ca,
+    0x201f1f94, 0xcb20e016, 0x2a029596, 0xbebcffa0, 0x13146290, 0xf33a048e, 0x0d728ec8, 0x85852d7a,
+    0x2d1c243e, 0x3d74ba46, 0xcc3c7e3c, 0xbb8f3d50, 0xa8148e38, 0xf7a7dcf6, 0xa3b38ac8, 0xc27dfb8a,
+    0x17ee5628, 0x2288f6e6, 0x852c7cb4, 0x1407058a, 0x11e562bc, 0x34644696, 0x761fa6f2, 0xd1d65ec6,
+    0x92c50276, 0xc16dbee0, 0x0d4bdcc8, 0x28660c48, 0xffff9422, 0x344ee13c, 0xe3d42212, 0x201eb3b8,
+    0xff6fc154, 0x0dd6b7a8, 0xdedbb358, 0x128423e4, 0x0110bc36, 0xec4e4220, 0x9809515e, 0x2e2ce076,
+    0x29c2fc66, 0x6445cf9a, 0xe9bc1dc6, 0xd1d78aa0, 0x5bedac90, 0x8d6fa88e, 0x9455862a, 0x73dc02b8,
+    0xaff89f76, 0x198202de, 0x87e30844, 0xc1de0232, 0x4de64974, 0xfe02af36, 0x93b460fa, 0xe0ab4bea,
+    0xbf706e16, 0xa1003dc2, 0x09115834, 0xbf700238, 0xd54f1efe, 0xece57a46, 0xdf8eb5f0, 0xd4bee052,
+    0xfabc31f0, 0xbe6a6948, 0xe7430436, 0xfbccee26, 0xaab8ab6a, 0x7f4c5594, 0x29f9ce9c, 0xd47ba7d0,
+    0xe3922530, 0x13b5ec64, 0xa6533270, 0x3f7fd1c0, 0xa12594f2, 0x3aa8b89a, 0xb35bd47a, 0x511e3468,
+    0x542abb78, 0x3b3edcbe, 0x12fc369c, 0xa21104ee, 0x39418bf4, 0xa6b09796, 0x82bc50d8, 0xf8b1fa0a,
+    0x47b0d558, 0x8bcda90c, 0xb821fc42, 0x1cfff456, 0x78b32354, 0x97b0b234, 0xf1bed4aa, 0x736f5544,
+    0x561b1b7c, 0xd901d8e0, 0x6f3c436a, 0x00d3c6e6, 0x584e2e76, 0x99361208, 0xd54f6eb8, 0x3be053a6,
+    0xacebfe6c, 0x7ba2a128, 0x7b602566, 0x4e11935e, 0xb64b59c4, 0x2ebbf9e0, 0x9f2fc7c8, 0x0a76153c,
+    0x69fad69e, 0xb22bfe64, 0xac871a2a, 0xa33c6292, 0x58dc95fa, 0x2f436b04, 0x9bee5c9c, 0xa08d6b52,
+]
+ph_lower = bytes( c+32 if 65 <= c <= 90 else c for c in range(256) )
+ph_skipped = bytes( c for c in range(256) if not (48 <= c <= 57 or 65 <= c <= 90 or 97 <= c <= 122) ) # only letters and digits are hashed
+
+# Text hash of the pHash library (ph_texthash() in pHash/src/libpHash.so, run by pHash/text_hash.exe) computed in python.
+# Return the hashes as hex strings, the same as the pHash/hash file written by text_hash.exe, or [] if the text is too short.
+# A rolling hash is computed on every character (letters and digits only), and the smallest one of every 100 is a hash.
+# ph_texthash() also xors out the key of the char leaving its 50-char kgram (shifted by 50 bits), that is always 0 with its textkeys.
+# Except when chars of the first kgram are skipped: their kgram slots are left uninitialized. In text_hash.exe, only the garbage of the
+# 9th slot is out of the textkeys table, and the key read for it is 0x2d200000 after the shift, xored into the 9th hash after the first
+# kgram (the other slots give keys whose shifted value is 0).
+def PHashText(text):
+    data = text.encode()
+    if len(data) < 50:
+        return []
+    hash_v = 0
+    for c in data[:50].translate(ph_lower, ph_skipped): # the first kgram
+        hash_v = ((hash_v<<1) ^ ph_textkeys[c]) & 0xffffffff
+
+    hash_list = [hash_v]
+    for c in data[50:].translate(ph_lower, ph_skipped):
+        hash_v = ((hash_v<<1) ^ ph_textkeys[c]) & 0xffffffff
+        hash_list.append(hash_v)
+    if ph_lower[data[8]] in ph_skipped and len(hash_list) > 9:
+        for i in range(9, min(len(hash_list), 9+32)): # shifted out after 32 chars
+            hash_list[i] ^= (0x2d200000 << (i-9)) & 0xffffffff
+
+    return [ '%x' % min(hash_list[i:i+100]) for i in range(0, len(hash_list)-99, 100) ]
+
 # Compute the average hamming distance, the return value is a number form 0 to 32. This is a wrapper
 def HammingDist(hash1,hash2,printing=False):
     hm_dist1 = HammingDist_avg(hash1,hash2,printing=printing)
@@ -633,14 +1959,22 @@ def HammingDist_avg(hash1,hash2,printing=False):
         print('hash2 list:',hash2)
 
     # use the smallest hamming distance between two hash list as the hamming distance
-    hm_dist_list = []
-    for h1 in hash1:
-        if not h1 in hash2:
-            for h2 in hash2:
-                cur_hm = HammingDist_real(h1,h2,printing=printing)
-                hm_dist_list.append(cur_hm)
-
-    hm_dist = sum(hm_dist_list)/(len(hash1)*len(hash2)) # calculate the average
+    hash2_set = set(hash2)
+    if printing or np is None:
+        hm_dist_sum = 0
+        hash2_int = HashInt(hash2)
+        for h1 in hash1:
+            if not h1 in hash2_set:
+                if printing:
+                    hm_dist_sum += sum( HammingDist_real(h1,h2,printing=printing) for h2 in hash2 )
+                else:
+                    h1_int = HashInt([h1])[0]
+                    hm_dist_sum += sum( PopCount(h1_int^h2) for h2 in hash2_int )
+    else:
+        unseen = np.array( [ not h1 in hash2_set for h1 in hash1 ], dtype=bool )
+        hm_dist_sum = int( HammingMatrix(HashArray(hash1)[unseen], HashArray(hash2)).sum() )
+
+    hm_dist = hm_dist_sum/(len(hash1)*len(hash2)) # calculate the average
     if printing:
         print('Overall hamming distance =',hm_dist)
 
@@ -648,68 +1982,152 @@ def HammingDist_avg(hash1,hash2,printing=False):
 
 # Compute the hamming distance, the return value is a number form 0 to 32, input is two hashes(string)
 def HammingDist_real(hash1,hash2,printing=False):
-    hash1_b = '{0:b}'.format(int(hash1,16)) #hex to binary
-    hash2_b = '{0:b}'.format(int(hash2,16))
-
-    hash1_b = '0'*(32-len(hash1_b))+hash1_b # add zeros
-    hash2_b = '0'*(32-len(hash2_b))+hash2_b
-
-    count = 0
-    for i in range(32):
-        if (hash1_b[i] != hash2_b[i]):
-            count += 1
+    count = PopCount( int(hash1,16) ^ int(hash2,16) )
 
     if printing:
-        print('hash1 =',hash1_b,'(',hash1,')')
-        print('hash2 =',hash2_b,'(',hash2,')')
+        print('hash1 =','{0:032b}'.format(int(hash1,16)),'(',hash1,')')
+        print('hash2 =','{0:032b}'.format(int(hash2,16)),'(',hash2,')')
         print('hamming distance =',count)
 
     return count 
 
+# number of 1 bits of a non-negative integer
+if hasattr(int, 'bit_count'): # python >= 3.10
+    PopCount = int.bit_count
+else:
+    def PopCount(x):
+        return bin(x).count('1')
+
+# hash list (hex strings, integers or a numpy array) to a list of integers
+def HashInt(hash_list):
+    return [ int(h,16) if isinstance(h,str) else int(h) for h in hash_list ]
+
+# hash list (hex strings, integers or a numpy array) to a numpy uint64 array
+def HashArray(hash_list):
+    if isinstance(hash_list, np.ndarray):
+        return hash_list.astype(np.uint64, copy=False)
+    return np.array( HashInt(hash_list), dtype=np.uint64 )
+
+# number of 1 bits of every element of a numpy uint64 array
+def PopCountArray(x):
+    if hasattr(np, 'bitwise_count'): # numpy >= 2.0
+        return np.bitwise_count(x)
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    bit_table = np.array( [ bin(i).count('1') for i in range(256) ], dtype=np.uint8 )
+    return bit_table[ x.view(np.uint8) ].reshape( x.shape+(8,) ).sum(axis=-1, dtype=np.uint8)
+
+# matrix of the hamming distances between every hash of two numpy uint64 arrays, element [i,j] is the distance between hash_array1[i] and hash_array2[j]
+def HammingMatrix(hash_array1, hash_array2):
+    return PopCountArray( hash_array1[:,None] ^ hash_array2[None,:] )
+
 # generate a perceptual hash list of a given string textin
 def TextHash64(textin):
-    hash_list = []
-    for i in range(8):
-        new_textin = 'dummy '*i+textin
-        cur_hash_list = TextHash64_real(new_textin)
-        hash_list += cur_hash_list
-        
-    # reduce hash list size
-    target_hd = 0
-    while(len(hash_list)>32):
-        hashl_len = len(hash_list)
-        delete_list = [False]*hashl_len
-        
-        for i in range(hashl_len):
-            if delete_list[i]:
-                continue
-            if delete_list.count(False)<32:
-                continue
-            for j in range(i+1,hashl_len):
-                if HammingDist64_real(hash_list[i],hash_list[j]) == target_hd:
-                    delete_list[j] = True
-        
-        new_hashl = filter(lambda p: p[1] == False, zip(hash_list,delete_list))
-        new_hashl = list(zip(*new_hashl))[0]
-        
-        hash_list = list(new_hashl)
-        target_hd += 1
-        
-    return hash_list
+    with Stage('texthash64'):
+        if np is not None:
+            hash_list = TextHash64_prefixes(textin, 8)
+        else:
+            hash_list = []
+            for i in range(8):
+                new_textin = 'dummy '*i+textin
+                cur_hash_list = TextHash64_real(new_textin)
+                hash_list += cur_hash_list
+
+    return ReduceTextHashes(hash_list)
+
+# the hash list of TextHash64() from the hashes of the paragraphs of every prefix
+def ReduceTextHashes(hash_list):
+    with Stage('reduce'):
+        reduced = ReduceHashList(hash_list, 32)
+    CountStat('raw_hashes', len(hash_list))
+    CountStat('reduced_hashes', len(reduced))
+    return reduced
+
+reduce_matrix_size = 1<<26 # bytes of the distance matrix ReduceHashList() keeps (about 8000 different hashes)
+reduce_block_size = 1<<21 # distances ReduceHashList() computes at a time
+
+# reduce hash list size to at most n_keep hashes: with target_hd = 0, 1, 2, ..., a hash is deleted if a previous hash that is not deleted
+# is at hamming distance target_hd from it (no more deleted after less than n_keep hashes are left). The order of the hashes is kept.
+# target_hd = 0 only deletes the copies of a hash, after that the hamming distances of the hashes left are computed by blocks of rows.
+def ReduceHashList(hash_list, n_keep=32):
+    if len(hash_list) <= n_keep:
+        return list(hash_list)
+
+    hash_int = HashInt(hash_list)
+    n_copy = collections.Counter(hash_int)
+    kept = set() # hashes whose copies are deleted
+    n_left = len(hash_int)
+    for hash_v in hash_int:
+        if hash_v in kept:
+            continue
+        if n_left < n_keep:
+            break
+        kept.add(hash_v)
+        n_left -= n_copy[hash_v]-1
+    alive = []
+    seen = set()
+    for i, hash_v in enumerate(hash_int):
+        if not hash_v in seen or not hash_v in kept:
+            alive.append(i)
+        seen.add(hash_v)
+
+    target_hd = 1
+    if np is not None and len(alive) > n_keep:
+        hash_array = HashArray( [ hash_int[i] for i in alive ] )
+        n = len(alive)
+        # the distances between all the hashes are kept (uint8) if they fit in reduce_matrix_size bytes, else they are computed again
+        # for every block of rows at every target_hd
+        hm_matrix = None
+        if n*n <= reduce_matrix_size:
+            hm_matrix = np.empty( (n,n), dtype=np.uint8 )
+            for r0 in range(0, n, max(1, reduce_block_size//n)):
+                r1 = min(r0 + max(1, reduce_block_size//n), n)
+                hm_matrix[r0:r1] = HammingMatrix(hash_array[r0:r1], hash_array)
+        left = np.arange(n) # hashes not deleted
+        while len(left) > n_keep:
+            delete = np.zeros(len(left), dtype=bool)
+            n_left = len(left)
+            block_rows = max(1, reduce_block_size//len(left))
+            for r0 in range(0, len(left), block_rows):
+                rows = left[r0:r0+block_rows]
+                block = hm_matrix[rows][:,left] if hm_matrix is not None else HammingMatrix(hash_array[rows], hash_array[left])
+                same_hd = np.triu( block == target_hd, r0+1 ) # hashes after the hash of the row only
+                for b in np.flatnonzero( same_hd.any(axis=1) ).tolist():
+                    if delete[r0+b]:
+                        continue
+                    if n_left < n_keep:
+                        break
+                    n_left -= int( np.count_nonzero( same_hd[b] & ~delete ) )
+                    delete |= same_hd[b]
+                if n_left < n_keep:
+                    break
+            left = left[~delete]
+            target_hd += 1
+        alive = [ alive[i] for i in left.tolist() ]
+    else:
+        while len(alive) > n_keep:
+            delete = [False]*len(alive)
+            n_left = len(alive)
+            for i in range(len(alive)):
+                if delete[i]:
+                    continue
+                if n_left < n_keep:
+                    break
+                hash1 = hash_int[alive[i]]
+                for j in range(i+1,len(alive)):
+                    if not delete[j] and PopCount(hash1^hash_int[alive[j]]) == target_hd:
+                        delete[j] = True
+                        n_left -= 1
+            alive = [ p for p, d in zip(alive,delete) if not d ]
+            target_hd += 1
+
+    return [ hash_list[p] for p in alive ]
 
 def TextHash64_real(textin):
     # every paragraph generate a hash value of 64 bits
     win_len = 8 # window length, in number of characters
     para_len = 10 # paragraph length, in number of windows
     
-    # align with space
-    text_t = textin.split(' ')
-    text = ''
-    for txt_item in text_t:
-        sec_len = math.ceil( len(txt_item)/win_len )*win_len
-        new_item = txt_item+' '*(sec_len-len(txt_item))
-        text += new_item
-    
+    text = TextAlign(textin, win_len)
     txt_len = len(text)
     
     round = int(txt_len/(win_len*para_len)) + 1
@@ -732,47 +2150,577 @@ def TextHash64_real(textin):
         hash_list.append(hash)
         
     return hash_list
+
+# align with space: every word (split by ' ') is padded with spaces to a multiple of win_len characters
+def TextAlign(textin, win_len=8):
+    return ''.join( txt_item.ljust( math.ceil( len(txt_item)/win_len )*win_len ) for txt_item in textin.split(' ') )
+
+# TextHash64_real('dummy '*i+textin) for i in range(n_prefix), concatenated, with numpy.
+# 'dummy ' is aligned to one window, so the prefixes only shift the windows of textin: the character value sums of the windows are
+# accumulated once (after n_prefix-1 dummy windows), and the sums of every paragraph of every prefix are differences of the cumulative sum.
+def TextHash64_prefixes(textin, n_prefix=8):
+    return WindowHashes( TextWindows(textin), n_prefix )
+
+# TextHash64_prefixes() of the text of windows (see TextWindows): all the paragraphs of all the prefixes at once
+def WindowHashes(windows, n_prefix=8, para_len=10):
+    window_cumsum = WindowCumsum(windows, n_prefix, para_len)
+    lo = ParagraphStarts(len(windows), n_prefix, para_len)
+    return ParagraphHex( window_cumsum[lo+para_len] - window_cumsum[lo], windows.shape[1] )
+
+# first window of every paragraph of every prefix after WindowCumsum()'s dummy windows, prefix after prefix: paragraph r of prefix i
+# starts at window n_prefix-1-i + para_len*r, and a text of n_window windows has (i+n_window)//para_len + 1 paragraphs with prefix i
+def ParagraphStarts(n_window, n_prefix=8, para_len=10):
+    prefix = np.arange(n_prefix)
+    n_para = (prefix+n_window)//para_len + 1
+    r = np.arange(n_para[-1])
+    lo = (n_prefix-1-prefix)[:,None] + para_len*r[None,:]
+    return lo[ r[None,:] < n_para[:,None] ]
+
+# hashes of paragraphs from their sums (a row of win_len character value sums per paragraph), as TextHash64_real() does
+def ParagraphHex(para_sum, win_len=8):
+    hash_hex = (para_sum % 256).astype(np.uint8).tobytes().hex()
+    return [ hash_hex[j:j+2*win_len] for j in range(0, len(hash_hex), 2*win_len) ]
+
+# the windows of TextAlign(textin, win_len), a numpy array of character values with a row per window
+def TextWindows(textin, win_len=8):
+    text = TextAlign(textin, win_len)
+    return np.frombuffer( text.encode('utf-32-le'), dtype=np.uint32 ).reshape(-1, win_len)
+
+# cumulative sum of the windows after n_prefix-1 dummy windows ('dummy '), with zeros after the text for the last paragraph
+def WindowCumsum(windows, n_prefix=8, para_len=10):
+    n_window, win_len = windows.shape
+    dummy = np.frombuffer( TextAlign('dummy ', win_len).encode('utf-32-le'), dtype=np.uint32 )
+    all_windows = np.zeros( (n_prefix-1 + n_window + 2*para_len, win_len), dtype=np.int64 )
+    all_windows[:n_prefix-1] = dummy
+    all_windows[n_prefix-1:n_prefix-1+n_window] = windows
+    window_cumsum = np.zeros( (len(all_windows)+1, win_len), dtype=np.int64 )
+    np.cumsum(all_windows, axis=0, out=window_cumsum[1:])
+    return window_cumsum
+
+# hashes of the paragraphs r_lo to r_hi-1 of TextHash64_real('dummy '*i+textin), window_cumsum is WindowCumsum() of textin
+def ParagraphHashes(window_cumsum, n_prefix, i, r_lo, r_hi, para_len=10):
+    if r_hi <= r_lo:
+        return []
+    win_len = window_cumsum.shape[1]
+    bounds = n_prefix-1-i + para_len*np.arange(r_lo, r_hi+1)
+    return ParagraphHex( window_cumsum[bounds[1:]] - window_cumsum[bounds[:-1]], win_len )
  
 # Compute the hamming distance between two hash list
+# hash lists are hex strings (from TextHash64), or integers / numpy uint64 arrays of the same hashes
 def HammingDist64(hash_list1, hash_list2):
-    hm_dist1 = HammingDist64_oneside(hash_list1, hash_list2)
-    hm_dist2 = HammingDist64_oneside(hash_list2, hash_list1)
+    if np is None or len(hash_list1) == 0 or len(hash_list2) == 0:
+        hm_dist1 = HammingDist64_oneside(hash_list1, hash_list2)
+        hm_dist2 = HammingDist64_oneside(hash_list2, hash_list1)
+    else:
+        # both directions from one distance matrix
+        hm_matrix = HammingMatrix( HashArray(hash_list1), HashArray(hash_list2) )
+        hm_dist1 = int( hm_matrix.min(axis=1).sum() )/len(hash_list1)
+        hm_dist2 = int( hm_matrix.min(axis=0).sum() )/len(hash_list2)
     
     return (hm_dist1+hm_dist2)/2
 
 def HammingDist64_oneside(hash_list1, hash_list2):
-    min_hamming_dist_list = []
-    
-    for hash1 in hash_list1:
-        hm_dist_min = 64
-        for hash2 in hash_list2:
-            cur_hm_dist = HammingDist64_real(hash1, hash2)
-            if cur_hm_dist==0:
-                hm_dist_min = 0
-                break
-            elif cur_hm_dist < hm_dist_min:
-                hm_dist_min = cur_hm_dist
-        
-        min_hamming_dist_list.append(hm_dist_min)
+    if np is not None and len(hash_list1) > 0 and len(hash_list2) > 0:
+        hm_matrix = HammingMatrix( HashArray(hash_list1), HashArray(hash_list2) )
+        min_hamming_dist_sum = int( hm_matrix.min(axis=1).sum() )
+    else:
+        hash_int2 = HashInt(hash_list2)
+        min_hamming_dist_sum = sum( min( (PopCount(hash1^hash2) for hash2 in hash_int2), default=64 ) for hash1 in HashInt(hash_list1) )
     
     # use average minimum hamming distance as the Hamming Distance of two hash list
-    avg_min_hd = sum(min_hamming_dist_list)/len(min_hamming_dist_list) 
+    avg_min_hd = min_hamming_dist_sum/len(hash_list1) 
     return avg_min_hd
     
     
 def HammingDist64_real(hash1,hash2):
-    hash1_b = '{0:b}'.format(int(hash1,16)) #hex to binary
-    hash2_b = '{0:b}'.format(int(hash2,16))
+    return PopCount( int(hash1,16) ^ int(hash2,16) )
+
+# Compute HammingDist64() between every two hash lists of hash_lists, return a symmetric N*N numpy float64 matrix (N = len(hash_lists))
+# The matrix is computed block_size*block_size hash lists at a time. If out_file is given, the matrix is a numpy memory-mapped .npy file instead of in memory.
+# (without numpy, return a list of lists computed by HammingDist64())
+def PairwiseDistanceMatrix(hash_lists, block_size=32, out_file=None):
+    n = len(hash_lists)
+    if np is None:
+        hm_matrix = [ [0.0]*n for _ in range(n) ]
+        for i in range(n):
+            for j in range(i+1,n):
+                hm_matrix[i][j] = hm_matrix[j][i] = HammingDist64(hash_lists[i], hash_lists[j])
+        return hm_matrix
+
+    hash_array, offsets = PackHashLists(hash_lists)
+    lengths = np.diff(offsets)
+    if n > 0 and lengths.min() == 0:
+        raise ValueError('empty hash list')
+
+    if out_file == None:
+        hm_matrix = np.zeros( (n,n), dtype=np.float64 )
+    else:
+        hm_matrix = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float64, shape=(n,n))
+
+    for r0 in range(0, n, block_size):
+        r1 = min(r0+block_size, n)
+        row_hashes = hash_array[ offsets[r0]:offsets[r1] ]
+        row_starts = offsets[r0:r1] - offsets[r0] # start of every hash list in row_hashes
+        for c0 in range(r0, n, block_size): # upper triangle only, the matrix is symmetric
+            c1 = min(c0+block_size, n)
+            col_hashes = hash_array[ offsets[c0]:offsets[c1] ]
+            col_starts = offsets[c0:c1] - offsets[c0]
+            block = HammingMatrix(row_hashes, col_hashes)
+            # sum of the minimum distance of every hash of row list i to col list j, and of every hash of col list j to row list i
+            row_min_sum = np.add.reduceat( np.minimum.reduceat(block, col_starts, axis=1), row_starts, axis=0, dtype=np.int64 )
+            col_min_sum = np.add.reduceat( np.minimum.reduceat(block, row_starts, axis=0), col_starts, axis=1, dtype=np.int64 )
+            dist = ( row_min_sum/lengths[r0:r1,None] + col_min_sum/lengths[None,c0:c1] )/2
+            hm_matrix[r0:r1, c0:c1] = dist
+            hm_matrix[c0:c1, r0:r1] = dist.T
+
+    if out_file != None:
+        hm_matrix.flush()
+    return hm_matrix
+
+# pack hash lists into one numpy uint64 array, return (hash_array, offsets), hash list i is hash_array[offsets[i]:offsets[i+1]]
+# (for a FingerprintStore, the arrays of its file)
+def PackHashLists(hash_lists):
+    if isinstance(hash_lists, FingerprintStore): # already packed
+        return (hash_lists.hash_array, hash_lists.offsets)
+    offsets = np.zeros( len(hash_lists)+1, dtype=np.int64 )
+    offsets[1:] = np.cumsum( [ len(hash_list) for hash_list in hash_lists ] )
+    hash_array = np.empty( offsets[-1], dtype=np.uint64 )
+    for i, hash_list in enumerate(hash_lists):
+        hash_array[ offsets[i]:offsets[i+1] ] = HashArray(hash_list)
+
+    return (hash_array, offsets)
+
+# Compute HammingDist64() between hash_list and every hash list packed in (hash_array, offsets) (see PackHashLists()), return a numpy float64 array.
+# hash lists are compared chunk_size at a time, to bound the size of the distance matrix
+def HammingDist64OneToMany(hash_list, hash_array, offsets, chunk_size=4096):
+    query_array = HashArray(hash_list)
+    n = len(offsets)-1
+    lengths = np.diff(offsets)
+    hm_dist = np.empty(n, dtype=np.float64)
+    for c0 in range(0, n, chunk_size):
+        c1 = min(c0+chunk_size, n)
+        starts = offsets[c0:c1] - offsets[c0]
+        block = HammingMatrix( query_array, hash_array[ offsets[c0]:offsets[c1] ] )
+        query_min_sum = np.minimum.reduceat(block, starts, axis=1).sum(axis=0, dtype=np.int64)
+        other_min_sum = np.add.reduceat(block.min(axis=0), starts, dtype=np.int64)
+        hm_dist[c0:c1] = ( query_min_sum/len(query_array) + other_min_sum/lengths[c0:c1] )/2
 
-    hash1_b = '0'*(64-len(hash1_b))+hash1_b # add zeros
-    hash2_b = '0'*(64-len(hash2_b))+hash2_b
+    return hm_dist
 
-    count = 0
-    for i in range(64):
-        if (hash1_b[i] != hash2_b[i]):
-            count += 1
+# Similarity index of hash lists (from TextHash64) for nearest neighbor search by HammingDist64(), with multi-index hashing.
+# Every 64-bit hash is split into n_chunk chunks, and every chunk has a table: chunk value -> hash lists having a hash with that chunk value.
+# If two hashes are within hamming distance r, one of their chunks is within r//n_chunk bits, so candidates are found by probing chunk values
+# a few bits away from the query's. HammingDist64() is never smaller than the smallest distance between two hashes of the two lists,
+# so after probing s bits (every hash pair within n_chunk*(s+1)-1 bits found), a hash list not found yet is farther than that.
+# Candidates are ranked by the exact HammingDist64(). Needs numpy.
+class HashIndex:
+    def __init__(self, n_chunk=3):
+        if np is None:
+            raise ImportError('HashIndex needs numpy')
+        self.n_chunk = n_chunk
+        # (shift, width) of every chunk of a hash
+        widths = [ 64//n_chunk + (1 if i < 64%n_chunk else 0) for i in range(n_chunk) ]
+        self.chunks = [ (sum(widths[:i]), widths[i]) for i in range(n_chunk) ]
+        self.tables = [ {} for _ in range(n_chunk) ] # chunk value -> list of hash list indices
+        self.hash_arrays = [] # hash list index -> numpy uint64 array
+        self.kernel_ids = [] # hash list index -> kernel id given to Add()
+        self.packed = None # PackHashLists() of all hash lists, for brute force search
+
+    def __len__(self):
+        return len(self.hash_arrays)
+
+    # add a hash list, kernel_id is returned by Query() (its index in the index by default). return the index of the hash list
+    def Add(self, hash_list, kernel_id=None):
+        index = len(self.hash_arrays)
+        hash_int = HashInt(hash_list)
+        if len(hash_int) == 0:
+            raise ValueError('empty hash list')
+        self.hash_arrays.append( np.array(hash_int, dtype=np.uint64) )
+        self.kernel_ids.append( index if kernel_id == None else kernel_id )
+        for (shift, width), table in zip(self.chunks, self.tables):
+            mask = (1<<width)-1
+            for value in set( h >> shift & mask for h in hash_int ):
+                table.setdefault(value, []).append(index)
+        self.packed = None
+
+        return index
+
+    # find the hash lists nearest to hash_list: the k nearest ones, or the ones within HammingDist64() <= radius, or the k nearest within radius.
+    # return a list of (kernel_id, distance), sorted by distance (then by order of insertion).
+    # Chunk values up to max_probe_bits bits away are probed. If that does not prove the result, with exact=True the remaining hash lists
+    # are compared by brute force, and with exact=False the best candidates found are returned (faster, may miss some).
+    # The number of probes grows fast with max_probe_bits: with a large index, probing 2 bits finds a good part of it anyway.
+    def Query(self, hash_list, k=None, radius=None, max_probe_bits=1, exact=True):
+        if k == None and radius == None:
+            raise ValueError('k or radius must be given')
+        query_int = HashInt(hash_list)
+        query_chunks = [ set( h >> shift & ((1<<width)-1) for h in query_int ) for shift, width in self.chunks ]
+        hm_dist_dict = {} # hash list index -> HammingDist64()
+        for s in range(max_probe_bits+1):
+            candidates = set()
+            for (shift, width), table, values in zip(self.chunks, self.tables, query_chunks):
+                for mask in ProbeMasks(width, s):
+                    for value in values:
+                        candidates.update( table.get(value^mask, ()) )
+            candidates = sorted( candidates.difference(hm_dist_dict) )
+            if candidates:
+                hm_dist_dict.update( zip( candidates, self.Distances(query_int, candidates) ) )
+
+            found_radius = self.n_chunk*(s+1)-1 # every hash list within this distance is found
+            if radius != None and radius < found_radius+1:
+                return self.Result(hm_dist_dict, k, radius)
+            if k != None and len(hm_dist_dict) >= k and sorted( hm_dist_dict.values() )[k-1] <= found_radius:
+                return self.Result(hm_dist_dict, k, radius)
+
+        if exact and len(hm_dist_dict) < len(self):
+            if self.packed == None:
+                self.packed = PackHashLists(self.hash_arrays)
+            hm_dist_dict = dict( enumerate( HammingDist64OneToMany(query_int, *self.packed).tolist() ) )
+        return self.Result(hm_dist_dict, k, radius)
+
+    # HammingDist64() between the query and the hash lists of the given indices
+    def Distances(self, query_int, indices):
+        hash_array, offsets = PackHashLists( [ self.hash_arrays[i] for i in indices ] )
+        return HammingDist64OneToMany(query_int, hash_array, offsets).tolist()
+
+    def Result(self, hm_dist_dict, k, radius):
+        result = sorted( hm_dist_dict.items(), key=lambda p: (p[1],p[0]) )
+        if radius != None:
+            result = [ p for p in result if p[1] <= radius ]
+        if k != None:
+            result = result[:k]
+        return [ (self.kernel_ids[i], hm_dist) for i, hm_dist in result ]
+
+    # save the index to file_name in the .npz format. The file is opened here, so np.savez() does not append '.npz' to its name
+    def Save(self, file_name):
+        hash_array, offsets = PackHashLists(self.hash_arrays)
+        id_json = np.frombuffer( json.dumps(self.kernel_ids).encode(), dtype=np.uint8 )
+        with open(file_name,'wb') as f:
+            np.savez(f, hash_array=hash_array, offsets=offsets, kernel_ids=id_json, n_chunk=self.n_chunk)
+
+    # load an index saved by Save() with the same file_name. Earlier versions saved it to file_name+'.npz' when file_name had no
+    # '.npz' extension, that file is loaded if file_name does not exist
+    @staticmethod
+    def Load(file_name):
+        if not os.path.exists(file_name) and os.path.exists(file_name+'.npz'):
+            file_name += '.npz'
+        with np.load(file_name) as data:
+            index = HashIndex( n_chunk=int(data['n_chunk']) )
+            kernel_ids = json.loads( data['kernel_ids'].tobytes().decode() )
+            hash_array = data['hash_array']
+            offsets = data['offsets']
+            for i, kernel_id in enumerate(kernel_ids):
+                index.Add( hash_array[ offsets[i]:offsets[i+1] ], kernel_id )
+
+        return index
+
+probe_mask_dict = {} # (width, n_bit) -> ProbeMasks(width, n_bit)
+
+# all the integers of width bits with exactly n_bit bits set (xor with a chunk value to probe the values n_bit bits away)
+def ProbeMasks(width, n_bit):
+    if not (width, n_bit) in probe_mask_dict:
+        probe_mask_dict[(width, n_bit)] = [ sum( 1<<b for b in bits ) for bits in itertools.combinations(range(width), n_bit) ]
+    return probe_mask_dict[(width, n_bit)]
+
+# Clone detection without comparing every two hash lists: locality-sensitive bucketing by banded bit sampling. Every band is a random
+# set of band_bits bit positions, and a hash list is put in the bucket (band, hash & band mask) of every one of its hashes for every band,
+# so two hash lists are candidates when one hash of each agrees on all the bits of one band. Two hashes at hamming distance d agree on a
+# band with probability (1-d/64)**band_bits: more bands find more of the close pairs (recall), more bits per band give fewer candidates
+# (speed). Buckets of more than max_bucket hash lists (0 or None: no limit) are skipped: the hashes of kernels are far from uniform, and
+# the hashes of common code (e.g. a paragraph of padding) would make most pairs candidates. With min_shared > 1 a pair must share that
+# many buckets. The candidates are compared exactly, so the result is the pairs within threshold of PairwiseDistanceMatrix(), minus the
+# ones missed by the buckets (python benchmark.py clones measures the recall). Returns [(i, j, distance)], i < j, by distance. Needs numpy.
+def FindClones(hash_lists, threshold, n_band=16, band_bits=32, max_bucket=64, min_shared=1, seed=0):
+    if np is None:
+        raise ImportError('FindClones needs numpy')
+    hash_array, offsets = PackHashLists(hash_lists)
+    if len(offsets) > 1 and np.diff(offsets).min() == 0:
+        raise ValueError('empty hash list')
+    pairs = CandidatePairs(hash_array, offsets, n_band, band_bits, max_bucket, min_shared, seed)
+    hm_dist = PairDistances(hash_array, offsets, pairs)
+    keep = hm_dist <= threshold
+    clones = [ (i, j, hm_dist) for (i, j), hm_dist in zip( pairs[keep].tolist(), hm_dist[keep].tolist() ) ]
+    return sorted( clones, key=lambda p: (p[2],p[0],p[1]) )
+
+# the band masks of FindClones(): n_band random sets of band_bits bit positions (the same ones for the same seed)
+def BandMasks(n_band, band_bits, seed=0):
+    rng = random.Random(seed)
+    return [ sum( 1<<b for b in rng.sample(range(64), band_bits) ) for _ in range(n_band) ]
+
+# candidate pairs of FindClones() among the hash lists packed in (hash_array, offsets) (see PackHashLists()), a numpy int64 array
+# with a row (i, j), i < j, per pair, sorted
+def CandidatePairs(hash_array, offsets, n_band=16, band_bits=32, max_bucket=64, min_shared=1, seed=0):
+    n = len(offsets)-1
+    owner = np.repeat( np.arange(n, dtype=np.int64), np.diff(offsets) ) # hash list of every hash
+    pair_codes = [] # i*n+j of the pairs sharing a bucket, once per bucket
+    for mask in BandMasks(n_band, band_bits, seed):
+        keys = hash_array & np.uint64(mask)
+        order = np.lexsort( (owner, keys) )
+        keys, owners = keys[order], owner[order]
+        # every hash list once per bucket
+        first = np.ones( len(keys), dtype=bool )
+        first[1:] = (keys[1:] != keys[:-1]) | (owners[1:] != owners[:-1])
+        keys, owners = keys[first], owners[first]
+        # buckets of 2 to max_bucket hash lists
+        starts = np.flatnonzero( np.concatenate( ([True], keys[1:] != keys[:-1]) ) )
+        sizes = np.diff( np.append(starts, len(keys)) )
+        kept = (sizes > 1) & (sizes <= (max_bucket or len(keys)))
+        if not kept.any():
+            continue
+        # every element is paired with the next ones of its bucket
+        positions = np.flatnonzero( np.repeat(kept, sizes) )
+        ends = np.repeat( starts[kept]+sizes[kept], sizes[kept] )
+        n_next = ends-positions-1
+        left = np.repeat(positions, n_next)
+        right = np.arange( len(left) ) - np.repeat( np.cumsum(n_next)-n_next, n_next ) + left + 1
+        pair_codes.append( owners[left]*n + owners[right] )
+
+    if not pair_codes:
+        return np.zeros( (0,2), dtype=np.int64 )
+    codes, counts = np.unique( np.concatenate(pair_codes), return_counts=True )
+    codes = codes[counts >= min_shared]
+    return np.stack( (codes//n, codes%n), axis=1 )
+
+# HammingDist64() of every pair (i, j) of pairs (sorted by i, see CandidatePairs()) of the hash lists packed in (hash_array, offsets),
+# a numpy float64 array
+def PairDistances(hash_array, offsets, pairs):
+    hm_dist = np.empty( len(pairs), dtype=np.float64 )
+    lengths = np.diff(offsets)
+    bounds = np.flatnonzero( np.diff( pairs[:,0], prepend=-1, append=-1 ) )
+    for p0, p1 in zip( bounds[:-1].tolist(), bounds[1:].tolist() ):
+        i = pairs[p0,0]
+        others = pairs[p0:p1,1]
+        # the hash lists of others packed one after the other
+        sub_offsets = np.zeros( len(others)+1, dtype=np.int64 )
+        np.cumsum( lengths[others], out=sub_offsets[1:] )
+        gather = np.arange( sub_offsets[-1] ) + np.repeat( offsets[others]-sub_offsets[:-1], lengths[others] )
+        hm_dist[p0:p1] = HammingDist64OneToMany( hash_array[ offsets[i]:offsets[i+1] ], hash_array[gather], sub_offsets )
 
-    return count 
+    return hm_dist
+
+# Binary file of many hash lists, opened with mmap: the hash lists are views of the file (numpy arrays, or memoryviews of integers without
+# numpy), so nothing is read or copied until used. They can be given to HammingDist64() and the other comparison functions directly, and
+# PackHashLists(store) returns the arrays of the file, e.g. PairwiseDistanceMatrix(store) or HammingDist64OneToMany(hash_list, *PackHashLists(store)).
+# Format (little-endian): header (magic, version, number of hash lists n, number of hashes, size of the kernel id table, 0 if none),
+# offsets (n+1 int64, hash list i is hashes offsets[i] to offsets[i+1]-1), hashes (uint64), then the optional kernel id table:
+# id offsets (n+1 int64) and the UTF-8 ids concatenated.
+class FingerprintStore:
+    header = struct.Struct('<4sIQQQ')
+    magic = b'KPHS'
+    version = 1
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name,'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < self.header.size or self.mmap[:4] != self.magic:
+            self.mmap.close()
+            raise ValueError('%s is not a fingerprint store' % file_name)
+        magic, version, n, n_hash, id_size = self.header.unpack_from(self.mmap, 0)
+        if version != self.version:
+            self.mmap.close()
+            raise ValueError('%s: fingerprint store version %d is not supported' % (file_name, version))
+        pos = self.header.size
+        self.offsets = self.View(pos, n+1, 'q')
+        pos += 8*(n+1)
+        self.hash_array = self.View(pos, n_hash, 'Q')
+        pos += 8*n_hash
+        if id_size:
+            self.id_offsets = self.View(pos, n+1, 'q')
+            self.id_start = pos + 8*(n+1)
+        else:
+            self.id_offsets = None
+        self.id_dict = None
+
+    # count items of the file from byte pos, typecode 'q' (int64) or 'Q' (uint64)
+    def View(self, pos, count, typecode):
+        if np is not None:
+            return np.frombuffer(self.mmap, dtype='<i8' if typecode == 'q' else '<u8', count=count, offset=pos)
+        view = memoryview(self.mmap)[pos:pos+8*count]
+        if sys.byteorder == 'little':
+            return view.cast(typecode)
+        items = array.array(typecode) # a copy on big-endian
+        items.frombytes(view)
+        items.byteswap()
+        return items
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    # hash list i, a view of the file
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError('fingerprint store index out of range')
+        i %= len(self)
+        return self.hash_array[ self.offsets[i]:self.offsets[i+1] ]
+
+    # kernel id of hash list i (its index as a string if the store has no ids)
+    def KernelId(self, i):
+        if self.id_offsets is None:
+            return str(i)
+        return self.mmap[ self.id_start+self.id_offsets[i] : self.id_start+self.id_offsets[i+1] ].decode()
+
+    # index of the first hash list with kernel id, None if not found
+    def Find(self, kernel_id):
+        if self.id_dict == None:
+            self.id_dict = {}
+            for i in range(len(self)-1, -1, -1):
+                self.id_dict[ self.KernelId(i) ] = i
+        return self.id_dict.get(kernel_id)
+
+    # close the file, the hash lists still in use keep it mapped until they are deleted
+    def Close(self):
+        self.offsets = self.hash_array = self.id_offsets = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+
+    # write hash lists (hex strings, integers or numpy arrays) to file_name, with kernel ids (strings) if given
+    @staticmethod
+    def Write(file_name, hash_lists, kernel_ids=None):
+        offsets = array.array('q', [0])
+        hash_array = array.array('Q')
+        for hash_list in hash_lists:
+            if len(hash_list) and isinstance(hash_list[0], str) and set( map(len, hash_list) ) == {16}: # hashes of TextHash64, parsed at once
+                hashes = array.array('Q', bytes.fromhex( ''.join(hash_list) ))
+                if sys.byteorder == 'little':
+                    hashes.byteswap()
+                hash_array.extend(hashes)
+            else:
+                hash_array.extend( HashInt(hash_list) )
+            offsets.append( len(hash_array) )
+        id_table = b''
+        if kernel_ids != None:
+            ids = [ str(kernel_id).encode() for kernel_id in kernel_ids ]
+            if len(ids) != len(offsets)-1:
+                raise ValueError('%d kernel ids for %d hash lists' % (len(ids), len(offsets)-1))
+            id_offsets = array.array('q', [0])
+            for kernel_id in ids:
+                id_offsets.append( id_offsets[-1]+len(kernel_id) )
+            if sys.byteorder != 'little':
+                id_offsets.byteswap()
+            id_table = id_offsets.tobytes() + b''.join(ids)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            hash_array.byteswap()
+
+        # written to a temporary file first, so a store being read is never seen half written
+        tmp_name = '%s.tmp%d' % (file_name, os.getpid())
+        with open(tmp_name,'wb') as f:
+            f.write( FingerprintStore.header.pack(FingerprintStore.magic, FingerprintStore.version, len(offsets)-1, len(hash_array), len(id_table)) )
+            f.write( offsets.tobytes() )
+            f.write( hash_array.tobytes() )
+            f.write( id_table )
+        os.replace(tmp_name, file_name)
+
+# fingerprint of a kernel: {'hash': hash list from PHashGen(), 'text': the text it hashes (UnifiedText), 'io': FindIO() of the AST}
+# None if the hash can not be generated
+def KernelFingerprint(text, textgen=TEXTGEN, phash=PHASH):
+    ast = ASTGen(text, compact=True)
+    text_ast = UnifiedText(ast, textgen)
+    if text_ast == None:
+        return None
+    hash_v = TextPHash(text_ast, phash)
+    if hash_v == -1:
+        return None
+
+    return {'hash': hash_v, 'text': text_ast, 'io': FindIO(ast)}
+
+# key of a kernel in FingerprintCache: digest of the tokens of the text without comments (the AST only depends on them, so changes of
+# comments and whitespace give the same key), the settings and FINGERPRINT_VERSION
+def KernelKey(text, textgen=TEXTGEN, phash=PHASH):
+    import hashlib
+    tokens = TextSplit( StripComments(text) )
+    return hashlib.sha256( '\n'.join( [str(FINGERPRINT_VERSION), textgen, phash] + tokens ).encode() ).hexdigest()
+
+# Persistent cache of KernelFingerprint() results, an SQLite database in cache_dir that several processes can use at the same time.
+# When the total size of the cached values (JSON) is over max_size bytes, the least recently used ones are evicted.
+# hits, misses and evictions count the cache accesses of this object (in this process).
+class FingerprintCache:
+    def __init__(self, cache_dir, max_size=256*1024*1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.file_name = os.path.join(cache_dir, 'fingerprints.sqlite')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = None
+        self.pid = None
+
+    # database connection of this process (a connection can not be used after fork)
+    def Connection(self):
+        if self.pid != os.getpid():
+            import sqlite3
+            self.connection = sqlite3.connect(self.file_name, timeout=60, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL') # no fsync per transaction, a cache can lose its last updates
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fingerprint (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS fingerprint_last_used ON fingerprint (last_used)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+            self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('total_size', 0)")
+            self.pid = os.getpid()
+        return self.connection
+
+    # cached value of key, None if not cached
+    def Get(self, key):
+        connection = self.Connection()
+        row = connection.execute('SELECT value FROM fingerprint WHERE key = ?', (key,)).fetchone()
+        if row == None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        connection.execute('UPDATE fingerprint SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def Put(self, key, value):
+        value_json = json.dumps(value)
+        connection = self.Connection()
+        connection.execute('BEGIN IMMEDIATE') # one writer at a time, total_size stays consistent
+        try:
+            row = connection.execute('SELECT size FROM fingerprint WHERE key = ?', (key,)).fetchone()
+            total_size = connection.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+            total_size += len(value_json) - (row[0] if row else 0)
+            connection.execute('INSERT OR REPLACE INTO fingerprint VALUES (?, ?, ?, ?)', (key, value_json, len(value_json), time.time()))
+            if total_size > self.max_size:
+                evicted = []
+                for old_key, size in connection.execute('SELECT key, size FROM fingerprint ORDER BY last_used'):
+                    if total_size <= self.max_size:
+                        break
+                    evicted.append( (old_key,) )
+                    total_size -= size
+                connection.executemany('DELETE FROM fingerprint WHERE key = ?', evicted)
+                self.evictions += len(evicted)
+            connection.execute("UPDATE meta SET value = ? WHERE name = 'total_size'", (total_size,))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+    # KernelFingerprint(text, textgen, phash), from the cache if possible
+    def Fingerprint(self, text, textgen=TEXTGEN, phash=PHASH):
+        with Stage('cache'):
+            key = KernelKey(text, textgen, phash)
+            value = self.Get(key)
+        if value == None:
+            value = KernelFingerprint(text, textgen, phash)
+            if value != None:
+                with Stage('cache'):
+                    self.Put(key, value)
+        return value
+
+    # counters of this object, and the number of entries and total size of the cache
+    def Stats(self):
+        connection = self.Connection()
+        entries = connection.execute('SELECT COUNT(*) FROM fingerprint').fetchone()[0]
+        total_size = connection.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': entries, 'size': total_size}
+
+    def Close(self):
+        if self.connection != None and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+        self.pid = None
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit( main(sys.argv[1:]) )
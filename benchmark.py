@@ -0,0 +1,1100 @@
+#! /usr/bin/env python3
+""" Micro-benchmarks of KernelPHash. Usage: python benchmark.py [benchmark name ...] (run all if no name is given, exit status 1 if a check fails)
+    python benchmark.py suite [--save FILE] [--compare FILE] runs the reproducible suite on synthetic kernels against a baseline
+    python benchmark.py service [--requests N] [--concurrency C] is a load generator of python KernelPHash.py --serve """
+import KernelPHash as kph
+import os, sys, re, io, glob, time, random, tracemalloc, gc, subprocess, tempfile, json, hashlib, platform, argparse, contextlib, asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# read all kernels in test_cases/
+def TestCases():
+    kernel_list = []
+    for file_name in sorted( glob.glob('test_cases/*.txt') ):
+        with open(file_name,'r') as f:
+            kernel_list.append( (file_name, f.read()) )
+
+    return kernel_list
+
+# a failed check of a benchmark: the optimized code does not give the result of the code it replaces (main() exits with status 1)
+class CheckError(Exception):
+    pass
+
+# run func() repeatedly for at least min_time seconds, return the average time of one call in seconds
+def TimeIt(func, min_time=0.2):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed/n
+
+# the splitter used by ASTGen before TextSplit(): whitespace and ';' first, then one re.split per operator over the whole list
+def LegacySplit(text_real):
+    text_s = re.split(r'\s+',text_real)
+    text_s = map( lambda p: re.split(r'(;)',p), text_s )
+    text_s = sum(text_s,[])
+    text_s = list(filter(lambda p: p!='', text_s) )
+    return kph.OperatorSplit(text_s)
+
+def BenchTokenizer():
+    kernel_list = TestCases()
+    # the concatenation of all test cases repeated, to measure the throughput on a large kernel
+    big_kernel = ('\n'.join(txt for _, txt in kernel_list))*50
+    kernel_list.append( ('all test cases x50', big_kernel) )
+
+    print('%-24s %8s %14s %14s %8s' % ('tokenizer','tokens','legacy(us)','TextSplit(us)','speedup'))
+    for name, txt in kernel_list:
+        text_s = kph.TextSplit(txt)
+        if text_s != LegacySplit(txt):
+            raise CheckError('TextSplit() and the legacy splitter disagree on '+name)
+        t_legacy = TimeIt(lambda: LegacySplit(txt))
+        t_new = TimeIt(lambda: kph.TextSplit(txt))
+        print('%-24s %8d %14.1f %14.1f %7.1fx' % (name[-24:], len(text_s), t_legacy*1e6, t_new*1e6, t_legacy/t_new))
+
+# synthetic expression with n_leaf operands (variables, constants and arrays), as a balanced tree of binary operators with brackets
+def SynExpr(n_leaf, rng):
+    if n_leaf == 1:
+        return rng.choice( [ ['a'], ['tmp_real'], ['0.5'], ['sample','[','i',']','[','0',']'], ['x','[','i','+','8',']'] ] )
+    left = SynExpr(n_leaf//2, rng)
+    right = SynExpr(n_leaf-n_leaf//2, rng)
+    op = rng.choice( ['+','-','*','/','%','<<','>>','<','==','&','^','|','&&','||'] )
+    return ['(']+left+[op]+right+[')']
+
+# synthetic assignment statement (list of tokens) with about n_token tokens
+def SynStatement(n_token, seed=0):
+    rng = random.Random(seed)
+    return ['y','[','i',']','=']+SynExpr( max(1,n_token//5), rng )
+
+def BenchAssignParser():
+    print('%-24s %8s %14s %14s' % ('AssignSyntaxRule','tokens','time(us)','ns/token'))
+    for n_token in [10,100,1000,10000]:
+        text_list = SynStatement(n_token)
+        t = TimeIt(lambda: kph.AssignSyntaxRule(text_list))
+        print('%-24s %8d %14.1f %14.1f' % ('synthetic statement', len(text_list), t*1e6, t*1e9/len(text_list)))
+
+    for name, txt in TestCases():
+        statement_list = [ st.split() for st in re.findall(r'([^;{}]*=[^;{}]*);', re.sub(r'for\s*\(.*?\)','',txt)) ]
+        t = TimeIt(lambda: [ kph.AssignSyntaxRule( kph.TextSplit(' '.join(st)) ) for st in statement_list ])
+        n_token = sum( len(kph.TextSplit(' '.join(st))) for st in statement_list )
+        print('%-24s %8d %14.1f %14.1f' % (name[-24:], n_token, t*1e6, t*1e9/max(1,n_token)))
+
+# kernels nested depth levels deep, as (name, kernel text, expected DFS pre-order, expected DFS post-order)
+def DeepKernels(depth):
+    return [
+        ( 'nested for', 'for(i=0;i<n;i++){'*depth+' a = b; '+'}'*depth,
+          'for BLOCK '*depth+'= Var(a) Var(b)', 'Var(a) Var(b) ='+' BLOCK for'*depth ),
+        ( 'if else chain', 'if (c) a = b; else '*depth+'a = b;',
+          'if Var(c) = Var(a) Var(b) '*depth+'= Var(a) Var(b)', 'Var(c) Var(a) Var(b) = '*depth+'Var(a) Var(b) ='+' if'*depth ),
+        ( 'nested brackets', 'a = '+'( '*depth+'b'+' )'*depth+';',
+          '= Var(a) Var(b)', 'Var(a) Var(b) =' ),
+        ( 'expression chain', 'a = '+' - '.join(['b']*depth)+';',
+          '= Var(a) '+'- '*(depth-1)+' '.join(['Var(b)']*depth), 'Var(a) Var(b)'+' Var(b) -'*(depth-1)+' =' ),
+    ]
+
+def BenchDeepKernel(depth=5000):
+    print('%-24s %8s %14s %14s' % ('deep kernels','depth','ASTGen(ms)','PHashGen(ms)'))
+    for name, txt, text_pre, text_post in DeepKernels(depth):
+        start = time.perf_counter()
+        ast = kph.ASTGen(txt)
+        t_ast = time.perf_counter() - start
+        if kph.TextGenDFS(ast,order='pre') != text_pre or kph.TextGenDFS(ast,order='post') != text_post:
+            raise CheckError('wrong DFS traversal of '+name)
+        kph.TextGenBFS(ast)
+        kph.FindIO(ast)
+        start = time.perf_counter()
+        kph.PHashGen(ast)
+        t_hash = time.perf_counter() - start
+        print('%-24s %8d %14.1f %14.1f' % (name, depth, t_ast*1e3, t_hash*1e3))
+
+# return (result of func(), memory allocated by func() and still used after it returns, in bytes)
+def MemoryUse(func):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    result = func()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return (result, used)
+
+def BenchCompactAST():
+    big_kernel = ('\n'.join(txt for _, txt in TestCases()))*50
+    print('%-24s %8s %12s %12s %12s %12s' % ('AST of test cases x50','nodes','memory(KB)','ASTGen(ms)','preorder(ms)','BFS(ms)'))
+    for name, compact in [('anytree node list',False), ('CompactAST',True)]:
+        ast, used = MemoryUse(lambda: kph.ASTGen(big_kernel, compact=compact))
+        t_ast = TimeIt(lambda: kph.ASTGen(big_kernel, compact=compact))
+        t_dfs = TimeIt(lambda: kph.TextGenDFS(ast))
+        t_bfs = TimeIt(lambda: kph.TextGenBFS(ast))
+        print('%-24s %8d %12.1f %12.1f %12.1f %12.1f' % (name, len(ast), used/1024, t_ast*1e3, t_dfs*1e3, t_bfs*1e3))
+
+# AST node names and hash lists of a kernel
+def Fingerprint(txt):
+    ast = kph.ASTGen(txt)
+    return ( [node.name for node in ast], kph.PHashGen(ast,textgen='preorder'), kph.PHashGen(ast,textgen='BFS') )
+
+# check that ASTGen/PHashGen give the same results from a thread pool, and that memory stays flat over many parses
+max_reentrant_growth = 64*1024 # bytes, memory growth of the repeated parses of BenchReentrant() (the caches of the parser are bounded)
+
+def BenchReentrant(n_task=200, n_thread=8, n_parse=5000, n_split=400):
+    kernel_list = [ txt for _, txt in TestCases() ]
+    expected = [ Fingerprint(txt) for txt in kernel_list ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_thread) as pool:
+        results = list( pool.map( lambda i: Fingerprint(kernel_list[i%len(kernel_list)]), range(n_task) ) )
+    elapsed = time.perf_counter() - start
+    n_wrong = sum( 1 for i, result in enumerate(results) if result != expected[i%len(kernel_list)] )
+    print('%d ASTGen+PHashGen on %d threads: %.1f ms, %d wrong result(s)' % (n_task, n_thread, elapsed*1e3, n_wrong))
+    if n_wrong:
+        raise CheckError('%d wrong result(s) of ASTGen+PHashGen from threads' % n_wrong)
+
+    # a tiny operator run cache, cleared all the time by the other threads (switching threads as often as possible)
+    rng = random.Random(0)
+    texts = [ ' '.join( 'a'+''.join( rng.choice(kph.operator_chars) for _ in range(rng.randint(2,4)) ) for _ in range(50) ) for _ in range(n_split) ]
+    expected = [ kph.TextSplit(text) for text in texts ]
+    run_size = kph.operator_run_size
+    switch_interval = sys.getswitchinterval()
+    kph.operator_run_size = 4
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=n_thread) as pool:
+            results = list( pool.map(kph.TextSplit, texts) )
+    finally:
+        sys.setswitchinterval(switch_interval)
+        kph.operator_run_size = run_size
+        kph.operator_run_dict.clear()
+    n_wrong = sum( 1 for result, tokens in zip(results, expected) if result != tokens )
+    print('%d TextSplit on %d threads with a cache of 4 operator runs: %d wrong result(s)' % (n_split, n_thread, n_wrong))
+    if n_wrong:
+        raise CheckError('%d wrong result(s) of TextSplit from threads' % n_wrong)
+
+    tracemalloc.start()
+    for i in range(n_parse):
+        kph.ASTGen(kernel_list[i%len(kernel_list)])
+        if i == n_parse//10:
+            gc.collect() # anytree nodes are freed by the garbage collector (parent/children cycles)
+            mem_start = tracemalloc.get_traced_memory()[0]
+    gc.collect()
+    mem_end = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('memory growth from parse %d to parse %d: %.1f KB' % (n_parse//10, n_parse, (mem_end-mem_start)/1024))
+    if mem_end-mem_start > max_reentrant_growth:
+        raise CheckError('memory grew by %.1f KB from parse %d to parse %d (limit %.1f KB)' % ((mem_end-mem_start)/1024, n_parse//10, n_parse, max_reentrant_growth/1024))
+
+# TextGenDFS() and TextGenBFS() before they emitted label lists: string += and re.sub() at every node, a list as the BFS queue
+def LegacyTextGenDFS(node_list, order='pre'):
+    text = ''
+    stack = [ (node_list[0],False) ]
+    while stack:
+        node, visited = stack.pop()
+        if visited or order=='pre':
+            text += ( ' '+re.sub(r'\{[\d]+\}','',node.name) )
+        if visited:
+            continue
+        if order=='post':
+            stack.append( (node,True) )
+        for child_node in reversed(node.children):
+            stack.append( (child_node,False) )
+
+    return text[1:]
+
+def LegacyTextGenBFS(node_list):
+    text = ''
+    queue_b = [ node_list[0] ]
+    while bool( queue_b ):
+        text += ( ' '+re.sub(r'\{[\d]+\}','',queue_b[0].name) )
+        for child_node in queue_b[0].children:
+            queue_b.append(child_node)
+        del queue_b[0]
+
+    return text[1:]
+
+def BenchTraversal(n_copy=300):
+    big_kernel = ('\n'.join(txt for _, txt in TestCases()))*n_copy
+    node_list = kph.ASTGen(big_kernel)
+    compact_ast = kph.ASTGen(big_kernel, compact=True)
+    print('%d-node AST' % len(node_list))
+    print('%-24s %14s %14s %14s' % ('traversal (ms)','legacy','node list','CompactAST'))
+    for name, legacy_func, func in [ ('DFS pre-order', lambda ast: LegacyTextGenDFS(ast,'pre'), lambda ast: kph.TextGenDFS(ast,'pre')),
+                                     ('DFS post-order', lambda ast: LegacyTextGenDFS(ast,'post'), lambda ast: kph.TextGenDFS(ast,'post')),
+                                     ('BFS', LegacyTextGenBFS, kph.TextGenBFS) ]:
+        text = legacy_func(node_list)
+        if func(node_list) != text or func(compact_ast) != text:
+            raise CheckError('wrong %s traversal' % name)
+        print('%-24s %14.1f %14.1f %14.1f' % (name, TimeIt(lambda: legacy_func(node_list))*1e3, TimeIt(lambda: func(node_list))*1e3, TimeIt(lambda: func(compact_ast))*1e3))
+    print('%-24s %14s %14.1f %14.1f' % ('VarList', '', TimeIt(lambda: kph.VarList(node_list))*1e3, TimeIt(lambda: kph.VarList(compact_ast))*1e3))
+
+# HammingDist64() before hashes were compared as integers: both hashes to 64-character binary strings, compared character by character
+def LegacyHammingDist64(hash_list1, hash_list2):
+    def OneSide(hash_list1, hash_list2):
+        min_hamming_dist_list = []
+        for hash1 in hash_list1:
+            hm_dist_min = 64
+            for hash2 in hash_list2:
+                hash1_b = '{0:064b}'.format(int(hash1,16))
+                hash2_b = '{0:064b}'.format(int(hash2,16))
+                cur_hm_dist = sum( 1 for i in range(64) if hash1_b[i] != hash2_b[i] )
+                if cur_hm_dist==0:
+                    hm_dist_min = 0
+                    break
+                elif cur_hm_dist < hm_dist_min:
+                    hm_dist_min = cur_hm_dist
+            min_hamming_dist_list.append(hm_dist_min)
+        return sum(min_hamming_dist_list)/len(min_hamming_dist_list)
+
+    return ( OneSide(hash_list1,hash_list2)+OneSide(hash_list2,hash_list1) )/2
+
+# n random hash lists of 32 64-bit hashes (hex strings), derived from a few base hashes so that they are similar
+def RandomHashLists(n, seed=0, n_hash=32):
+    rng = random.Random(seed)
+    base_list = [ rng.getrandbits(64) for _ in range(64) ]
+    return [ [ '%016x' % ( rng.choice(base_list) ^ (rng.getrandbits(64) & rng.getrandbits(64) & rng.getrandbits(64)) ) for _ in range(n_hash) ] for _ in range(n) ]
+
+def BenchHamming():
+    hash_lists = [ kph.PHashGen(kph.ASTGen(txt)) for _, txt in TestCases() ] + RandomHashLists(5)
+    pairs = [ (h1,h2) for h1 in hash_lists for h2 in hash_lists ]
+    expected = [ LegacyHammingDist64(h1,h2) for h1, h2 in pairs ]
+    np_module = kph.np
+    print('%-24s %8s %14s' % ('HammingDist64','pairs','us/pair'))
+    print('%-24s %8d %14.1f' % ('legacy', len(pairs), TimeIt(lambda: [ LegacyHammingDist64(h1,h2) for h1, h2 in pairs ])*1e6/len(pairs)))
+    for name, module in [('pure python',None), ('numpy',np_module)]:
+        if name == 'numpy' and module is None:
+            continue
+        kph.np = module
+        try:
+            if [ kph.HammingDist64(h1,h2) for h1, h2 in pairs ] != expected:
+                raise CheckError('wrong HammingDist64 with '+name)
+            print('%-24s %8d %14.1f' % (name, len(pairs), TimeIt(lambda: [ kph.HammingDist64(h1,h2) for h1, h2 in pairs ])*1e6/len(pairs)))
+        finally:
+            kph.np = np_module
+
+def BenchPairwise(n=2000):
+    if kph.np is None:
+        print('pairwise benchmark needs numpy')
+        return
+    hash_lists = RandomHashLists(n)
+    rng = random.Random(1)
+    sample_pairs = [ (rng.randrange(n), rng.randrange(n)) for _ in range(1000) ]
+    t_pair = TimeIt(lambda: [ kph.HammingDist64(hash_lists[i],hash_lists[j]) for i, j in sample_pairs ])/len(sample_pairs)
+    start = time.perf_counter()
+    hm_matrix = kph.PairwiseDistanceMatrix(hash_lists)
+    t_matrix = time.perf_counter() - start
+    if any( hm_matrix[i,j] != kph.HammingDist64(hash_lists[i],hash_lists[j]) for i, j in sample_pairs ):
+        raise CheckError('PairwiseDistanceMatrix differs from HammingDist64')
+    print('%d x %d matrix: PairwiseDistanceMatrix %.2f s, HammingDist64 on every pair %.2f s (estimated)' % (n, n, t_matrix, t_pair*n*n))
+
+# n fingerprints in clusters: each is a random cluster center with a few bits of every hash flipped
+def ClusteredHashLists(n, n_cluster, seed=0, n_hash=32, n_flip=3):
+    rng = random.Random(seed)
+    centers = [ [ rng.getrandbits(64) for _ in range(n_hash) ] for _ in range(n_cluster) ]
+    def Perturb(hash_list):
+        return [ h ^ (1<<rng.randrange(64)) ^ (1<<rng.randrange(64)) if rng.random() < n_flip/2 else h for h in hash_list ]
+    return [ Perturb(rng.choice(centers)) for _ in range(n) ], centers, Perturb
+
+def BenchIndex(n=100000, n_query=50, k=5):
+    if kph.np is None:
+        print('index benchmark needs numpy')
+        return
+    hash_lists, centers, Perturb = ClusteredHashLists(n, n//20)
+    start = time.perf_counter()
+    index = kph.HashIndex()
+    for hash_list in hash_lists:
+        index.Add(hash_list)
+    t_build = time.perf_counter() - start
+    hash_array, offsets = kph.PackHashLists(hash_lists)
+    rng = random.Random(1)
+    queries = [ Perturb(rng.choice(centers)) for _ in range(n_query) ]
+
+    start = time.perf_counter()
+    truth = []
+    for query in queries:
+        hm_dist = kph.HammingDist64OneToMany(query, hash_array, offsets).tolist()
+        truth.append( sorted( range(n), key=lambda i: (hm_dist[i],i) )[:k] )
+    t_brute = (time.perf_counter() - start)/n_query
+    print('%d fingerprints, top-%d of %d queries: index build %.1f s, brute force %.1f ms/query' % (n, k, n_query, t_build, t_brute*1e3))
+    for label, options in [ ('exact', {}), ('approximate (no probe bit)', {'max_probe_bits':0, 'exact':False}) ]:
+        start = time.perf_counter()
+        results = [ index.Query(query, k=k, **options) for query in queries ]
+        t_query = (time.perf_counter() - start)/n_query
+        recall = sum( len( set(truth[q]).intersection( i for i, _ in results[q] ) ) for q in range(n_query) )/(k*n_query)
+        print('  HashIndex %s: %.1f ms/query, recall %.3f' % (label, t_query*1e3, recall))
+
+    # Save() and Load() with the same name, without the .npz extension
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'index')
+        start = time.perf_counter()
+        index.Save(file_name)
+        t_save = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = kph.HashIndex.Load(file_name)
+        t_load = time.perf_counter() - start
+        if os.listdir(tmp_dir) != ['index'] or [ loaded.Query(query, k=k) for query in queries ] != [ index.Query(query, k=k) for query in queries ]:
+            raise CheckError('HashIndex.Load() does not give the index saved by HashIndex.Save()')
+    print('  save %.1f s, load %.1f s' % (t_save, t_load))
+
+# the text PHashGen() hashes with phash='pHashlib'
+def PHashInput(node_list, textgen):
+    text_ast = kph.UnifyNaming( kph.TextGenBFS(node_list) if textgen == 'BFS' else kph.TextGenDFS(node_list, order=textgen[:-5]) )
+    i = 1
+    while len(text_ast) < 500:
+        text_ast += text_ast
+        i += 1
+    return text_ast + ('101'*i + ' 5656 '*(i>4 and i<8) + '7878'*(i>8 and i<16) + '9090'*(i>16))
+
+# the hashes of text by pHash/text_hash.exe, the way PHashGen() used to run it (a temporary directory instead of pHash/)
+def LegacyTextHashExe(text):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir,'text_ast'),'w') as f:
+            f.write(text)
+        env = dict( os.environ, LD_LIBRARY_PATH=os.path.abspath('pHash/src') )
+        ret = subprocess.run( [os.path.abspath('pHash/text_hash.exe'), 'text_ast'], cwd=tmp_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+        if ret.returncode != 0:
+            return -1
+        with open(os.path.join(tmp_dir,'hash'),'r') as f:
+            return f.read().splitlines()
+
+def BenchPHashText(n_kernel=120, n_random=150):
+    os.chmod('pHash/text_hash.exe', 0o744) # not executable in the repository
+    texts = [ PHashInput( kph.ASTGen(kernel_txt), textgen ) for _, kernel_txt in TestCases() for textgen in ['preorder','postorder','BFS'] ]
+    # checked on more texts: SynKernel() kernels, and random texts of letters, digits and skipped characters (too short ones included)
+    rng = random.Random(0)
+    check_texts = texts + [ PHashInput( kph.ASTGen( SynKernel(rng.randint(1,30), 3, 0.2, seed), compact=True ), textgen )
+                            for seed in range(n_kernel) for textgen in ['preorder','postorder','BFS'] ]
+    check_texts += [ ''.join( rng.choice('abcXYZ0189 ()+=;_\n-') for _ in range(rng.randint(40,3000)) ) for _ in range(n_random) ]
+    for text in check_texts:
+        hash_v = kph.PHashText(text)
+        if (hash_v or -1) != LegacyTextHashExe(text): # text_hash.exe fails on a too short text
+            raise CheckError('PHashText differs from text_hash.exe on %r' % text[:80])
+    t_new = TimeIt(lambda: [ kph.PHashText(text) for text in texts ])
+    t_old = TimeIt(lambda: [ LegacyTextHashExe(text) for text in texts ], min_time=1)
+    print('%d texts checked, %d test_cases texts: PHashText %.2f ms, text_hash.exe %.1f ms (%.0fx)' % (len(check_texts), len(texts), t_new*1e3, t_old*1e3, t_old/t_new))
+
+def BenchTextHash64(n_copy=20):
+    texts = [ kph.UnifyNaming( kph.TextGenDFS( kph.ASTGen(kernel_txt) ) ) for _, kernel_txt in TestCases() ]
+    texts.append( ' '.join(texts)*n_copy )
+    legacy = lambda text: sum( ( kph.TextHash64_real('dummy '*i+text) for i in range(8) ), [] )
+    for text in texts:
+        if kph.TextHash64_prefixes(text) != legacy(text):
+            raise CheckError('TextHash64_prefixes differs from TextHash64_real')
+    for label, text in [ ('test_cases (each)', texts[:-1]), ('all test_cases x %d' % n_copy, texts[-1:]) ]:
+        t_old = TimeIt(lambda: [ legacy(p) for p in text ])
+        t_new = TimeIt(lambda: [ kph.TextHash64_prefixes(p) for p in text ])
+        print('%s: 8 prefixes by TextHash64_real %.2f ms, TextHash64_prefixes %.2f ms (%.1fx)' % (label, t_old*1e3, t_new*1e3, t_old/t_new))
+
+# the hash list reduction TextHash64() used before ReduceHashList()
+def LegacyReduceHashList(hash_list):
+    target_hd = 0
+    while(len(hash_list)>32):
+        hashl_len = len(hash_list)
+        delete_list = [False]*hashl_len
+        for i in range(hashl_len):
+            if delete_list[i]:
+                continue
+            if delete_list.count(False)<32:
+                continue
+            for j in range(i+1,hashl_len):
+                if kph.HammingDist64_real(hash_list[i],hash_list[j]) == target_hd:
+                    delete_list[j] = True
+        hash_list = [ p for p, d in zip(hash_list,delete_list) if not d ]
+        target_hd += 1
+    return hash_list
+
+max_reduce_memory = 256*2**20 # bytes, peak memory of ReduceHashList() on the large kernel of BenchReduceHashList()
+
+def BenchReduceHashList(n_random=300):
+    # randomized check on hash lists with many close hashes
+    rng = random.Random(0)
+    for _ in range(n_random):
+        bases = [ rng.getrandbits(64) for _ in range(rng.randint(1,40)) ]
+        hash_list = [ '%016x' % (rng.choice(bases) ^ (1<<rng.randrange(64))*(rng.random()<0.5)) for _ in range(rng.randint(0,300)) ]
+        if kph.ReduceHashList(hash_list) != LegacyReduceHashList(hash_list):
+            raise CheckError('ReduceHashList differs from the old reduction')
+    text = ' '.join( kph.UnifyNaming( kph.TextGenDFS( kph.ASTGen(kernel_txt) ) ) for _, kernel_txt in TestCases() )
+    random_text = ' '.join( ''.join( rng.choice('abcdefghij()+=') for _ in range(rng.randint(1,12)) ) for _ in range(1000) )
+    for label, text_in in [ ('test_cases x 5', text*5), ('test_cases x 20', text*20), ('random text', random_text) ]:
+        hash_list = sum( ( kph.TextHash64_real('dummy '*i+text_in) for i in range(8) ), [] )
+        if kph.ReduceHashList(hash_list) != LegacyReduceHashList(hash_list):
+            raise CheckError('ReduceHashList differs from the old reduction')
+        t_old = TimeIt(lambda: LegacyReduceHashList(hash_list))
+        t_new = TimeIt(lambda: kph.ReduceHashList(hash_list))
+        print('%s, %d raw hashes (%d different): old reduction %.1f ms, ReduceHashList %.1f ms (%.0fx)' % (label, len(hash_list), len(set(hash_list)), t_old*1e3, t_new*1e3, t_old/t_new))
+
+    if kph.np is None:
+        return
+    # the same reduction with the distances computed again by blocks of rows instead of kept in a matrix
+    matrix_size = kph.reduce_matrix_size
+    kph.reduce_matrix_size = 0
+    try:
+        if kph.ReduceHashList(hash_list) != LegacyReduceHashList(hash_list):
+            raise CheckError('ReduceHashList without the distance matrix differs from the old reduction')
+    finally:
+        kph.reduce_matrix_size = matrix_size
+    # a large kernel (too slow for the old reduction): the memory must not grow with the square of the number of hashes
+    text_in = kph.UnifiedText( kph.ASTGen( SynKernel(600, 3, 0.2, 0), compact=True ) )
+    hash_list = kph.TextHash64_prefixes(text_in, 8)
+    start = time.perf_counter()
+    peak = PeakMemory(lambda: kph.ReduceHashList(hash_list))
+    t_new = time.perf_counter() - start
+    print('SynKernel(600), %d raw hashes (%d different): ReduceHashList %.1f s, peak memory %.1f MB' % (len(hash_list), len(set(hash_list)), t_new, peak/2**20))
+    if peak > max_reduce_memory:
+        raise CheckError('ReduceHashList used %.1f MB on %d hashes (limit %.1f MB)' % (peak/2**20, len(hash_list), max_reduce_memory/2**20))
+
+def BenchCache():
+    kernels = [ kernel_txt for _, kernel_txt in TestCases() ]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = kph.FingerprintCache(cache_dir)
+        for kernel_txt in kernels:
+            if cache.Fingerprint(kernel_txt) != kph.KernelFingerprint(kernel_txt):
+                raise CheckError('cached fingerprint differs from KernelFingerprint')
+        t_miss = TimeIt(lambda: [ kph.KernelFingerprint(kernel_txt) for kernel_txt in kernels ])
+        t_hit = TimeIt(lambda: [ cache.Fingerprint(kernel_txt) for kernel_txt in kernels ])
+        cache.Close()
+    print('%d kernels: KernelFingerprint %.2f ms, FingerprintCache hit %.2f ms (%.0fx)' % (len(kernels), t_miss*1e3, t_hit*1e3, t_miss/t_hit))
+
+# an unrolled FFT-like kernel: n butterflies, the same statements with different indices
+def UnrolledKernel(n):
+    lines = []
+    for k in range(n):
+        i, j, w = 2*k, 2*k+n, k % 16
+        lines += [ 'tmp_real = sample[%d][0]*w_real[%d] - sample[%d][1]*w_imag[%d];' % (j, w, j, w),
+                   'tmp_imag = sample[%d][1]*w_real[%d] + sample[%d][0]*w_imag[%d];' % (j, w, j, w),
+                   'sample[%d][0] = sample[%d][0] - tmp_real;' % (j, i),
+                   'sample[%d][1] = sample[%d][1] - tmp_imag;' % (j, i),
+                   'sample[%d][0] += tmp_real;' % i,
+                   'sample[%d][1] += tmp_imag;' % i ]
+    return 'for(s=0;s<%d;s++){\n%s\n}' % (n, '\n'.join(lines))
+
+# peak memory allocated while running func()
+def PeakMemory(func):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - start
+    tracemalloc.stop()
+    return peak
+
+def BenchStatementCache(n=2000):
+    # a kernel without repeated statements: every statement is a miss of the cache
+    kernels = [ kernel_txt for _, kernel_txt in TestCases() ] + [ SynKernel(400, 3, 0.0, 0), UnrolledKernel(n) ]
+    cache_size = kph.statement_cache_size
+    results = []
+    for size in [0, cache_size]:
+        kph.statement_cache_size = size
+        kph.StatementCacheClear()
+        results.append( [ kph.TextGenDFS( kph.ASTGen(kernel_txt) ) for kernel_txt in kernels ] )
+    if results[0] != results[1]:
+        kph.statement_cache_size = cache_size
+        raise CheckError('ASTs differ with the statement cache')
+    for label, kernel_list in [ ('test_cases', kernels[:-2]), ('SynKernel, no repeats', kernels[-2:-1]), ('unrolled, %d statements' % (6*n), kernels[-1:]) ]:
+        for compact in [True, False]:
+            timing = []
+            for size in [0, cache_size]:
+                kph.statement_cache_size = size
+                def Parse():
+                    kph.StatementCacheClear() # only the statements of the same kernel are reused
+                    return [ kph.ASTGen(kernel_txt, compact) for kernel_txt in kernel_list ]
+                timing.append( (TimeIt(Parse), PeakMemory(Parse)) )
+            (t_old, m_old), (t_new, m_new) = timing
+            print('%s, %s: no cache %.1f ms %.0f KB, statement cache %.1f ms %.0f KB (%.1fx)' % (label, 'CompactAST' if compact else 'anytree',
+                  t_old*1e3, m_old/1024, t_new*1e3, m_new/1024, t_old/t_new))
+    kph.statement_cache_size = cache_size
+    kph.StatementCacheClear()
+    kph.ASTGen(kernels[-1], True)
+    print('statement cache after the unrolled kernel:', kph.StatementCacheInfo())
+
+# UnifyNaming() before the single-pass renaming: one str.replace() over the whole text per distinct name
+def LegacyUnifyNaming(text):
+    var_list = list(dict.fromkeys( re.findall(r'Var\(.+?\)',text) ))
+    arr_list = list(dict.fromkeys( re.findall(r'Arr\(.+?\)',text) ))
+    new_text = text
+    for i, var in enumerate(var_list):
+        new_text = new_text.replace(var,'Var('+str(i)*3+')')
+    for i, arr in enumerate(arr_list):
+        new_text = new_text.replace(arr,'Arr('+str(i)*3+')')
+    return new_text
+
+# a kernel with n_name distinct variables and arrays
+def ManyNamesKernel(n_name):
+    return '\n'.join( 'v%d = a%d[i] * v%d + c%d;' % (k, k % (n_name//2), (k*7) % n_name, k) for k in range(n_name) )
+
+def BenchUnifyNaming():
+    # canonical output, and a text in which a new name ('Var(000)') is also an original name
+    for text, expected in [ ('Root = Var(x) + Arr(y) [ ] Var(i) Var(x) Arr(z) Var(i)', 'Root = Var(000) + Arr(000) [ ] Var(111) Var(000) Arr(111) Var(111)'),
+                            ('Var(a) Var(000) Var(a)', 'Var(000) Var(111) Var(000)') ]:
+        if kph.UnifyNaming(text) != expected:
+            raise CheckError('UnifyNaming(%r) = %r, expected %r' % (text, kph.UnifyNaming(text), expected))
+    print('%-16s %8s %12s %14s %8s' % ('kernel','names','legacy(ms)','single pass(ms)','speedup'))
+    kernels = [ (name, txt) for name, txt in TestCases() ] + [ ('%d names' % n, ManyNamesKernel(n)) for n in [100, 1000] ]
+    for name, txt in kernels:
+        text = kph.TextGenDFS( kph.ASTGen(txt, compact=True) )
+        if kph.UnifyNaming(text) != LegacyUnifyNaming(text):
+            raise CheckError('UnifyNaming() and the legacy renaming disagree on '+name)
+        n_name = len(set( re.findall(r'(?:Var|Arr)\(.+?\)',text) ))
+        t_legacy = TimeIt(lambda: LegacyUnifyNaming(text))
+        t_new = TimeIt(lambda: kph.UnifyNaming(text))
+        print('%-16s %8d %12.2f %14.2f %7.1fx' % (name[-16:], n_name, t_legacy*1e3, t_new*1e3, t_legacy/t_new))
+
+# small edits of a kernel of about n_line lines: (name, new text)
+def KernelEdits(n_line=10000):
+    txt = '\n'.join(txt for _, txt in TestCases())
+    lines = ( '\n'.join( [txt]*(n_line//txt.count('\n')+1) ) ).split('\n')[:n_line]
+    mid = next( k for k in range(len(lines)//2, len(lines)) if 'tmp_real = ' in lines[k] )
+    first = next( k for k in range(len(lines)) if '16' in lines[k] )
+    edits = [ ('change a constant', lines[:mid] + [ lines[mid].replace('+8','+4') ] + lines[mid+1:]),
+              ('insert a statement', lines[:mid] + [ 'tmp_real = tmp_real * 2;' ] + lines[mid:]),
+              ('delete a statement', lines[:mid] + lines[mid+1:]),
+              ('rename a variable', lines[:mid] + [ lines[mid].replace('tmp_real','tmp_new') ] + lines[mid+1:]),
+              ('edit the first loop', [ line.replace('16','32',1) if k == first else line for k, line in enumerate(lines) ]),
+              ('append a statement', lines + [ 'sample[0][0] = 0;' ]) ]
+    return '\n'.join(lines), [ (name, '\n'.join(new_lines)) for name, new_lines in edits ]
+
+def BenchIncremental(n_line=10000):
+    base, edits = KernelEdits(n_line)
+    for textgen in ['preorder','BFS']:
+        print('%d lines, %s: %-20s %10s %14s %10s %8s' % (n_line, textgen, 'edit', 'fresh(ms)', 'incremental(ms)', 'reparsed', 'speedup'))
+        inc = kph.IncrementalPHash(textgen)
+        for name, text in edits:
+            hash_v = kph.PHashGen( kph.ASTGen(text, compact=True), textgen )
+            inc.Update(base)
+            if inc.Update(text) != hash_v:
+                raise CheckError('IncrementalPHash and PHashGen disagree after the edit: '+name)
+            t_fresh = TimeIt(lambda: kph.PHashGen( kph.ASTGen(text, compact=True), textgen ))
+            t_inc = []
+            for _ in range(5):
+                inc.Update(base)
+                start = time.perf_counter()
+                inc.Update(text)
+                t_inc.append( time.perf_counter()-start )
+            print('%-20s %10.1f %14.1f %10d %7.1fx' % (name, t_fresh*1e3, min(t_inc)*1e3, inc.n_parsed, t_fresh/min(t_inc)))
+
+def BenchStore(n=100000, n_file=2000):
+    hash_lists = RandomHashLists(n)
+    kernel_ids = [ 'kernel%d' % i for i in range(n) ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_file = os.path.join(tmp_dir, 'hashes.jsonl')
+        store_file = os.path.join(tmp_dir, 'hashes.kph')
+        def WriteJSON():
+            with open(json_file,'w') as f:
+                for kernel_id, hash_list in zip(kernel_ids, hash_lists):
+                    f.write( json.dumps({'file': kernel_id, 'hash': hash_list})+'\n' )
+        def LoadJSON():
+            with open(json_file,'r') as f:
+                return [ json.loads(line)['hash'] for line in f ]
+        def LoadStore():
+            store = kph.FingerprintStore(store_file)
+            return store, store[n-1]
+        t_write_json = TimeIt(WriteJSON)
+        t_write_store = TimeIt(lambda: kph.FingerprintStore.Write(store_file, hash_lists, kernel_ids))
+        t_load_json = TimeIt(LoadJSON)
+        t_load_store = TimeIt(LoadStore)
+        store = kph.FingerprintStore(store_file)
+        if [ kph.HashInt(store[i]) for i in range(0, n, 997) ] != [ kph.HashInt(hash_lists[i]) for i in range(0, n, 997) ] or store.KernelId(n-1) != kernel_ids[-1]:
+            raise CheckError('wrong hash lists read from the fingerprint store')
+        print('%d hash lists: JSON lines %.1f MB, write %.0f ms, load %.0f ms; FingerprintStore %.1f MB, write %.0f ms, open %.2f ms' % (n,
+              os.path.getsize(json_file)/1e6, t_write_json*1e3, t_load_json*1e3, os.path.getsize(store_file)/1e6, t_write_store*1e3, t_load_store*1e3))
+
+        query = hash_lists[n//2]
+        t_json = TimeIt(lambda: kph.HammingDist64OneToMany( query, *kph.PackHashLists(LoadJSON()) ))
+        t_store = TimeIt(lambda: kph.HammingDist64OneToMany( query, *kph.PackHashLists(kph.FingerprintStore(store_file)) ))
+        print('load + HammingDist64OneToMany: JSON lines %.0f ms, FingerprintStore %.0f ms (%.1fx)' % (t_json*1e3, t_store*1e3, t_json/t_store))
+        store.Close()
+
+        # one kernel per file, against one file of kernels split by '//@kernel' lines
+        kernels = [ ('kernel%d' % i, txt) for i in range(n_file) for _, txt in TestCases()[i % 5 : i % 5 + 1] ]
+        for i, (name, txt) in enumerate(kernels):
+            with open( os.path.join(tmp_dir, '%s.txt' % name), 'w' ) as f:
+                f.write(txt)
+        multi_file = os.path.join(tmp_dir, 'kernels.c')
+        kph.WriteKernels(multi_file, kernels)
+        if kph.ReadKernels(multi_file) != kernels:
+            raise CheckError('ReadKernels() does not read the kernels written by WriteKernels()')
+        def ReadFiles():
+            texts = []
+            for file_name in kph.BatchInputs([tmp_dir], 'kernel*.txt'):
+                with open(file_name,'r') as f:
+                    texts.append( f.read() )
+            return texts
+        t_files = TimeIt(ReadFiles)
+        t_multi = TimeIt(lambda: kph.ReadKernels(multi_file))
+        print('read %d kernels: one file each %.1f ms, one multi-kernel file %.1f ms (%.1fx)' % (n_file, t_files*1e3, t_multi*1e3, t_files/t_multi))
+
+def BenchPipelineStats(n_stage=100000):
+    kernels = [ kernel_txt for _, kernel_txt in TestCases() ]
+    def Fingerprints():
+        return [ kph.PHashGen( kph.ASTGen(kernel_txt, compact=True) ) for kernel_txt in kernels ]
+    def EmptyStages():
+        for _ in range(n_stage):
+            with kph.Stage('none'):
+                pass
+    t_off = TimeIt(Fingerprints)
+    t_stage_off = TimeIt(EmptyStages)/n_stage
+    with kph.CollectStats() as stats:
+        if Fingerprints() != [ kph.PHashGen( kph.ASTGen(kernel_txt, compact=True) ) for kernel_txt in kernels ]:
+            raise CheckError('different hash lists while collecting stats')
+        t_on = TimeIt(Fingerprints)
+        t_stage_on = TimeIt(EmptyStages)/n_stage
+    n_call = sum( stats.calls[stage] for stage in kph.pipeline_stages ) / (stats.counts['kernels']/len(kernels)) # stages per Fingerprints()
+    print('%d kernels: %.2f ms without stats, %.2f ms collecting stats (%+.1f%%)' % (len(kernels), t_off*1e3, t_on*1e3, (t_on/t_off-1)*100))
+    print('one stage: %.0f ns without stats (%.0f stages per run, %.3f%% of the run time), %.0f ns collecting stats' % (t_stage_off*1e9,
+          n_call, n_call*t_stage_off/t_off*100, t_stage_on*1e9))
+
+# TextPHash() before PaddedWindows(): the text doubled until it has limit_low characters, the padding appended, then hashed
+def LegacyTextPHash(text_ast, phash='selfmade'):
+    i = 1
+    limit_low = 80 if phash == 'selfmade' else 500
+    while len(text_ast) < limit_low:
+        text_ast += text_ast
+        i += 1
+    text_ast += ('101'*i + ' 5656 '*(i>4 and i<8) + '7878'*(i>8 and i<16) + '9090'*(i>16))
+    if phash != 'selfmade':
+        return kph.PHashText(text_ast)
+    # the paragraphs of every prefix one prefix at a time
+    windows = kph.TextWindows(text_ast)
+    window_cumsum = kph.WindowCumsum(windows, 8)
+    hash_list = []
+    for i in range(8):
+        hash_list += kph.ParagraphHashes(window_cumsum, 8, i, 0, (i+len(windows))//10 + 1)
+    return kph.ReduceHashList(hash_list, 32)
+
+def BenchPadding():
+    # unified texts of kernels of every size, cut to n characters at a space
+    full_text = kph.UnifiedText( kph.ASTGen( SynKernel(40, 3, 0.0, 1), compact=True ) )
+    texts = [ kph.UnifiedText( kph.ASTGen(src, compact=True) ) for src in ['a;', 'a = b;', 'y = (a*x) + b;'] ]
+    texts += [ full_text[:full_text.rindex(' ', 0, n)] for n in [40, 60, 79, 120, 400, 2000] ]
+    print('%-12s %8s %10s %14s %14s %8s' % ('TextPHash','chars','doublings','legacy(us)','new(us)','speedup'))
+    for text in texts:
+        if kph.TextPHash(text) != LegacyTextPHash(text) or kph.TextPHash(text,'pHashlib') != LegacyTextPHash(text,'pHashlib'):
+            raise CheckError('TextPHash() and the legacy padding disagree on %r' % text)
+        t_legacy = min( TimeIt(lambda: LegacyTextPHash(text), 0.05) for _ in range(5) )
+        t_new = min( TimeIt(lambda: kph.TextPHash(text), 0.05) for _ in range(5) )
+        print('%-12s %8d %10d %14.1f %14.1f %7.2fx' % ('selfmade', len(text), kph.PaddingDoublings(len(text), 80), t_legacy*1e6, t_new*1e6, t_legacy/t_new))
+
+# near-duplicate kernels: n_base SynKernel()s and n_edit copies of them with 1 to 3 constants changed, and their hash lists
+def NearDuplicateHashLists(n_base, n_edit, n_statement=8, seed=0):
+    rng = random.Random(seed)
+    kernel_list = [ SynKernel(n_statement, 2, 0.0, s) for s in range(n_base) ]
+    for _ in range(n_edit):
+        txt = rng.choice(kernel_list[:n_base])
+        for _ in range(rng.randint(1,3)):
+            m = rng.choice( list( re.finditer(r'\b\d+\b', txt) ) )
+            txt = txt[:m.start()]+str(rng.randint(0,99))+txt[m.end():]
+        kernel_list.append(txt)
+    return [ kph.PHashGen( kph.ASTGen(txt, compact=True) ) for txt in kernel_list ]
+
+# FindClones() settings compared to PairwiseDistanceMatrix(): n_band, band_bits, max_bucket
+clone_settings = [ (8,16,64), (16,24,64), (16,32,64), (32,32,64), (16,48,64), (4,48,64), (16,32,0) ]
+
+def BenchClones(threshold=8):
+    if kph.np is None:
+        print('clones benchmark needs numpy')
+        return
+    corpora = [ ('kernels', NearDuplicateHashLists(400, 200)), ('clustered', ClusteredHashLists(2000, 500)[0]) ]
+    print('%-10s %6s %6s %10s %10s %8s %8s %10s %8s' % ('corpus','bands','bits','max_bucket','pairs','cand(%)','recall','time(s)','speedup'))
+    for corpus, hash_lists in corpora:
+        n = len(hash_lists)
+        start = time.perf_counter()
+        hm_matrix = kph.PairwiseDistanceMatrix(hash_lists)
+        t_exhaustive = time.perf_counter() - start
+        rows, cols = kph.np.nonzero( kph.np.triu(hm_matrix <= threshold, 1) )
+        truth = set( zip( rows.tolist(), cols.tolist() ) )
+        print('%-10s %6s %6s %10s %10d %8.1f %8.3f %10.3f %8s' % (corpus,'-','-','-',len(truth),100.0,1.0,t_exhaustive,'1.00x'))
+        hash_array, offsets = kph.PackHashLists(hash_lists)
+        for n_band, band_bits, max_bucket in clone_settings:
+            start = time.perf_counter()
+            clones = kph.FindClones(hash_lists, threshold, n_band, band_bits, max_bucket)
+            t_clones = time.perf_counter() - start
+            found = set( (i,j) for i, j, _ in clones )
+            if not found <= truth or any( abs(hm_matrix[i,j]-hm_dist) > 1e-9 for i, j, hm_dist in clones ):
+                raise CheckError('FindClones() and PairwiseDistanceMatrix() disagree')
+            n_candidate = len( kph.CandidatePairs(hash_array, offsets, n_band, band_bits, max_bucket) )
+            print('%-10s %6d %6d %10d %10d %8.1f %8.3f %10.3f %7.2fx' % (corpus, n_band, band_bits, max_bucket, len(found), 100.0*n_candidate/(n*(n-1)//2),
+                  len(found)/max(len(truth),1), t_clones, t_exhaustive/t_clones))
+
+# time of the stages PHashGenViews() does once for all the views (walk and naming), and of the whole fingerprint
+def BenchViews(n_run=20):
+    textgens = ('preorder','postorder','BFS')
+    shared_stages = ['textgen','unify_naming']
+    print('%-10s %8s %14s %14s %8s %14s %14s %8s' % ('kernel','nodes','3 walks(us)','one walk(us)','speedup','3 PHashGen(us)','PHashGenViews','speedup'))
+    for n_statement in [5, 20, 80]:
+        ast = kph.ASTGen( SynKernel(n_statement, 3, 0.2, 0), compact=True )
+        if kph.PHashGenViews(ast) != { textgen: kph.PHashGen(ast, textgen) for textgen in textgens }:
+            raise CheckError('PHashGenViews() and PHashGen() disagree')
+        times = []
+        for func in [ lambda: [ kph.PHashGen(ast, textgen) for textgen in textgens ], lambda: kph.PHashGenViews(ast) ]:
+            with kph.CollectStats() as stats:
+                start = time.perf_counter()
+                for _ in range(n_run):
+                    func()
+                t_total = (time.perf_counter() - start)/n_run
+            stages = stats.Summary()['stages']
+            times.append( ( sum( stages[stage]['time'] for stage in shared_stages )/n_run, t_total ) )
+        (t_separate, t_separate_total), (t_views, t_views_total) = times
+        print('%-10s %8d %14.1f %14.1f %7.2fx %14.1f %14.1f %7.2fx' % ('%d stmts' % n_statement, len(ast), t_separate*1e6, t_views*1e6, t_separate/t_views,
+              t_separate_total*1e6, t_views_total*1e6, t_separate_total/t_views_total))
+
+# modules that 'import KernelPHash' must not import: the functions and modes using them import them (see LazyModule)
+lazy_modules = ['anytree','graphviz','numpy','asyncio','concurrent','multiprocessing','sqlite3','socket','signal','hashlib','argparse','glob','subprocess']
+
+# python -X importtime -c code in a new interpreter, return {module: cumulative import time in seconds}
+def ImportTimes(code):
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True).stderr
+    times = {}
+    for line in err.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and fields[1].strip().isdigit():
+            times[ fields[2].strip() ] = int(fields[1])*1e-6
+    return times
+
+def BenchImportTime(n_run=5):
+    runs = [ ImportTimes('import KernelPHash') for _ in range(n_run) ]
+    t_import = min( times['KernelPHash'] for times in runs )
+    t_numpy = min( ImportTimes('import numpy')['numpy'] for _ in range(n_run) ) if kph.np is not None else 0.0
+    t_anytree = min( ImportTimes('import anytree')['anytree'] for _ in range(n_run) )
+    print('%-32s %12s' % ('python -X importtime','time(ms)'))
+    print('%-32s %12.1f' % ('import KernelPHash', t_import*1e3))
+    print('%-32s %12.1f' % ('import numpy (not imported)', t_numpy*1e3))
+    print('%-32s %12.1f' % ('import anytree (not imported)', t_anytree*1e3))
+    imported = sorted( set( name.split('.')[0] for name in runs[0] ) & set(lazy_modules) )
+    if imported:
+        raise CheckError('import KernelPHash imports '+', '.join(imported))
+
+# names used by SynKernel()
+syn_names = ['a','b','c','n','tmp','acc','x_re','x_im']
+syn_arrays = ['sample','w','out','buf']
+syn_consts = ['0','1','2','8','16','255']
+syn_binary_ops = [ op for ops in kph.binary_levels[:kph.unary_level] for op in ops ] # no member access: ASTGen cannot parse 'a.b' nor '3.14'
+syn_compare_ops = ['<','<=','>','>=','==','!=']
+
+# random valid kernel: n_statement top-level statements (assignments, compound assignments, ternaries, returns, for/while loops, if/else, array indexing, unary and binary operators),
+# blocks nested up to max_depth, a final return, and each top-level statement replaced with probability repeat by an earlier one with new constants
+def SynKernel(n_statement, max_depth=3, repeat=0.0, seed=0):
+    rng = random.Random(seed)
+
+    def Operand(d):
+        r = rng.random()
+        if r < 0.35:
+            return rng.choice(syn_names)
+        if r < 0.55:
+            return rng.choice(syn_consts)
+        if r < 0.85:
+            return rng.choice(syn_arrays)+''.join( '[%s]' % Expr(d-1) for _ in range(rng.randint(1,2)) )
+        if r < 0.95:
+            return rng.choice(['!','~'])+'(%s)' % Expr(d-1)
+        return rng.choice(syn_names)+rng.choice(['++','--'])
+
+    def Expr(d):
+        if d <= 0:
+            return rng.choice(syn_names+syn_consts)
+        if rng.random() < 0.3:
+            return Operand(d)
+        return '(%s %s %s)' % (Expr(d-1), rng.choice(syn_binary_ops), Expr(d-1))
+
+    def Cond():
+        return '%s %s %s' % (Expr(2), rng.choice(syn_compare_ops), Expr(1))
+
+    def LValue():
+        if rng.random() < 0.5:
+            return rng.choice(syn_names)
+        return rng.choice(syn_arrays)+'[%s]' % Expr(1)
+
+    def Block(d, indent):
+        return '{\n'+''.join( Statement(d, indent+'    ')+'\n' for _ in range(rng.randint(1,4)) )+indent+'}'
+
+    def Statement(d, indent):
+        r = rng.random()
+        if d > 0 and r < 0.15:
+            return indent+'for(i=0;i<%s;i++)' % rng.choice(['n','8','16'])+Block(d-1, indent)
+        if d > 0 and r < 0.22:
+            return indent+'while(%s)' % Cond()+Block(d-1, indent)
+        if d > 0 and r < 0.35:
+            text = indent+'if(%s)' % Cond()+Block(d-1, indent)
+            if rng.random() < 0.5:
+                text += ' else '+Block(d-1, indent)
+            return text
+        if r < 0.4:
+            return indent+'return %s;' % Expr(2)
+        if r < 0.5:
+            return indent+'%s = %s ? %s : %s;' % (LValue(), Cond(), Expr(1), Expr(1))
+        return indent+'%s %s %s;' % (LValue(), rng.choice(['=']*5+kph.compound_assign), Expr(rng.randint(1,3)))
+
+    statements = []
+    for _ in range(n_statement):
+        if statements and rng.random() < repeat:
+            statements.append( re.sub(r'\b\d+\b', lambda m: str(rng.randint(0,99)), rng.choice(statements)) )
+        else:
+            statements.append( Statement(max_depth, '') )
+    statements.append( 'return %s;' % Expr(2) ) # ASTGen() expects a statement after a last 'if' without 'else'
+
+    return '\n'.join(statements)+'\n'
+
+# scales of the suite: name, number of top-level statements, nesting depth
+# (ReduceHashList() computes all the pairwise distances of the about text_chars/10 raw hashes, which bounds the size in memory)
+suite_scales = [ ('small',10,2), ('medium',40,3), ('large',160,3) ]
+suite_n_kernel = 4 # kernels per scale, SynKernel() seeds 0..suite_n_kernel-1
+suite_repeat = 0.25
+suite_n_repeat = 3 # measurements of each case
+suite_baseline = 'benchmark_baseline.json'
+
+# the kernels of one scale, checked to parse without errors
+def SuiteKernels(n_statement, max_depth):
+    kernel_list = [ SynKernel(n_statement, max_depth, suite_repeat, seed) for seed in range(suite_n_kernel) ]
+    for txt in kernel_list:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ast = kph.ASTGen(txt, compact=True)
+        if out.getvalue() or any( 'Error' in label for label in ast.label_list ):
+            raise ValueError('SynKernel() generated a kernel that does not parse:\n'+out.getvalue())
+
+    return kernel_list
+
+# time ASTGen, the TextGen variants, PHashGen and the Hamming distances on each scale, {'case/scale': seconds per kernel (or per pair)}
+# and the sha256 of the generated kernels
+def RunSuite(scales=suite_scales, min_time=0.2):
+    results = {}
+    digest = hashlib.sha256()
+    for scale, n_statement, max_depth in scales:
+        kernel_list = SuiteKernels(n_statement, max_depth)
+        for txt in kernel_list:
+            digest.update(txt.encode())
+        ast_list = [ kph.ASTGen(txt) for txt in kernel_list ]
+        selfmade_list = [ kph.PHashGen(ast, phash='selfmade') for ast in ast_list ]
+        phashlib_list = [ kph.PHashGen(ast, phash='pHashlib') for ast in ast_list ]
+        pairs = [ (i,j) for i in range(len(kernel_list)) for j in range(i+1,len(kernel_list)) ]
+
+        def PerKernel(func):
+            return lambda: [ func(x) for x in ast_list ]
+        cases = [
+            ( 'ASTGen', lambda: [ kph.ASTGen(txt) for txt in kernel_list ], len(kernel_list) ),
+            ( 'ASTGen-compact', lambda: [ kph.ASTGen(txt, compact=True) for txt in kernel_list ], len(kernel_list) ),
+            ( 'TextGenDFS-pre', PerKernel(lambda ast: kph.TextGenDFS(ast,order='pre')), len(kernel_list) ),
+            ( 'TextGenDFS-post', PerKernel(lambda ast: kph.TextGenDFS(ast,order='post')), len(kernel_list) ),
+            ( 'TextGenBFS', PerKernel(kph.TextGenBFS), len(kernel_list) ),
+            ( 'PHashGen-selfmade', PerKernel(lambda ast: kph.PHashGen(ast, phash='selfmade')), len(kernel_list) ),
+            ( 'PHashGen-pHashlib', PerKernel(lambda ast: kph.PHashGen(ast, phash='pHashlib')), len(kernel_list) ),
+            ( 'HammingDist64', lambda: [ kph.HammingDist64(selfmade_list[i], selfmade_list[j]) for i, j in pairs ], len(pairs) ),
+            ( 'HammingDist', lambda: [ kph.HammingDist(phashlib_list[i], phashlib_list[j]) for i, j in pairs ], len(pairs) ),
+        ]
+        for case, func, n in cases:
+            # best of suite_n_repeat measurements, less sensitive to the noise than one average
+            results[case+'/'+scale] = min( TimeIt(func, min_time/suite_n_repeat) for _ in range(suite_n_repeat) )/n
+
+    return results, digest.hexdigest()
+
+# environment and results of RunSuite(), as saved in the baseline file
+def SuiteRecord(results, digest):
+    return {
+        'version': 1,
+        'python': platform.python_version(),
+        'numpy': kph.np.__version__ if kph.np is not None else None,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'kernels_sha256': digest,
+        'scales': suite_scales,
+        'results': results,
+    }
+
+# print the results, compared to a baseline record if given; returns the names of the cases slower than the baseline by more than tolerance
+def SuiteReport(results, baseline=None, tolerance=0.25):
+    regressions = []
+    if baseline is None:
+        print('%-32s %14s' % ('case','time(us)'))
+    else:
+        print('%-32s %14s %14s %8s' % ('case','time(us)','baseline(us)','ratio'))
+    for name, t in results.items():
+        if baseline is None:
+            print('%-32s %14.1f' % (name, t*1e6))
+            continue
+        t_base = baseline['results'].get(name)
+        if t_base is None:
+            print('%-32s %14.1f %14s %8s' % (name, t*1e6, '-', '-'))
+            continue
+        ratio = t/t_base
+        flag = ''
+        if ratio > 1+tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-32s %14.1f %14.1f %7.2fx%s' % (name, t*1e6, t_base*1e6, ratio, flag))
+
+    return regressions
+
+# python benchmark.py suite [--scales small,medium] [--min-time SECONDS] [--save FILE] [--compare FILE] [--tolerance 0.25]
+# exit status 1 if --compare finds a regression
+def SuiteMain(argv):
+    parser = argparse.ArgumentParser(prog='benchmark.py suite', description='Reproducible benchmark suite on synthetic kernels')
+    parser.add_argument('--scales', default=','.join(scale[0] for scale in suite_scales), help='comma separated scales to run')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum time of each measurement in seconds')
+    parser.add_argument('--save', metavar='FILE', nargs='?', const=suite_baseline, help='save the results as a baseline (default '+suite_baseline+')')
+    parser.add_argument('--compare', metavar='FILE', nargs='?', const=suite_baseline, help='compare with a saved baseline (default '+suite_baseline+')')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown ratio above 1 reported as a regression')
+    args = parser.parse_args(argv)
+
+    scale_dict = { scale[0]: scale for scale in suite_scales }
+    names = args.scales.split(',')
+    for name in names:
+        if not name in scale_dict:
+            print('Error: unknown scale',name,'- available:',', '.join(scale_dict))
+            return 1
+
+    baseline = None
+    if args.compare:
+        with open(args.compare,'r') as f:
+            baseline = json.load(f)
+
+    results, digest = RunSuite([ scale_dict[name] for name in names ], args.min_time)
+    if baseline is not None and baseline.get('kernels_sha256') != digest and len(names) == len(suite_scales):
+        print('Warning: the generated kernels differ from the ones of the baseline, the times may not be comparable')
+    regressions = SuiteReport(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump(SuiteRecord(results, digest), f, indent=1)
+            f.write('\n')
+        print('baseline saved to',args.save)
+
+    if regressions:
+        print('%d case(s) slower than the baseline by more than %d%%' % (len(regressions), args.tolerance*100))
+        return 1
+    return 0
+
+# start python KernelPHash.py --serve on a Unix socket in a temporary directory, return (process, socket path) once it accepts connections
+def StartService(tmp_dir, workers, extra_args=()):
+    path = os.path.join(tmp_dir, 'kph.sock')
+    proc = subprocess.Popen([sys.executable, 'KernelPHash.py', '--serve', '--socket', path, '-j', str(workers)]+list(extra_args), stderr=subprocess.PIPE, text=True)
+    line = proc.stderr.readline()
+    if not line.startswith('serving on'):
+        proc.kill()
+        raise RuntimeError('the service did not start: '+line+proc.stderr.read())
+    return proc, path
+
+# closed-loop load on the service: concurrency connections, each one sends the next request when it has the previous reply.
+# return (wall time, latencies in seconds, number of hash lists different from expected)
+async def ServiceLoad(path, kernels, expected, n_request, concurrency):
+    next_request = iter( range(n_request) )
+    latency = []
+    n_wrong = [0]
+
+    async def Connection():
+        reader, writer = await asyncio.open_unix_connection(path, limit=1<<24)
+        for i in next_request:
+            start = time.perf_counter()
+            writer.write( (json.dumps( {'id': i, 'op': 'fingerprint', 'kernel': kernels[i%len(kernels)]} )+'\n').encode() )
+            await writer.drain()
+            response = json.loads( await reader.readline() )
+            latency.append( time.perf_counter()-start )
+            n_wrong[0] += response.get('hash') != expected[i%len(kernels)]
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather( *[ Connection() for _ in range(concurrency) ] )
+    return time.perf_counter()-start, latency, n_wrong[0]
+
+# the same load with one new interpreter per request (python -c ... importing KernelPHash), return (wall time, latencies, number wrong)
+def ProcessPerRequestLoad(kernels, expected, n_request, concurrency):
+    code = 'import sys, json, KernelPHash as kph; print( json.dumps( kph.PHashGen( kph.ASTGen(sys.stdin.read()) ) ) )'
+    def Run(i):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', code], input=kernels[i%len(kernels)], capture_output=True, text=True).stdout
+        return time.perf_counter()-start, json.loads(out) != expected[i%len(kernels)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        runs = list( executor.map(Run, range(n_request)) )
+    return time.perf_counter()-start, [ t for t, _ in runs ], sum( wrong for _, wrong in runs )
+
+# Load generator of the fingerprint service: python benchmark.py service [--requests N] [--concurrency C] [--workers J] [--baseline-requests M]
+# Compares the throughput and latency of the service with one new process per request on the same kernels.
+def LoadGenMain(argv):
+    parser = argparse.ArgumentParser(prog='benchmark.py service', description='Load generator of python KernelPHash.py --serve')
+    parser.add_argument('--requests', type=int, default=400, help='number of fingerprint requests sent to the service')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of clients sending requests at the same time')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes of the service')
+    parser.add_argument('--baseline-requests', type=int, default=40, help='number of requests run with one process per request, 0 to skip')
+    parser.add_argument('--batch-window', default='2', help='--batch-window of the service in ms')
+    parser.add_argument('--max-batch', default='32', help='--max-batch of the service')
+    args = parser.parse_args(argv)
+
+    kernels = [ txt for _, txt in TestCases() ]+[ SynKernel(20, 2, suite_repeat, seed) for seed in range(16) ]
+    expected = [ kph.PHashGen( kph.ASTGen(txt) ) for txt in kernels ]
+
+    print('%-24s %8s %10s %10s %10s %10s %6s' % ('service load','requests','req/s','p50(ms)','p99(ms)','max(ms)','wrong'))
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        proc, path = StartService(tmp_dir, args.workers, ['--batch-window', args.batch_window, '--max-batch', args.max_batch])
+        try:
+            wall, latency, n_wrong = asyncio.run( ServiceLoad(path, kernels, expected, args.requests, args.concurrency) )
+            client = kph.ServiceClient(path)
+            metrics = client.Metrics()
+            client.Close()
+        finally:
+            proc.terminate()
+            proc.wait()
+        rows.append( ('service (%d workers)' % args.workers, wall, latency, n_wrong) )
+
+    if args.baseline_requests > 0:
+        wall, latency, n_wrong = ProcessPerRequestLoad(kernels, expected, args.baseline_requests, args.concurrency)
+        rows.append( ('process per request', wall, latency, n_wrong) )
+
+    for name, wall, latency, n_wrong in rows:
+        latency = sorted(latency)
+        print('%-24s %8d %10.1f %10.2f %10.2f %10.2f %6d' % (name, len(latency), len(latency)/wall, kph.Percentile(latency,50)*1e3,
+              kph.Percentile(latency,99)*1e3, latency[-1]*1e3, n_wrong))
+    if len(rows) > 1:
+        print('throughput: %.1fx the process per request baseline' % ( (len(rows[0][2])/rows[0][1]) / (len(rows[1][2])/rows[1][1]) ))
+    print('service metrics: %d batches, mean batch size %.1f, max queue depth %d, server p50 %.2f ms, p99 %.2f ms' % (metrics['batches'],
+          metrics['mean_batch_size'], metrics['max_queue_depth'], metrics['latency_p50_ms'], metrics['latency_p99_ms']))
+    return 1 if any( row[3] for row in rows ) else 0
+
+benchmarks = {
+    'tokenizer': BenchTokenizer,
+    'parser': BenchAssignParser,
+    'deep': BenchDeepKernel,
+    'compact': BenchCompactAST,
+    'reentrant': BenchReentrant,
+    'traversal': BenchTraversal,
+    'hamming': BenchHamming,
+    'pairwise': BenchPairwise,
+    'index': BenchIndex,
+    'phash': BenchPHashText,
+    'texthash': BenchTextHash64,
+    'reduce': BenchReduceHashList,
+    'cache': BenchCache,
+    'statement': BenchStatementCache,
+    'naming': BenchUnifyNaming,
+    'incremental': BenchIncremental,
+    'store': BenchStore,
+    'stats': BenchPipelineStats,
+    'importtime': BenchImportTime,
+    'padding': BenchPadding,
+    'clones': BenchClones,
+    'views': BenchViews,
+    'suite': lambda: SuiteMain([]),
+    'service': lambda: LoadGenMain([]),
+}
+
+def main(argv):
+    if argv and argv[0] == 'suite':
+        return SuiteMain(argv[1:])
+    if argv and argv[0] == 'service':
+        return LoadGenMain(argv[1:])
+    names = argv if argv else list(benchmarks)
+    for name in names:
+        if not name in benchmarks:
+            print('Error: unknown benchmark',name,'- available:',', '.join(benchmarks))
+            return 1
+    failed = []
+    for name in names:
+        try:
+            status = benchmarks[name]()
+        except CheckError as e:
+            print('Error:',e)
+            status = 1
+        if status:
+            failed.append(name)
+        print()
+
+    if failed:
+        print('Error: failed benchmark(s):',', '.join(failed))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv[1:]) )
@@ -2,7 +2,6 @@
 from anytree import Node, RenderTree
 from anytree.exporter import DotExporter
 import KernelPHash as kph
-import re
 
 # read a kernel:0 (text file)
 with open('test_cases/test.txt','r') as f:
@@ -16,8 +15,7 @@ DotExporter( ast0[0] ).to_picture('AST.png')
 
 # print the tree in terminal
 for pre, fill, node in RenderTree( ast0[0] ):
-    node_name = re.sub(r'\{[\d]+\}','',node.name) #just to remove the label {n}
-    print("%s%s" % (pre,node_name))
+    print("%s%s" % (pre,node.label)) # node.label is the node name without {n}
     
 # print DFS pre-order traversal
 text_d = kph.TextGenDFS(ast0, order='pre')